@@ -0,0 +1,302 @@
+import os
+import time
+import pickle
+import threading
+import collections
+
+import numpy
+
+import theano
+import theano.tensor as T
+
+import lasagne
+import lasagne.layers
+
+import CNN
+import CNN.conv
+import CNN.utils
+import CNN.enums
+import CNN.npnet
+
+
+class Detector(object):
+    """
+    Detector that is ready for inference: the compiled conv+pool trunk of the
+    recognition model and the loaded nolearn MLP of the detection model.
+    The conv trunk is compiled for a fixed batch size. In case of the numpy backend,
+    the trunk and the MLP are their numpy counterparts in CNN.npnet.
+    If given, fused_fn is the trunk and the MLP compiled in one function. In this case,
+    the conv trunk alone is only needed for predict(fused=False), so it can be given as
+    conv_fn_builder instead, and it's compiled the first time it's needed.
+    """
+
+    def __init__(self, conv_fn, nn_mlp, img_dim, batch_size, mlp_input_shape, fused_fn=None, conv_fn_builder=None):
+        self.nn_mlp = nn_mlp
+        self.img_dim = img_dim
+        self.batch_size = batch_size
+        self.mlp_input_shape = mlp_input_shape
+        self.fused_fn = fused_fn
+        self.__conv_fn = conv_fn
+        self.__conv_fn_builder = conv_fn_builder
+        self.__lock = threading.Lock()
+
+    @property
+    def conv_fn(self):
+        """
+        the conv trunk, compiled using conv_fn_builder if not compiled yet
+        """
+        if self.__conv_fn is None and self.__conv_fn_builder is not None:
+            with self.__lock:
+                if self.__conv_fn is None:
+                    self.__conv_fn, self.mlp_input_shape = self.__conv_fn_builder()
+                    self.__conv_fn_builder = None
+        return self.__conv_fn
+
+    def predict(self, batch, fused=True):
+        """
+        Run the conv trunk then the MLP on the given batch of regions
+        :param batch: regions, it's size must be equal to the batch size of the detector
+        :param fused: use the fused function if the detector has one
+        :return:
+        """
+        batch = batch.reshape((self.batch_size, 1, self.img_dim, self.img_dim))
+        if fused and self.fused_fn is not None:
+            return self.fused_fn(batch)
+
+        filters = self.conv_fn(batch)
+        filters = filters.reshape(self.mlp_input_shape).astype("float32")
+        return self.nn_mlp.predict(filters)
+
+
+class DetectorCache(object):
+    """
+    Process-wide registry of the detectors, so the recognition model is not re-loaded
+    and the conv trunk is not re-compiled for each image. Detectors are keyed by the
+    model pathes, the batch size and the modification time of the model files, and the
+    least recently used one is evicted when the cache is full.
+    """
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.__detectors = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, recognition_model_path, detection_model_path, batch_size, backend=CNN.enums.BackendType.theano):
+        key = self.__key(recognition_model_path, detection_model_path, batch_size, backend)
+
+        with self.__lock:
+            detector = self.__detectors.get(key)
+            if detector is not None:
+                self.__detectors.move_to_end(key)
+                return detector
+
+        # build outside the lock, compiling might take several seconds
+        detector = build_detector(recognition_model_path, detection_model_path, batch_size, backend)
+
+        with self.__lock:
+            self.__detectors[key] = detector
+            self.__detectors.move_to_end(key)
+            while len(self.__detectors) > self.max_size:
+                self.__detectors.popitem(last=False)
+
+        return detector
+
+    def warm_up(self, recognition_model_path, detection_model_path, batch_sizes, backend=CNN.enums.BackendType.theano):
+        """
+        Build the detector for each of the given batch sizes in advance
+        so the first image does not pay for the compilation
+        """
+        t1 = time.clock()
+        for batch_size in batch_sizes:
+            self.get(recognition_model_path, detection_model_path, batch_size, backend)
+        t2 = time.clock()
+        print("... warm-up of %d detectors, time(sec.): %f" % (len(batch_sizes), t2 - t1))
+
+    def clear(self):
+        with self.__lock:
+            self.__detectors.clear()
+
+    def __len__(self):
+        return len(self.__detectors)
+
+    def __key(self, recognition_model_path, detection_model_path, batch_size, backend):
+        recognition_model_path = os.path.abspath(recognition_model_path)
+        detection_model_path = os.path.abspath(detection_model_path)
+        recognition_mtime = os.path.getmtime(recognition_model_path)
+        detection_mtime = os.path.getmtime(detection_model_path)
+        return recognition_model_path, detection_model_path, batch_size, backend, recognition_mtime, detection_mtime
+
+
+def build_conv_fn(loaded_objects, batch_size):
+    """
+    Compile the 3 layers of conv+pool of the given recognition model
+    (of type ModelType._02_conv3_mlp2) for the given batch size
+    :param loaded_objects: the objects loaded by CNN.utils.load_model
+    :param batch_size:
+    :return: the compiled function and the shape of it's flattened output
+    """
+
+    layer0_input, layer2_output, layer3_input_shape = __build_conv_graph(loaded_objects, batch_size)
+
+    # do the filtering using 3 layers of Conv+Pool
+    conv_fn = theano.function([layer0_input], layer2_output)
+
+    return conv_fn, layer3_input_shape
+
+
+def build_fused_fn(loaded_objects, nn_mlp, batch_size):
+    """
+    Compile the 3 layers of conv+pool of the given recognition model and the layers of the
+    given nolearn MLP in one function, from the regions to the predictions. The MLP is
+    plugged on the output of the conv+pool layers using the weights of it's lasagne layers,
+    so the filters are neither copied nor casted outside the graph.
+    :param loaded_objects: the objects loaded by CNN.utils.load_model
+    :param nn_mlp: the loaded nolearn NeuralNet of the detection model
+    :param batch_size:
+    :return: the compiled function, it gives the same output as nn_mlp.predict
+    """
+
+    layer0_input, layer2_output, layer3_input_shape = __build_conv_graph(loaded_objects, batch_size)
+
+    # the input/output layers of the MLP, the input layer is replaced by the conv+pool output
+    nn_mlp.initialize()
+    mlp_layers = list(nn_mlp.layers_.values())
+    mlp_input = T.cast(layer2_output.flatten(2), "float32")
+    mlp_output = lasagne.layers.get_output(mlp_layers[-1], {mlp_layers[0]: mlp_input}, deterministic=True)
+
+    # same as nolearn, in case of classification, the prediction is the class with max probability
+    if not nn_mlp.regression:
+        mlp_output = T.argmax(mlp_output, axis=1)
+
+    fused_fn = theano.function([layer0_input], mlp_output)
+
+    # same as nolearn, the predicted classes are mapped to the labels of it's label encoder, if any
+    # they might not be numbers, so they are mapped outside the graph
+    if not nn_mlp.regression and nn_mlp.use_label_encoder:
+        classes = nn_mlp.enc_.classes_
+        fused_argmax_fn = fused_fn
+        fused_fn = lambda batch: classes[fused_argmax_fn(batch)]
+
+    return fused_fn
+
+
+def __build_conv_graph(loaded_objects, batch_size):
+
+    img_dim = loaded_objects[1]
+    kernel_dim = loaded_objects[2]
+    nkerns = loaded_objects[3]
+    pool_size = loaded_objects[5]
+
+    layer0_W = theano.shared(loaded_objects[6], borrow=True)
+    layer0_b = theano.shared(loaded_objects[7], borrow=True)
+    layer1_W = theano.shared(loaded_objects[8], borrow=True)
+    layer1_b = theano.shared(loaded_objects[9], borrow=True)
+    layer2_W = theano.shared(loaded_objects[10], borrow=True)
+    layer2_b = theano.shared(loaded_objects[11], borrow=True)
+
+    layer0_input = T.tensor4(name='input')
+    layer0_img_dim = img_dim
+    layer0_kernel_dim = kernel_dim[0]
+    layer1_img_dim = int((layer0_img_dim - layer0_kernel_dim + 1) / 2)
+    layer1_kernel_dim = kernel_dim[1]
+    layer2_img_dim = int((layer1_img_dim - layer1_kernel_dim + 1) / 2)
+    layer2_kernel_dim = kernel_dim[2]
+    layer3_img_dim = int((layer2_img_dim - layer2_kernel_dim + 1) / 2)
+    layer3_input_shape = (batch_size, nkerns[2] * layer3_img_dim * layer3_img_dim)
+
+    # layer 0, 1, 2: Conv-Pool
+    layer0_output = CNN.conv.convpool_layer(
+        input=layer0_input, W=layer0_W, b=layer0_b,
+        image_shape=(batch_size, 1, layer0_img_dim, layer0_img_dim),
+        filter_shape=(nkerns[0], 1, layer0_kernel_dim, layer0_kernel_dim),
+        pool_size=pool_size
+    )
+    layer1_output = CNN.conv.convpool_layer(
+        input=layer0_output, W=layer1_W, b=layer1_b,
+        image_shape=(batch_size, nkerns[0], layer1_img_dim, layer1_img_dim),
+        filter_shape=(nkerns[1], nkerns[0], layer1_kernel_dim, layer1_kernel_dim),
+        pool_size=pool_size
+    )
+    layer2_output = CNN.conv.convpool_layer(
+        input=layer1_output, W=layer2_W, b=layer2_b,
+        image_shape=(batch_size, nkerns[1], layer2_img_dim, layer2_img_dim),
+        filter_shape=(nkerns[2], nkerns[1], layer2_kernel_dim, layer2_kernel_dim),
+        pool_size=pool_size
+    )
+    return layer0_input, layer2_output, layer3_input_shape
+
+
+def build_detector(recognition_model_path, detection_model_path, batch_size, backend=CNN.enums.BackendType.theano):
+    print("... building detector, batch size: %d, backend: %s" % (batch_size, backend.name))
+
+    loaded_objects = CNN.utils.load_model(model_path=recognition_model_path, model_type=CNN.enums.ModelType._02_conv3_mlp2)
+    img_dim = loaded_objects[1]
+
+    # load the regression/binary model
+    with open(detection_model_path, 'rb') as f:
+        nn_mlp = pickle.load(f)
+
+    fused_fn = None
+    conv_fn_builder = None
+    if backend == CNN.enums.BackendType.theano:
+        # only the fused function is compiled, the conv trunk alone is compiled
+        # the first time it's needed (predict without fusing), not for each detector
+        fused_fn = build_fused_fn(loaded_objects, nn_mlp, batch_size)
+        conv_fn = None
+        mlp_input_shape = None
+        conv_fn_builder = lambda: build_conv_fn(loaded_objects, batch_size)
+    elif backend == CNN.enums.BackendType.numpy:
+        conv_fn = CNN.npnet.ConvTrunk(loaded_objects, n_layers=3)
+        mlp_input_shape = (batch_size, -1)
+        nn_mlp = CNN.npnet.MLP.from_nolearn(nn_mlp)
+    else:
+        raise Exception("Unknown backend type")
+
+    return Detector(conv_fn, nn_mlp, img_dim, batch_size, mlp_input_shape, fused_fn, conv_fn_builder)
+
+
+# the default registry, shared by all the detection entry points of the process
+__detectors = DetectorCache()
+
+
+def get_detector(recognition_model_path, detection_model_path, batch_size, backend=CNN.enums.BackendType.theano):
+    return __detectors.get(recognition_model_path, detection_model_path, batch_size, backend)
+
+
+def warm_up(recognition_model_path, detection_model_path, batch_sizes, backend=CNN.enums.BackendType.theano):
+    __detectors.warm_up(recognition_model_path, detection_model_path, batch_sizes, backend)
+
+
+def clear():
+    __detectors.clear()
+
+
+def check_fused_detector(recognition_model_path, detection_model_path, batch_size=50, n_batches=20):
+    """
+    Run the detector with and without the fused function on the same random regions,
+    print the max difference between the two outputs (or the number of different labels
+    in case of classification) and the time per batch of each
+    """
+
+    detector = get_detector(recognition_model_path, detection_model_path, batch_size)
+    img_dim = detector.img_dim
+
+    rng = numpy.random.RandomState(1234)
+    batch = rng.uniform(low=0, high=1, size=(batch_size, 1, img_dim, img_dim)).astype("float32")
+
+    durations = []
+    predictions = []
+    for fused in [False, True]:
+        t1 = time.clock()
+        for i in range(n_batches):
+            pred = detector.predict(batch, fused)
+        t2 = time.clock()
+        durations.append((t2 - t1) / n_batches)
+        predictions.append(pred)
+
+    if detector.nn_mlp.regression:
+        pred_diff = numpy.max(numpy.abs(predictions[0] - predictions[1]))
+    else:
+        pred_diff = numpy.sum(predictions[0] != predictions[1])
+    print("... max difference: %f, time(sec./batch) not fused: %f, fused: %f" % (pred_diff, durations[0], durations[1]))
+    return pred_diff, durations[0], durations[1]
@@ -8,6 +8,7 @@ import numpy
 import pickle
 import csv
 import time
+import concurrent.futures
 
 import lasagne
 import lasagne.layers
@@ -15,6 +16,69 @@ import nolearn
 import nolearn.lasagne
 
 
+class CascadeClassifier(object):
+    """
+    Hierarchical classifier: the superclass model predicts the superclass of the images,
+    then each image is classified by the model of it's superclass. All the models are kept
+    loaded so the classifier can be used for many batches of images (the test set
+    or the regions of street view images)
+    """
+
+    def __init__(self, sc_model_path, models_pathes, superclass_types, img_dim=28):
+        """
+        :param sc_model_path: the superclass model, it's prediction i means superclass_types[i]
+        :param models_pathes: the class-specific models, one for each superclass
+        :param superclass_types:
+        :param img_dim:
+        """
+
+        self.img_dim = img_dim
+        self.superclass_types = superclass_types
+
+        print('... loading superclass model')
+        with open(sc_model_path, 'rb') as f:
+            self.__sc_model = pickle.load(f)
+
+        self.__class_models = []
+        self.__class_ids = []
+        for model_path, superclass_type in zip(models_pathes, superclass_types):
+            print("... loading %s model" % (superclass_type.name))
+            with open(model_path, 'rb') as f:
+                self.__class_models.append(pickle.load(f))
+            # lookup table to restore the original class ids
+            self.__class_ids.append(numpy.asarray(CNN.utils.superclass_classes_ids(superclass_type)))
+
+        # the class-specific models are independent, so they run concurrently
+        self.__pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.__class_models))
+
+    def predict(self, images):
+        n_images = images.shape[0]
+        images = images.reshape((n_images, 1, self.img_dim, self.img_dim))
+        predictions = numpy.zeros(shape=(n_images,), dtype=int)
+
+        sc_prediction = self.__sc_model.predict(images)
+
+        # group the images by their superclass, using one sort instead of where for each model
+        img_idx = numpy.argsort(sc_prediction, kind="mergesort")
+        n_models = len(self.__class_models)
+        img_split = numpy.cumsum(numpy.bincount(sc_prediction, minlength=n_models))[:-1]
+        models_img_idx = numpy.split(img_idx, img_split)[0:n_models]
+
+        futures = []
+        for class_model, model_img_idx in zip(self.__class_models, models_img_idx):
+            if len(model_img_idx) == 0:
+                futures.append(None)
+            else:
+                futures.append(self.__pool.submit(class_model.predict, images[model_img_idx]))
+
+        # restore the original class ids and add the predictions in their location of the final list
+        for future, class_ids, model_img_idx in zip(futures, self.__class_ids, models_img_idx):
+            if future is not None:
+                predictions[model_img_idx] = class_ids[future.result()]
+
+        return predictions
+
+
 def classify_testset():
     dataset_path = "D:\\_Dataset\GTSRB\\gtsrb_serialized_test_28.pkl"
     sc_model_path = "D:\\_Dataset\\SuperClass\\cnn_model_las_28.pkl"
@@ -24,8 +88,6 @@ def classify_testset():
     others_model_path = "D:\\_Dataset\\GTSRB\\cnn_model_las_o_28.pkl"
     result_file_path = "D:\\_Dataset\GTSRB\\_Results\\Result_%d.csv" % int(time.time())
     img_dim = 28
-    train_images = []
-    train_classes = []
 
     # load data
     print('... loading data')
@@ -36,46 +98,22 @@ def classify_testset():
     test_images = dataset[0]
     n_images = test_images.shape[0]
     test_images = test_images.reshape((n_images, 1, img_dim, img_dim))
-    final_predictions = numpy.zeros(shape=(n_images,), dtype=int)
     del dataset
 
     # load models
-    print('... loading superclass model')
-    with open(sc_model_path, 'rb') as f:
-        sc_model = pickle.load(f)
-
-    print('... predicting superclass')
-    sc_prediction = sc_model.predict(test_images)
-    sc_prediction_list = sc_prediction.tolist()
-    del sc_model
-
-    n_models = 4
-    models_names = ["prohibitory", "warning", "mandatory", "others"]
     models_pathes = [prohib_model_path, warning_model_path, mandat_model_path, others_model_path]
     superclass_types = [CNN.enums.SuperclassType._01_Prohibitory,
                         CNN.enums.SuperclassType._02_Warning,
                         CNN.enums.SuperclassType._03_Mandatory,
                         CNN.enums.SuperclassType._04_Other]
-
-    # for all the class-specific models
-    for i in range(0, n_models):
-        # load the model
-        print("... loading %s model" % (models_names[i]))
-        with open(models_pathes[i], 'rb') as f:
-            class_model = pickle.load(f)
-
-        img_idx = numpy.where(sc_prediction == i)[0]
-        model_images = test_images[img_idx]
-
-        # get prediction, then delete the model
-        class_predictions = class_model.predict(model_images)
-        del class_model
-
-        # restore the original class ids
-        class_predictions = CNN.utils.restore_class_ids(class_predictions, superclass_types[i])
-
-        # add these predictions in their location of the final list
-        final_predictions[img_idx] = class_predictions
+    classifier = CascadeClassifier(sc_model_path, models_pathes, superclass_types, img_dim)
+
+    print('... predicting')
+    t1 = time.clock()
+    final_predictions = classifier.predict(test_images)
+    t2 = time.clock()
+    duration = t2 - t1
+    print("... %d images, time(sec.): %f, images/sec.: %f" % (n_images, duration, n_images / duration))
 
     # finally, calcuate the final error
     error = 100 * numpy.sum(numpy.not_equal(final_predictions, test_truth)) / n_images
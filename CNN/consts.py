@@ -3,3 +3,11 @@ class ClassesIDs(object):
     WARNING_CLASSES = [11, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31]
     MANDATORY_CLASSES = [33, 34, 35, 36, 37, 38, 39, 40]
     OTHER_CLASSES = [6, 12, 13, 14, 17, 32, 41, 42]
+
+
+class ModelBinaryFormat(object):
+    MAGIC = b"TSRMODEL"
+    VERSION = 1
+    STRUCT = "<II"
+    PAGE_SIZE = 4096
+    EXTENSION = ".bin"
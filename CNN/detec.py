@@ -26,6 +26,11 @@ import CNN.enums
 import CNN.recog
 import CNN.nms
 import CNN.prop
+import CNN.cache
+import CNN.region
+import CNN.frame
+import CNN.heatmap
+import CNN.sink
 
 from CNN.mlp import HiddenLayer
 
@@ -910,60 +915,11 @@ def detect_from_dataset(dataset_path, recognition_model_path, detection_model_pa
     # then load the regression model to run on these filters
     # note, you may apply on train, valid and test datasets for comparison
 
-    # load model and read it's parameters
-    loaded_objects = CNN.utils.load_model(recognition_model_path, CNN.enums.ModelType._02_conv3_mlp2)
-    img_dim = loaded_objects[1]
-    kernel_dim = loaded_objects[2]
-    nkerns = loaded_objects[3]
-    pool_size = loaded_objects[5]
+    # load the cnn model and the regression model, or get them from the cache if already loaded
     batch_size = 1000
-
-    # parameters of the convolutional+maxpool layers
-    layer0_W = theano.shared(loaded_objects[6], borrow=True)
-    layer0_b = theano.shared(loaded_objects[7], borrow=True)
-    layer1_W = theano.shared(loaded_objects[8], borrow=True)
-    layer1_b = theano.shared(loaded_objects[9], borrow=True)
-    layer2_W = theano.shared(loaded_objects[10], borrow=True)
-    layer2_b = theano.shared(loaded_objects[11], borrow=True)
-
-    layer0_input = T.tensor4('input')
-    layer0_img_dim = img_dim
-    layer0_kernel_dim = kernel_dim[0]
-    layer1_img_dim = int((layer0_img_dim - layer0_kernel_dim + 1) / 2)
-    layer1_kernel_dim = kernel_dim[1]
-    layer2_img_dim = int((layer1_img_dim - layer1_kernel_dim + 1) / 2)
-    layer2_kernel_dim = kernel_dim[2]
-    layer3_img_dim = int((layer2_img_dim - layer2_kernel_dim + 1) / 2)
-    layer3_input_shape = (batch_size, nkerns[2] * layer3_img_dim * layer3_img_dim)
-
-    # layer 0, 1, 2: Conv-Pool
-    layer0_output = CNN.conv.convpool_layer(
-        input=layer0_input, W=layer0_W, b=layer0_b,
-        image_shape=(batch_size, 1, layer0_img_dim, layer0_img_dim),
-        filter_shape=(nkerns[0], 1, layer0_kernel_dim, layer0_kernel_dim),
-        pool_size=pool_size
-    )
-    layer1_output = CNN.conv.convpool_layer(
-        input=layer0_output, W=layer1_W, b=layer1_b,
-        image_shape=(batch_size, nkerns[0], layer1_img_dim, layer1_img_dim),
-        filter_shape=(nkerns[1], nkerns[0], layer1_kernel_dim, layer1_kernel_dim),
-        pool_size=pool_size
-    )
-    layer2_output = CNN.conv.convpool_layer(
-        input=layer1_output, W=layer2_W, b=layer2_b,
-        image_shape=(batch_size, nkerns[1], layer2_img_dim, layer2_img_dim),
-        filter_shape=(nkerns[2], nkerns[1], layer2_kernel_dim, layer2_kernel_dim),
-        pool_size=pool_size
-    )
-    # do the filtering using 3 layers of Conv+Pool
-    conv_fn = theano.function([layer0_input], layer2_output)
-
-    #########################################
-    #       Build the regression model      #
-    #########################################
     print("... load the regression model")
-    with open(detection_model_path, 'rb') as f:
-        nn_regression = pickle.load(f)
+    detector = CNN.cache.get_detector(recognition_model_path, detection_model_path, batch_size)
+    img_dim = detector.img_dim
 
     ##############################
     # Test the regression model  #
@@ -982,10 +938,7 @@ def detect_from_dataset(dataset_path, recognition_model_path, detection_model_pa
         subset_x = subset_x[0:batch_size]
         subset_y_int = subset_y_int[0:batch_size]
         subset_y = ((subset_y_int * 2) - img_dim) / img_dim
-        inputs_reshaped = subset_x.reshape(batch_size, 1, layer0_img_dim, layer0_img_dim)
-        filters = conv_fn(inputs_reshaped)
-        filters = filters.reshape(layer3_input_shape).astype("float32")
-        predict_y = nn_regression.predict(filters)
+        predict_y = detector.predict(subset_x)
         # calculate the error of the prediction
         predict_y = numpy.rint(((predict_y * img_dim) + img_dim) / 2).astype(int)
         error = numpy.mean(numpy.mean(numpy.abs(subset_y_int - predict_y), axis=0))
@@ -1032,11 +985,6 @@ def binary_detect_from_file_fast(img_path, recognition_model_path, detection_mod
 
     r_count = 0
 
-    # regions, locations and window_dim at each scale
-    regions = []
-    locations = []
-    window_dims = []
-
     # important, instead of naively add every sliding window, we'll only add
     # windows that covers the strong detection proposals
     prop_weak, prop_strong, prop_map, prop_circles = CNN.prop.detection_proposal(img_color, min_dim=min_window_dim, max_dim=max_window_dim)
@@ -1044,41 +992,13 @@ def binary_detect_from_file_fast(img_path, recognition_model_path, detection_mod
         print("... NO TRAFFIC SIGN PROPOSALS WERE FOUND")
         return
 
-    # loop on the detection proposals
+    # crop, resize and equalize the regions at all the scales of all the proposals in one go
+    # we only need to store the region, it's top-left corner and sliding window dim
     scales = numpy.arange(0.7, 1.58, 0.05)
-    for prop in prop_strong:
-        x1 = prop[0]
-        y1 = prop[1]
-        x2 = prop[2]
-        y2 = prop[3]
-        w = x2 - x1
-        h = y2 - y1
-        window_dim = max(h, w)
-        center_x = int(x1 + round(w / 2))
-        center_y = int(y1 + round(h / 2))
-
-        for scale in scales:
-            dim = window_dim * scale
-            dim_half = round(dim / 2)
-            dim = round(dim)
-            x1 = center_x - dim_half
-            y1 = center_y - dim_half
-            x2 = center_x + dim_half
-            y2 = center_y + dim_half
-
-            # pre-process the region and scale it to img_dim
-            region = img[y1:y2, x1:x2]
-            region = skimage.transform.resize(region, output_shape=(img_dim, img_dim))
-            region = skimage.exposure.equalize_hist(region)
-
-            # we only need to store the region, it's top-left corner and sliding window dim
-            regions.append(region)
-            locations.append([x1, y1])
-            window_dims.append(dim)
-
-    regions = numpy.asarray(regions)
-    locations = numpy.asarray(locations)
-    window_dims = numpy.asarray(window_dims)
+    boxes, window_dims = CNN.region.boxes_at_scales(prop_strong, scales)
+    regions = CNN.region.RegionBatcher(img_dim).extract(img, boxes)
+    regions = regions.reshape((regions.shape[0], img_dim, img_dim))
+    locations = boxes[:, 0:2]
 
     # run the detector on the regions
     start_time = time.clock()
@@ -1094,10 +1014,11 @@ def binary_detect_from_file_fast(img_path, recognition_model_path, detection_mod
     s_count = 0
     overlap_thresh = 0.5
     min_overlap = 0
+    heatmap = CNN.heatmap.HeatmapAccumulator(img_width, img_height)
     for pred, loc, window_dim in zip(predictions, locations, window_dims):
         s_count += 1
         map, w_regions, s_regions = __probability_map(img, [pred], [loc], window_dim, img_width, img_height, img_dim, s_count,
-                                                      False, overlap_thresh=overlap_thresh, min_overlap=min_overlap)
+                                                      False, overlap_thresh=overlap_thresh, min_overlap=min_overlap, heatmap=heatmap)
         if len(s_regions) > 0:
             strong_regions.append(s_regions)
             print("Scale: %d, window_dim: %d, regions: %d, strong regions detected" % (s_count, window_dim, r_count))
@@ -1171,6 +1092,9 @@ def binary_detect_from_file(img_path, recognition_model_path, detection_model_pa
     scale_locations = []
     scale_window_dim = []
 
+    # the image is pre-processed for the detection proposals only once for all the scales
+    prop_context = CNN.prop.ProposalContext(img_color)
+
     # we start by the window dimension = max and stop when it goes below
     # the min, at each iteration, we scale down the window dimension by a factor
     window_dim = max_window_dim
@@ -1200,19 +1124,13 @@ def binary_detect_from_file(img_path, recognition_model_path, detection_model_pa
         s_count += 1
         r_count = 0
 
-        # for the current scale of the window, extract regions, start from the
-        y = 0
-        x_count = 0
-        y_count = 0
-        region_shape = []
-
         # check if option of using proposal is enabled
         if proposals:
             # important, instead of naively add every sliding window, we'll only add
             # windows that covers the strong detection proposals
             prop_max_dim = int(window_dim * 1.1)
             prop_min_dim = int(window_dim * 0.65)
-            prop_weak, prop_strong, prop_map, prop_circles = CNN.prop.detection_proposal(img_color, min_dim=prop_min_dim, max_dim=prop_max_dim)
+            prop_weak, prop_strong, prop_map, prop_circles, prop_integral = CNN.prop.detection_proposal(prop_context, min_dim=prop_min_dim, max_dim=prop_max_dim, integral=True)
             if len(prop_strong) == 0:
                 print("Scale: %d, stride: %d, window_dim: %d, regions: %d" % (s_count, stride, window_dim, r_count))
                 window_dim = int(window_dim * down_scale_factor)
@@ -1220,53 +1138,28 @@ def binary_detect_from_file(img_path, recognition_model_path, detection_model_pa
                 scale_locations.append([])
                 continue
 
-        while y <= img_height:
-            x = 0
-            x_count = 0
-            while x <= img_width:
-
-                # check if option of using proposal is enabled
-                if proposals:
-                    # if the current region does not intersect with the proposal, then ignore it
-                    if not numpy.any(prop_map[y:y + window_dim, x:x + window_dim]):
-                        x += stride
-                        region_shape = (window_dim, window_dim)
-                        continue
-
-                # - add region to the region list
-                # - adjust the position of the ground_truth to be relative to the window
-                #   relative frame of reference (i.e not relative to the image)
-                # - don't forget to re_scale the extracted/sampled region to be 28*28
-                #   hence, multiply the relative position with this scaling accordingly
-                # - also, the image needs to be preprocessed so it can be ready for the CNN
-                region = img[y:y + window_dim, x:x + window_dim]
-                region_shape = region.shape
-                region = skimage.transform.resize(region, output_shape=(img_dim, img_dim))
-
-                # pre-process the region if needed
-                region = skimage.exposure.equalize_hist(region)
-
-                # we only need to store the region, it's top-left corner and sliding window dim
-                regions.append(region)
-                locations.append([x, y])
-
-                r_count += 1
+        # top-left corners of all the windows of the current scale, if proposals are enabled, only
+        # the windows that intersect with the proposals (tested using the integral of the proposal map)
+        origins = CNN.prop.window_origins(img_height, img_width, window_dim, stride, prop_integral if proposals else None)
+        for x, y in origins:
+
+            # - add region to the region list
+            # - adjust the position of the ground_truth to be relative to the window
+            #   relative frame of reference (i.e not relative to the image)
+            # - don't forget to re_scale the extracted/sampled region to be 28*28
+            #   hence, multiply the relative position with this scaling accordingly
+            # - also, the image needs to be preprocessed so it can be ready for the CNN
+            region = img[y:y + window_dim, x:x + window_dim]
+            region = skimage.transform.resize(region, output_shape=(img_dim, img_dim))
 
-                # # # save region for experiemnt
-                # filePathWrite = "D:\\_Dataset\\GTSDB\\Test_Regions\\%s_%s.png" % ("{0:03d}".format(s_count), "{0:03d}".format(r_count))
-                # img_save = region * 255
-                # img_save = img_save.astype(int)
-                # cv2.imwrite(filePathWrite, img_save)
+            # pre-process the region if needed
+            region = skimage.exposure.equalize_hist(region)
 
-                x_count += 1
-                x += stride
-                if region_shape[1] < window_dim:
-                    break
+            # we only need to store the region, it's top-left corner and sliding window dim
+            regions.append(region)
+            locations.append([x, y])
 
-            y_count += 1
-            if region_shape[0] < window_dim:
-                break
-            y += stride
+            r_count += 1
 
         # append all the regions extracted from the current scale
         # we'll only do detection after we collect all the regions
@@ -1294,10 +1187,11 @@ def binary_detect_from_file(img_path, recognition_model_path, detection_model_pa
 
     # construct the probability map for each scale and show it/ save it
     s_count = 0
+    heatmap = CNN.heatmap.HeatmapAccumulator(img_width, img_height)
     for pred, locations in zip(scale_pred, scale_locations):
         window_dim = scale_window_dim[s_count]
         s_count += 1
-        map, weak_regions, strong_regions = __probability_map(img, pred, locations, window_dim, img_width, img_height, img_dim, s_count, False)
+        map, weak_regions, strong_regions = __probability_map(img, pred, locations, window_dim, img_width, img_height, img_dim, s_count, False, heatmap=heatmap)
         if len(strong_regions) > 0:
             scale_strong_regions.append(strong_regions)
             print("Scale: %d, stride: %d, window_dim: %d, regions: %d, strong regions detected" % (s_count, stride, window_dim, r_count))
@@ -1367,6 +1261,9 @@ def detect_from_file_fast(img_path, recognition_model_path, detection_model_path
     scale_regions = []
     scale_locations = []
 
+    # the image is pre-processed for the detection proposals only once for all the scales
+    prop_context = CNN.prop.ProposalContext(img_color)
+
     # we start by the window dimension = max and stop when it goes below
     # the min, at each iteration, we scale down the window dimension by a factor
     window_dim = max_window_dim
@@ -1402,7 +1299,7 @@ def detect_from_file_fast(img_path, recognition_model_path, detection_model_path
         # we only add windows that covers the strong detection proposals
         prop_max_dim = int(window_dim * 1.1)
         prop_min_dim = int(window_dim * 0.65)
-        prop_weak, prop_strong, prop_map, prop_circles = CNN.prop.detection_proposal(img_color, min_dim=prop_min_dim, max_dim=prop_max_dim)
+        prop_weak, prop_strong, prop_map, prop_circles = CNN.prop.detection_proposal(prop_context, min_dim=prop_min_dim, max_dim=prop_max_dim)
         if len(prop_strong) == 0:
             print("Scale: %d, stride: %d, window_dim: %d, regions: %d" % (s_count, stride, window_dim, r_count))
             window_dim = int(window_dim * down_scale_factor)
@@ -1451,10 +1348,11 @@ def detect_from_file_fast(img_path, recognition_model_path, detection_model_path
 
     # construct the probability map for each scale and show it/ save it
     s_count = 0
+    heatmap = CNN.heatmap.HeatmapAccumulator(img_width, img_height)
     for pred, locations in zip(scale_pred, scale_locations):
         window_dim = scale_window_dim[s_count]
         s_count += 1
-        map, weak_regions, strong_regions = __probability_map(img, pred, locations, window_dim, img_width, img_height, img_dim, s_count)
+        map, weak_regions, strong_regions = __probability_map(img, pred, locations, window_dim, img_width, img_height, img_dim, s_count, heatmap=heatmap)
         if len(strong_regions) > 0:
             scale_strong_regions.append(strong_regions)
             print("Scale: %d, stride: %d, window_dim: %d, regions: %d, strong regions detected" % (s_count, stride, window_dim, r_count))
@@ -1468,7 +1366,7 @@ def detect_from_file_fast(img_path, recognition_model_path, detection_model_path
         __confidence_map(img, img_width, img_height, scale_regions, s_count)
 
 
-def detect_from_file(img_path, recognition_model_path, detection_model_path, img_dim, proposals=True):
+def detect_from_file(img_path, recognition_model_path, detection_model_path, img_dim, proposals=True, pyramid=True):
     """
     detect a traffic sign form the given natural image
     detected signs depend on the given model, for example if it is a prohibitory detection model
@@ -1477,6 +1375,9 @@ def detect_from_file(img_path, recognition_model_path, detection_model_path, img
     :param model_path:
     :param classifier:
     :param img_dim:
+    :param proposals:
+    :param pyramid: in case of not using proposals, extract the sliding windows from an image pyramid
+    instead of resizing each window, see CNN.region.ImagePyramid
     :return:
     """
 
@@ -1526,67 +1427,76 @@ def detect_from_file(img_path, recognition_model_path, detection_model_path, img
     scale_locations = []
     scale_window_dim = []
 
-    # we start by the window dimension = max and stop when it goes below
-    # the min, at each iteration, we scale down the window dimension by a factor
-    window_dim = max_window_dim
-
-    # scale_down until you reach the min window
-    # instead of scaling up the image itself, we scale down the sliding window
-    while window_dim >= min_window_dim:
-
-        # we need to save window_dim at each scale to resize back the predicted region
-        scale_window_dim.append(window_dim)
-
-        # locations are the x,y position (top left) of the sliding-windows
-        # regions are the extracted sliding windows from the image, passed
-        # later to the detector to predict the location of the traffic sign with-in each one
-        regions = []
-        locations = []
-
-        # stride is dynamic, smaller strides for smaller scales
-        # this means that stride is equivialant to 2 pixels
-        # when the window is resized to the img_dim (required for CNN)
-        # r_factor = window_dim / min_window_dim
-        # stride = int(stride_factor * int(r_factor))
-
-        # simpler way to calculate the stride is: the stride is 10% of the current window dim
-        stride = int(window_dim * stride_factor)
-
-        s_count += 1
-        r_count = 0
+    # the image is pre-processed for the detection proposals (and the image pyramid
+    # is built in case of not using proposals) only once for all the scales
+    prop_context = CNN.frame.FrameContext(img_color)
 
-        # for the current scale of the window, extract regions, start from the
-        y = 0
-        x_count = 0
-        y_count = 0
-        region_shape = []
-
-        # check if option of using proposal is enabled
-        if proposals:
-            # important, instead of naively add every sliding window, we'll only add
-            # windows that covers the strong detection proposals
-            prop_max_dim = int(window_dim * 1.1)
-            prop_min_dim = int(window_dim * 0.65)
-            prop_weak, prop_strong, prop_map, prop_circles = CNN.prop.detection_proposal(img_color, min_dim=prop_min_dim, max_dim=prop_max_dim)
-            if len(prop_strong) == 0:
-                print("Scale: %d, stride: %d, window_dim: %d, regions: %d" % (s_count, stride, window_dim, r_count))
-                window_dim = int(window_dim * down_scale_factor)
-                scale_regions.append([])
-                scale_locations.append([])
-                continue
+    # exhaustive scan using the image pyramid, the image is resized once per window dim
+    # and the windows are passed to the detector in chunks
+    if not proposals and pyramid:
+        window_dim = max_window_dim
+        while window_dim >= min_window_dim:
+            scale_window_dim.append(window_dim)
+            window_dim = int(window_dim * down_scale_factor)
+        s_count = len(scale_window_dim)
+        stride = int(img_dim * stride_factor)
 
-        while y <= img_height:
-            x = 0
-            x_count = 0
-            while x <= img_width:
+        start_time = time.clock()
+        image_pyramid = prop_context.image_pyramid(img_dim, stride_factor)
+        scale_pred, scale_locations = __detect_from_pyramid(image_pyramid, scale_window_dim, recognition_model_path, detection_model_path)
+        end_time = time.clock()
+        duration = (end_time - start_time) / 60.0
+        r_count = sum([len(locations) for locations in scale_locations])
+        print("... detection regions: %d, duration(min.): %f" % (r_count, duration))
 
-                # check if option of using proposal is enabled
-                if proposals:
-                    # if the current region does not intersect with the proposal, then ignore it
-                    if not numpy.any(prop_map[y:y + window_dim, x:x + window_dim]):
-                        x += stride
-                        region_shape = (window_dim, window_dim)
-                        continue
+    else:
+        # we start by the window dimension = max and stop when it goes below
+        # the min, at each iteration, we scale down the window dimension by a factor
+        window_dim = max_window_dim
+
+        # scale_down until you reach the min window
+        # instead of scaling up the image itself, we scale down the sliding window
+        while window_dim >= min_window_dim:
+
+            # we need to save window_dim at each scale to resize back the predicted region
+            scale_window_dim.append(window_dim)
+
+            # locations are the x,y position (top left) of the sliding-windows
+            # regions are the extracted sliding windows from the image, passed
+            # later to the detector to predict the location of the traffic sign with-in each one
+            regions = []
+            locations = []
+
+            # stride is dynamic, smaller strides for smaller scales
+            # this means that stride is equivialant to 2 pixels
+            # when the window is resized to the img_dim (required for CNN)
+            # r_factor = window_dim / min_window_dim
+            # stride = int(stride_factor * int(r_factor))
+
+            # simpler way to calculate the stride is: the stride is 10% of the current window dim
+            stride = int(window_dim * stride_factor)
+
+            s_count += 1
+            r_count = 0
+
+            # check if option of using proposal is enabled
+            if proposals:
+                # important, instead of naively add every sliding window, we'll only add
+                # windows that covers the strong detection proposals
+                prop_max_dim = int(window_dim * 1.1)
+                prop_min_dim = int(window_dim * 0.65)
+                prop_weak, prop_strong, prop_map, prop_circles, prop_integral = CNN.prop.detection_proposal(prop_context, min_dim=prop_min_dim, max_dim=prop_max_dim, integral=True)
+                if len(prop_strong) == 0:
+                    print("Scale: %d, stride: %d, window_dim: %d, regions: %d" % (s_count, stride, window_dim, r_count))
+                    window_dim = int(window_dim * down_scale_factor)
+                    scale_regions.append([])
+                    scale_locations.append([])
+                    continue
+
+            # top-left corners of all the windows of the current scale, if proposals are enabled, only
+            # the windows that intersect with the proposals (tested using the integral of the proposal map)
+            origins = CNN.prop.window_origins(img_height, img_width, window_dim, stride, prop_integral if proposals else None)
+            for x, y in origins:
 
                 # - add region to the region list
                 # - adjust the position of the ground_truth to be relative to the window
@@ -1595,7 +1505,6 @@ def detect_from_file(img_path, recognition_model_path, detection_model_path, img
                 #   hence, multiply the relative position with this scaling accordingly
                 # - also, the image needs to be preprocessed so it can be ready for the CNN
                 region = img[y:y + window_dim, x:x + window_dim]
-                region_shape = region.shape
                 region = skimage.transform.resize(region, output_shape=(img_dim, img_dim))
 
                 # pre-process the region if needed
@@ -1607,52 +1516,37 @@ def detect_from_file(img_path, recognition_model_path, detection_model_path, img
 
                 r_count += 1
 
-                # # # save region for experiemnt
-                # filePathWrite = "D:\\_Dataset\\GTSDB\\Test_Regions\\%s_%s.png" % ("{0:03d}".format(s_count), "{0:03d}".format(r_count))
-                # img_save = region * 255
-                # img_save = img_save.astype(int)
-                # cv2.imwrite(filePathWrite, img_save)
-
-                x_count += 1
-                x += stride
-                if region_shape[1] < window_dim:
-                    break
+            # append all the regions extracted from the current scale
+            # we'll only do detection after we collect all the regions
+            # from all the scales
+            scale_regions.append(regions)
+            scale_locations.append(locations)
 
-            y_count += 1
-            if region_shape[0] < window_dim:
-                break
-            y += stride
-
-        # append all the regions extracted from the current scale
-        # we'll only do detection after we collect all the regions
-        # from all the scales
-        scale_regions.append(regions)
-        scale_locations.append(locations)
-
-        print("Scale: %d, stride: %d, window_dim: %d, regions: %d" % (s_count, stride, window_dim, r_count))
+            print("Scale: %d, stride: %d, window_dim: %d, regions: %d" % (s_count, stride, window_dim, r_count))
 
-        # now we want to re_scale, instead of down_scaling the whole image, we down_scale the window
-        # don't forget to recalculate the window area
-        window_dim = int(window_dim * down_scale_factor)
+            # now we want to re_scale, instead of down_scaling the whole image, we down_scale the window
+            # don't forget to recalculate the window area
+            window_dim = int(window_dim * down_scale_factor)
 
-    # run the detector on the regions
-    start_time = time.clock()
+        # run the detector on the regions
+        start_time = time.clock()
 
-    # after we collected all the regions from all the scales, send them to be detected
-    scale_pred = __detect_from_scales_regions(recognition_model_path, detection_model_path, scale_regions)
+        # after we collected all the regions from all the scales, send them to be detected
+        scale_pred = __detect_from_scales_regions(recognition_model_path, detection_model_path, scale_regions)
 
-    end_time = time.clock()
-    duration = (end_time - start_time) / 60.0
-    scale_strong_regions = []
+        end_time = time.clock()
+        duration = (end_time - start_time) / 60.0
 
-    print("... detection regions: %d, duration(min.): %f" % (r_count, duration))
+        print("... detection regions: %d, duration(min.): %f" % (r_count, duration))
 
     # construct the probability map for each scale and show it/ save it
+    scale_strong_regions = []
     s_count = 0
+    heatmap = CNN.heatmap.HeatmapAccumulator(img_width, img_height)
     for pred, locations in zip(scale_pred, scale_locations):
         window_dim = scale_window_dim[s_count]
         s_count += 1
-        map, weak_regions, strong_regions = __probability_map(img, pred, locations, window_dim, img_width, img_height, img_dim, s_count)
+        map, weak_regions, strong_regions = __probability_map(img, pred, locations, window_dim, img_width, img_height, img_dim, s_count, heatmap=heatmap)
         if len(strong_regions) > 0:
             scale_strong_regions.append(strong_regions)
             print("Scale: %d, stride: %d, window_dim: %d, regions: %d, strong regions detected" % (s_count, stride, window_dim, r_count))
@@ -1779,6 +1673,9 @@ def detect_from_file_slow_1(img_path, recognition_model_path, detection_model_pa
     strong_regions = []
     scale_regions = []
 
+    # the probability map of all the scales
+    heatmap = CNN.heatmap.HeatmapAccumulator(img_width, img_height)
+
     # scale_down until you reach the min window
     # instead of scaling up the image itself, we scale down the sliding window
     while window_dim >= img_dim:
@@ -1908,7 +1805,7 @@ def detect_from_file_slow_1(img_path, recognition_model_path, detection_model_pa
         # after getting the predictions, construct the probability map and show it/ save it
         # since we're working on course-to-fine fashion, so for the next scale,
         # we'll only explore the regions detected in the current scale
-        map, weak_regions, strong_regions = __probability_map(img, pred, locations, window_dim, img_width, img_height, img_dim, s_count)
+        map, weak_regions, strong_regions = __probability_map(img, pred, locations, window_dim, img_width, img_height, img_dim, s_count, heatmap=heatmap)
         if len(strong_regions) > 0:
             scale_regions.append(strong_regions)
             print("Scale: %d, stride: %d, window_dim: %d, regions: %d, duration(min.): %f" % (s_count, stride, window_dim, r_count, duration))
@@ -2038,6 +1935,42 @@ def detect_from_file_slow_2(img_path, recognition_model_path, detection_model_pa
     x = 10
 
 
+def __detect_from_pyramid(image_pyramid, window_dims, recognition_model_path, detection_model_path, chunk_size=256):
+    """
+    Same as extracting the sliding windows of the given dims from the image then calling
+    __detect_from_scales_regions, but the windows are extracted from the given image pyramid
+    and passed to the detector in chunks of fixed size
+    :return: the predictions and the locations of the windows of each window dim
+    """
+
+    detector = CNN.cache.get_detector(recognition_model_path, detection_model_path, chunk_size)
+    img_dim = image_pyramid.img_dim
+
+    # the last chunk of each window dim is zero-padded
+    batch = numpy.zeros(shape=(chunk_size, 1, img_dim, img_dim), dtype="float32")
+    scale_pred = [[] for _ in window_dims]
+    scale_locations = [[] for _ in window_dims]
+    for i, windows, locations in image_pyramid.chunks(window_dims, chunk_size):
+        n_windows = len(windows)
+        batch[0:n_windows] = windows
+        batch[n_windows:] = 0
+        scale_pred[i].append(detector.predict(batch)[0:n_windows])
+        scale_locations[i].append(locations)
+
+    for i in range(len(window_dims)):
+        pred = numpy.concatenate(scale_pred[i], axis=0)
+
+        # scale-back the the predicted values to it's original scale
+        pred = numpy.rint(((pred * img_dim) + img_dim) / 2).astype(int)
+        pred[pred > img_dim - 1] = img_dim - 1
+        pred[pred < 0] = 0
+
+        scale_pred[i] = pred
+        scale_locations[i] = numpy.concatenate(scale_locations[i], axis=0).tolist()
+
+    return scale_pred, scale_locations
+
+
 def __detect_from_scales_regions(recognition_model_path, detection_model_path, scale_regions, regression=True):
     # stack the regions of all the scales in one array
     # please note that a scale can have no regions, so using vstack wouldn't work
@@ -2056,55 +1989,9 @@ def __detect_from_scales_regions(recognition_model_path, detection_model_path, s
     # Build the detector         #
     ##############################
 
-    loaded_objects = CNN.utils.load_model(model_path=recognition_model_path, model_type=CNN.enums.ModelType._02_conv3_mlp2)
-    img_dim = loaded_objects[1]
-    kernel_dim = loaded_objects[2]
-    nkerns = loaded_objects[3]
-    pool_size = loaded_objects[5]
-
-    layer0_W = theano.shared(loaded_objects[6], borrow=True)
-    layer0_b = theano.shared(loaded_objects[7], borrow=True)
-    layer1_W = theano.shared(loaded_objects[8], borrow=True)
-    layer1_b = theano.shared(loaded_objects[9], borrow=True)
-    layer2_W = theano.shared(loaded_objects[10], borrow=True)
-    layer2_b = theano.shared(loaded_objects[11], borrow=True)
-
-    layer0_input = T.tensor4(name='input')
-    layer0_img_dim = img_dim
-    layer0_img_shape = (batch_size, 1, layer0_img_dim, layer0_img_dim)
-    layer0_kernel_dim = kernel_dim[0]
-    layer1_img_dim = int((layer0_img_dim - layer0_kernel_dim + 1) / 2)
-    layer1_kernel_dim = kernel_dim[1]
-    layer2_img_dim = int((layer1_img_dim - layer1_kernel_dim + 1) / 2)
-    layer2_kernel_dim = kernel_dim[2]
-    layer3_img_dim = int((layer2_img_dim - layer2_kernel_dim + 1) / 2)
-    layer3_input_shape = (batch_size, nkerns[2] * layer3_img_dim * layer3_img_dim)
-
-    # layer 0, 1, 2: Conv-Pool
-    layer0_output = CNN.conv.convpool_layer(
-        input=layer0_input, W=layer0_W, b=layer0_b,
-        image_shape=(batch_size, 1, layer0_img_dim, layer0_img_dim),
-        filter_shape=(nkerns[0], 1, layer0_kernel_dim, layer0_kernel_dim),
-        pool_size=pool_size
-    )
-    layer1_output = CNN.conv.convpool_layer(
-        input=layer0_output, W=layer1_W, b=layer1_b,
-        image_shape=(batch_size, nkerns[0], layer1_img_dim, layer1_img_dim),
-        filter_shape=(nkerns[1], nkerns[0], layer1_kernel_dim, layer1_kernel_dim),
-        pool_size=pool_size
-    )
-    layer2_output = CNN.conv.convpool_layer(
-        input=layer1_output, W=layer2_W, b=layer2_b,
-        image_shape=(batch_size, nkerns[1], layer2_img_dim, layer2_img_dim),
-        filter_shape=(nkerns[2], nkerns[1], layer2_kernel_dim, layer2_kernel_dim),
-        pool_size=pool_size
-    )
-    # do the filtering using 3 layers of Conv+Pool
-    conv_fn = theano.function([layer0_input], layer2_output)
-
-    # load the regression model
-    with open(detection_model_path, 'rb') as f:
-        nn_regression = pickle.load(f)
+    # the detector is compiled only once per model and batch size, then kept in the cache
+    detector = CNN.cache.get_detector(recognition_model_path, detection_model_path, batch_size)
+    img_dim = detector.img_dim
 
     ##############################
     # Start detection            #
@@ -2112,10 +1999,7 @@ def __detect_from_scales_regions(recognition_model_path, detection_model_path, s
 
     t1 = time.clock()
     # prediction: CNN filtering then MLP regression
-    batch = regions.reshape(layer0_img_shape)
-    filters = conv_fn(batch)
-    filters = filters.reshape(layer3_input_shape).astype("float32")
-    pred = nn_regression.predict(filters)
+    pred = detector.predict(regions)
     t2 = time.clock()
     print("... prediction time(sec.): %f" % (t2 - t1))
 
@@ -2152,63 +2036,14 @@ def __detect_batch(batch, recognition_model_path, detection_model_path, model_ty
 
 
 def __detect_batch_deep_model(batch, recognition_model_path, detection_model_path, classifier=CNN.enums.ClassifierType.logit):
-    loaded_objects = CNN.utils.load_model(model_path=recognition_model_path, model_type=CNN.enums.ModelType._02_conv3_mlp2)
-
-    img_dim = loaded_objects[1]
-    kernel_dim = loaded_objects[2]
-    nkerns = loaded_objects[3]
-    pool_size = loaded_objects[5]
     batch_size = batch.shape[0]
-
-    layer0_W = theano.shared(loaded_objects[6], borrow=True)
-    layer0_b = theano.shared(loaded_objects[7], borrow=True)
-    layer1_W = theano.shared(loaded_objects[8], borrow=True)
-    layer1_b = theano.shared(loaded_objects[9], borrow=True)
-    layer2_W = theano.shared(loaded_objects[10], borrow=True)
-    layer2_b = theano.shared(loaded_objects[11], borrow=True)
-
-    layer0_input = T.tensor4(name='input')
-    layer0_img_dim = img_dim
-    layer0_img_shape = (batch_size, 1, layer0_img_dim, layer0_img_dim)
-    layer0_kernel_dim = kernel_dim[0]
-    layer1_img_dim = int((layer0_img_dim - layer0_kernel_dim + 1) / 2)
-    layer1_kernel_dim = kernel_dim[1]
-    layer2_img_dim = int((layer1_img_dim - layer1_kernel_dim + 1) / 2)
-    layer2_kernel_dim = kernel_dim[2]
-    layer3_img_dim = int((layer2_img_dim - layer2_kernel_dim + 1) / 2)
-    layer3_input_shape = (batch_size, nkerns[2] * layer3_img_dim * layer3_img_dim)
-
-    # layer 0, 1, 2: Conv-Pool
-    layer0_output = CNN.conv.convpool_layer(
-        input=layer0_input, W=layer0_W, b=layer0_b,
-        image_shape=(batch_size, 1, layer0_img_dim, layer0_img_dim),
-        filter_shape=(nkerns[0], 1, layer0_kernel_dim, layer0_kernel_dim),
-        pool_size=pool_size
-    )
-    layer1_output = CNN.conv.convpool_layer(
-        input=layer0_output, W=layer1_W, b=layer1_b,
-        image_shape=(batch_size, nkerns[0], layer1_img_dim, layer1_img_dim),
-        filter_shape=(nkerns[1], nkerns[0], layer1_kernel_dim, layer1_kernel_dim),
-        pool_size=pool_size
-    )
-    layer2_output = CNN.conv.convpool_layer(
-        input=layer1_output, W=layer2_W, b=layer2_b,
-        image_shape=(batch_size, nkerns[1], layer2_img_dim, layer2_img_dim),
-        filter_shape=(nkerns[2], nkerns[1], layer2_kernel_dim, layer2_kernel_dim),
-        pool_size=pool_size
-    )
-    # do the filtering using 3 layers of Conv+Pool
-    conv_fn = theano.function([layer0_input], layer2_output)
-    with open(detection_model_path, 'rb') as f:
-        nn_regression = pickle.load(f)
+    detector = CNN.cache.get_detector(recognition_model_path, detection_model_path, batch_size)
+    img_dim = detector.img_dim
 
     start_time = time.clock()
 
     # prediction
-    batch = batch.reshape(layer0_img_shape)
-    filters = conv_fn(batch)
-    filters = filters.reshape(layer3_input_shape).astype("float32")
-    d_pred = nn_regression.predict(filters)
+    d_pred = detector.predict(batch)
 
     # scale-back the the predicted values to it's original scale
     d_pred = numpy.rint(((d_pred * img_dim) + img_dim) / 2).astype(int)
@@ -2396,116 +2231,84 @@ def __detect_img_deep_model(img4D, model_path, classifier=CNN.enums.ClassifierTy
 
 
 def __probability_map(img, predictions, locations, window_dim, img_width, img_height, img_dim, count, regression=True, **kwargs):
+    """
+    Regions detected at the given scale, they are suppressed then added to the heatmap
+    of the frame, shared by all the scales (if given in kwargs, else a new one is created)
+    :return: the heatmap (CNN.heatmap.HeatmapAccumulator), weak and strong regions
+    """
+
     # parameters of the algorithm
     min_dim = img_dim / 2
     overlap_thresh = 0.4
     min_overlap = 5
+    save_img = CNN.sink.enabled()
+    heatmap = None
 
     if 'overlap_thresh' in kwargs:
         overlap_thresh = kwargs['overlap_thresh']
     if 'min_overlap' in kwargs:
         min_overlap = kwargs['min_overlap']
+    if 'save_img' in kwargs:
+        save_img = kwargs['save_img']
+    if 'heatmap' in kwargs:
+        heatmap = kwargs['heatmap']
+    if heatmap is None:
+        heatmap = CNN.heatmap.HeatmapAccumulator(img_width, img_height)
 
     r_factor = window_dim / img_dim
-    locations = numpy.asarray(locations)
+    locations = numpy.asarray(locations).reshape((-1, 2))
     predictions = numpy.asarray(predictions)
-    n = predictions.shape[0]
-
-    # create an image
-    map = numpy.zeros(shape=(img_height, img_width))
-    new_regions = []
-    for i in range(0, n):
-
-        # in case of regression, mark only the predicted region
-        # else, mark the whole sliding window
-        if regression:
-            x1 = predictions[i, 0]
-            x2 = predictions[i, 2]
-            y2 = predictions[i, 3]
-            y1 = predictions[i, 1]
-            if (x2 - x1) < min_dim or (y2 - y1) < min_dim:
-                continue
-            new_region = numpy.rint(predictions[i] * r_factor)
-        else:
-            if predictions[i]:
-                new_region = [0, 0, window_dim, window_dim]
-            else:
-                continue
 
-        location = locations[i]
-        x1 = int(new_region[0] + location[0])
-        y1 = int(new_region[1] + location[1])
-        x2 = int(new_region[2] + location[0])
-        y2 = int(new_region[3] + location[1])
-        new_regions.append([x1, y1, x2, y2])
-        map[y1:y2, x1:x2] += 1
+    # in case of regression, mark only the predicted region
+    # else, mark the whole sliding window
+    if regression:
+        predictions = predictions.reshape((-1, 4))
+        idx = numpy.where(numpy.logical_and(predictions[:, 2] - predictions[:, 0] >= min_dim, predictions[:, 3] - predictions[:, 1] >= min_dim))[0]
+        new_regions = numpy.rint(predictions[idx] * r_factor)
+    else:
+        idx = numpy.where(predictions.reshape((-1,)).astype(bool))[0]
+        new_regions = numpy.tile([0, 0, window_dim, window_dim], (len(idx), 1))
 
     # check if no region found
-    if len(new_regions) == 0:
+    if len(idx) == 0:
         map = []
         weak_regions = []
         strong_regions = []
         return map, weak_regions, strong_regions
 
-    # suppress the new regions and raw them with red color
-    weak_regions, strong_regions = CNN.nms.suppression(new_regions, overlap_thresh, min_overlap)
-
-    # normalize image before drawing
-    map = map * 255 / (map.max() - map.min())
-    img_normalized = img * 255
-
-    # we also may want to blend the image and the probability map
-    blend_value = 0.25
-    map_blend = cv2.addWeighted(img_normalized, blend_value, map, 1 - blend_value, 0.0)
-    map_blend = map_blend.astype(int)
+    new_regions = (new_regions + numpy.tile(locations[idx], (1, 2))).astype(int)
+    heatmap.add(new_regions)
 
-    # convert to RGB before drawing colored boxes
-    map_color = numpy.zeros(shape=(img_height, img_width, 3))
-    for i in range(3):
-        map_color[:, :, i] = map_blend
-
-    red_color = (0, 0, 255)
-    yellow_color = (84, 212, 255)
-    blue_color = (255, 0, 0)
-    for loc in weak_regions:
-        cv2.rectangle(map_color, (loc[0], loc[1]), (loc[2], loc[3]), yellow_color, 1)
-    for loc in strong_regions:
-        cv2.rectangle(map_color, (loc[0], loc[1]), (loc[2], loc[3]), red_color, 2)
+    # suppress the new regions and raw them with red color
+    weak_regions, strong_regions = CNN.nms.suppression(new_regions, overlap_thresh, min_overlap, index="auto")
 
-    cv2.imwrite("D:\\_Dataset\\GTSDB\\Test_Regions\\" + "{0:05d}.png".format(count), map_color)
+    # the image of the map is only built if it's saved
+    if save_img:
+        map_color = heatmap.render(img, weak_regions, strong_regions)
+        CNN.sink.save("{0:05d}.png".format(count), map_color)
 
     # return the map to be exploited later by the detector, for the next scale
-    return map, weak_regions, strong_regions
+    return heatmap, weak_regions, strong_regions
 
 
 def __confidence_map(img, img_width, img_height, scale_regions, scale_count, **kwargs):
     overlap_thresh = 0.5
     min_overlap = 3
-    save_img = True
+    save_img = CNN.sink.enabled()
 
     if 'overlap_thresh' in kwargs:
         overlap_thresh = kwargs['overlap_thresh']
     if 'min_overlap' in kwargs:
         min_overlap = kwargs['min_overlap']
+    if 'save_img' in kwargs:
+        save_img = kwargs['save_img']
 
-    weak_regions, strong_regions = CNN.nms.suppression(scale_regions, overlap_thresh, min_overlap)
-
-    # normalize the image
-    img_normalized = img * 255
-
-    # convert to RGB before drawing colored boxes
-    map_color = numpy.zeros(shape=(img_height, img_width, 3))
-    for i in range(3):
-        map_color[:, :, i] = img_normalized
-
-    red_color = (0, 0, 255)
-    yellow_color = (84, 212, 255)
-    blue_color = (255, 0, 0)
-    for loc in weak_regions:
-        cv2.rectangle(map_color, (loc[0], loc[1]), (loc[2], loc[3]), yellow_color, 1)
-    for loc in strong_regions:
-        cv2.rectangle(map_color, (loc[0], loc[1]), (loc[2], loc[3]), red_color, 2)
+    weak_regions, strong_regions = CNN.nms.suppression(scale_regions, overlap_thresh, min_overlap, index="auto")
 
-    cv2.imwrite("D:\\_Dataset\\GTSDB\\Test_Regions\\" + "{0:05d}.png".format(scale_count + 1), map_color)
+    # draw the regions on the image, no need for the map
+    if save_img:
+        heatmap = CNN.heatmap.HeatmapAccumulator(img_width, img_height)
+        map_color = heatmap.render(img, weak_regions, strong_regions, blend_value=1.0)
+        CNN.sink.save("{0:05d}.png".format(scale_count + 1), map_color)
 
 # endregion
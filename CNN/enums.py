@@ -19,3 +19,13 @@ class ModelType(enum.Enum):
     _01_conv2_mlp2 = 1
     _02_conv3_mlp2 = 2
     _03_conv3_mlp3 = 3
+
+
+class BackendType(enum.Enum):
+    theano = 1
+    numpy = 2
+
+
+class ProposalType(enum.Enum):
+    hough = 1
+    color = 2
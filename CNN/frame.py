@@ -0,0 +1,46 @@
+import numpy
+
+import cv2
+
+import CNN
+import CNN.prop
+import CNN.region
+
+
+class FrameContext(CNN.prop.ProposalContext):
+    """
+    All the versions of a frame (natural image) needed by the stages of processing it: the color
+    image, the gray-scale image (uint8 and float32), the pre-processed images of the detection proposals
+    (see CNN.prop.ProposalContext) and the levels of the image pyramid. Each is computed once, when first
+    needed, then shared by the proposals, the detectors and the superclass classifier of the frame.
+    """
+
+    def __init__(self, img_color):
+        CNN.prop.ProposalContext.__init__(self, img_color)
+        self.__img_gray = None
+        self.__img_gray_float = None
+        self.__pyramids = {}
+
+    @property
+    def img_gray(self):
+        if self.__img_gray is None:
+            self.__img_gray = cv2.cvtColor(self.img_color, cv2.COLOR_BGR2GRAY)
+        return self.__img_gray
+
+    @property
+    def img_gray_float(self):
+        """
+        gray-scale image in the range [0, 1]
+        """
+        if self.__img_gray_float is None:
+            self.__img_gray_float = self.img_gray.astype(numpy.float32) / 255.0
+        return self.__img_gray_float
+
+    def image_pyramid(self, img_dim=80, stride_factor=0.1, equalize=True):
+        """
+        The image pyramid of the gray-scale image, it's levels are built when first needed
+        """
+        key = (img_dim, stride_factor, equalize)
+        if key not in self.__pyramids:
+            self.__pyramids[key] = CNN.region.ImagePyramid(self.img_gray_float, img_dim, stride_factor, equalize)
+        return self.__pyramids[key]
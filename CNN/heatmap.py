@@ -0,0 +1,142 @@
+import time
+import numpy
+
+import cv2
+
+
+class HeatmapAccumulator(object):
+    """
+    Probability map of the detected regions of a frame, shared by all the scales of the detection.
+    The map is kept at a reduced resolution (one cell for each cell_dim x cell_dim pixels) as a
+    difference array, so adding the regions of a scale is a few vectorized updates (np.add.at) at
+    their corners, whatever their size, and the memory doesn't grow with the number of scales.
+    The map itself (cumulative sum of the difference array) and it's image are only computed
+    when needed, for example for visualization.
+    """
+
+    def __init__(self, img_width, img_height, cell_dim=4, dtype="float32"):
+        self.img_width = img_width
+        self.img_height = img_height
+        self.cell_dim = cell_dim
+        self.map_width = int(numpy.ceil(img_width / cell_dim))
+        self.map_height = int(numpy.ceil(img_height / cell_dim))
+        self.n_regions = 0
+        self.__diff = numpy.zeros(shape=(self.map_height + 1, self.map_width + 1), dtype=dtype)
+
+    def add(self, regions, weights=None):
+        """
+        Add the given regions to the map, each region adds it's weight to the cells it covers
+        :param regions: array of shape (n, 4), each is x1, y1, x2, y2 in pixels of the image
+        :param weights: the weight of each region, for example it's score, None for a weight of 1
+        :return:
+        """
+
+        regions = numpy.asarray(regions).reshape((-1, 4))
+        if len(regions) == 0:
+            return
+
+        if weights is None:
+            weights = numpy.ones(len(regions), dtype=self.__diff.dtype)
+        else:
+            weights = numpy.asarray(weights, dtype=self.__diff.dtype).reshape((len(regions),))
+
+        # the cells covered by each region, the right/bottom side is exclusive
+        # same as map[y1:y2, x1:x2] += 1, the regions are clipped to the image
+        x1 = numpy.clip(regions[:, 0] // self.cell_dim, 0, self.map_width).astype(int)
+        y1 = numpy.clip(regions[:, 1] // self.cell_dim, 0, self.map_height).astype(int)
+        x2 = numpy.clip(-(-regions[:, 2] // self.cell_dim), 0, self.map_width).astype(int)
+        y2 = numpy.clip(-(-regions[:, 3] // self.cell_dim), 0, self.map_height).astype(int)
+
+        numpy.add.at(self.__diff, (y1, x1), weights)
+        numpy.add.at(self.__diff, (y1, x2), -weights)
+        numpy.add.at(self.__diff, (y2, x1), -weights)
+        numpy.add.at(self.__diff, (y2, x2), weights)
+        self.n_regions += len(regions)
+
+    def map(self, full_size=False):
+        """
+        :param full_size: resize the map to the size of the image
+        :return: the map, at the reduced resolution unless full_size
+        """
+        map = numpy.cumsum(numpy.cumsum(self.__diff, axis=0), axis=1)[0:self.map_height, 0:self.map_width]
+        if full_size:
+            map = cv2.resize(map, (self.map_width * self.cell_dim, self.map_height * self.cell_dim), interpolation=cv2.INTER_NEAREST)
+            map = map[0:self.img_height, 0:self.img_width]
+        return map
+
+    def render(self, img, weak_regions=(), strong_regions=(), blend_value=0.25):
+        """
+        Image of the map blended with the given image, with the weak/strong regions drawn on it
+        :param img: gray-scale image of the frame in the range [0, 1]
+        :param blend_value: weight of the image in the blending, 1.0 to draw only on the image
+        :return: color image of type uint8
+        """
+
+        img_normalized = (img * 255).astype(numpy.float32)
+
+        # normalize the map before blending
+        if self.n_regions > 0 and blend_value < 1.0:
+            map = self.map(full_size=True)
+            map_range = map.max() - map.min()
+            if map_range > 0:
+                map = map * 255 / map_range
+            map_blend = cv2.addWeighted(img_normalized, blend_value, map.astype(numpy.float32), 1 - blend_value, 0.0)
+        else:
+            map_blend = img_normalized
+
+        # convert to RGB before drawing colored boxes
+        map_color = cv2.cvtColor(numpy.clip(map_blend, 0, 255).astype(numpy.uint8), cv2.COLOR_GRAY2BGR)
+
+        red_color = (0, 0, 255)
+        yellow_color = (84, 212, 255)
+        for loc in weak_regions:
+            cv2.rectangle(map_color, (int(loc[0]), int(loc[1])), (int(loc[2]), int(loc[3])), yellow_color, 1)
+        for loc in strong_regions:
+            cv2.rectangle(map_color, (int(loc[0]), int(loc[1])), (int(loc[2]), int(loc[3])), red_color, 2)
+
+        return map_color
+
+    def reset(self):
+        self.__diff[:] = 0
+        self.n_regions = 0
+
+
+def check_heatmap(img_width=1360, img_height=800, n_scales=18, n_regions=2000, cell_dim=4):
+    """
+    Accumulate random regions of many scales using HeatmapAccumulator and using a full-frame map
+    per scale (as the old CNN.detec.__probability_map), print the time of each and the max difference
+    between the accumulator and the full-frame map of the regions snapped to it's cells
+    """
+
+    rng = numpy.random.RandomState(1234)
+    scale_regions = []
+    for i in range(n_scales):
+        dims = rng.randint(low=20, high=160, size=n_regions)
+        xs = rng.randint(low=0, high=img_width - 160, size=n_regions)
+        ys = rng.randint(low=0, high=img_height - 160, size=n_regions)
+        scale_regions.append(numpy.transpose(numpy.asarray([xs, ys, xs + dims, ys + dims])))
+
+    t1 = time.clock()
+    map_full = numpy.zeros(shape=(img_height, img_width))
+    for regions in scale_regions:
+        map = numpy.zeros(shape=(img_height, img_width))
+        for x1, y1, x2, y2 in regions:
+            map[y1:y2, x1:x2] += 1
+        map_full += map
+    t2 = time.clock()
+    heatmap = HeatmapAccumulator(img_width, img_height, cell_dim=cell_dim)
+    for regions in scale_regions:
+        heatmap.add(regions)
+    map_accum = heatmap.map()
+    t3 = time.clock()
+
+    # the accumulator is the same as a full-frame map of the regions snapped outward to the cells
+    map_snapped = numpy.zeros(shape=(heatmap.map_height * cell_dim, heatmap.map_width * cell_dim))
+    for regions in scale_regions:
+        for x1, y1, x2, y2 in regions:
+            map_snapped[(y1 // cell_dim) * cell_dim:-(-y2 // cell_dim) * cell_dim, (x1 // cell_dim) * cell_dim:-(-x2 // cell_dim) * cell_dim] += 1
+    map_reduced = map_snapped[::cell_dim, ::cell_dim]
+
+    map_diff = numpy.max(numpy.abs(map_reduced - map_accum))
+    print("... max difference: %f, max of map: %f, time(sec.) full-frame maps: %f, accumulator: %f" % (map_diff, map_full.max(), t2 - t1, t3 - t2))
+    return map_diff
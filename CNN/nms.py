@@ -1,4 +1,5 @@
 # import the necessary packages
+import time
 import numpy as np
 
 # Malisiewicz et al.
@@ -71,7 +72,8 @@ def __tutorial(boxes, overlap_thresh, min_overlap):
 
 
 # Malisiewicz et al. with mean-suppression
-def suppression(boxes, overlap_thresh, min_overlap):
+# the original implementation, kept as a reference for suppression, see check_suppression
+def suppression_slow(boxes, overlap_thresh, min_overlap):
     # if there are no boxes, return an empty list
     if len(boxes) == 0:
         return [], []
@@ -159,3 +161,453 @@ def suppression(boxes, overlap_thresh, min_overlap):
 
     # return only the bounding boxes that were picked using the integer data type
     return np.asarray(pick, dtype=int), np.asarray(strong_pick, dtype=int)
+
+
+# Malisiewicz et al. with mean-suppression, the same as suppression_slow
+# but without deleting from the indexes in each iteration
+# in case of index "auto", the grid is used from this number of boxes, below it
+# the grid is slower than the blocks (see benchmark_suppression)
+__GRID_MIN_BOXES = 8000
+
+
+def suppression(boxes, overlap_thresh, min_overlap, block_size=16, index=None):
+    """
+    The boxes are sorted by their area, the biggest box that is not suppressed yet suppresses
+    the smaller boxes it overlaps with, and their mean box is picked. The overlap is computed
+    for a block of the biggest remaining boxes with all the remaining boxes at once, then the
+    suppressed boxes are marked in a mask instead of deleting them from the indexes.
+    :param boxes: array of shape (n, 4), each is x1, y1, x2, y2
+    :param overlap_thresh: a box is suppressed if this ratio of it's area is overlapped
+    :param min_overlap: the mean box is strong if at least this number of boxes are suppressed (including it's base box)
+    :param block_size: number of boxes to compute their overlap at once
+    :param index: None, "grid" or "auto", in case of grid, each box is compared only with it's neighbours
+    in a uniform grid, which is faster for tens of thousands of boxes, see __suppression_grid,
+    in case of auto, the grid is used only if there are enough boxes for it to be faster
+    :return: weak and strong boxes
+    """
+
+    # if there are no boxes, return an empty list
+    if len(boxes) == 0:
+        return [], []
+
+    # cast as numpy if needed
+    if isinstance(boxes, list):
+        boxes = np.asarray(boxes)
+
+    # if the bounding boxes integers, convert them to floats --
+    # this is important since we'll be doing a bunch of divisions
+    if boxes.dtype.kind == "i" or boxes.dtype.kind == "u":
+        boxes = boxes.astype("float")
+
+    if index == "auto":
+        index = "grid" if len(boxes) >= __GRID_MIN_BOXES else None
+
+    if index == "grid":
+        return __suppression_grid(boxes, overlap_thresh, min_overlap)
+    elif index is not None:
+        raise Exception("Sorry, unknown index for suppression: %s" % (index,))
+
+    pick = []
+    strong_pick = []
+
+    # sort according to the area, so that the bigger box eat the smaller ones
+    # the boxes are re-arranged in this order, so the index of a box is it's rank
+    area = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    idxs = np.argsort(area)
+    boxes = boxes[idxs]
+    area = area[idxs]
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    alive = np.ones(len(boxes), dtype=bool)
+    while True:
+        # the boxes that are not suppressed yet, the block is the biggest of them
+        remaining = np.where(alive)[0]
+        if len(remaining) == 0:
+            break
+        block = remaining[-block_size:]
+
+        # overlap of the boxes of the block with all the remaining boxes, of shape (block, remaining)
+        w = np.maximum(0, 1 + np.minimum(x2[block, None], x2[None, remaining]) - np.maximum(x1[block, None], x1[None, remaining]))
+        h = np.maximum(0, 1 + np.minimum(y2[block, None], y2[None, remaining]) - np.maximum(y1[block, None], y1[None, remaining]))
+        overlap = (w * h) / area[None, remaining]
+
+        # only the boxes that overlap enough with any box of the block can be suppressed by it
+        candidates = np.where(np.any(overlap > overlap_thresh, axis=0))[0]
+        overlap = overlap[:, candidates] > overlap_thresh
+        candidates = remaining[candidates]
+
+        for b in range(len(block) - 1, -1, -1):
+            i = block[b]
+            if not alive[i]:
+                continue
+
+            # the smaller boxes that are not suppressed yet and overlap with the current box
+            # the candidates are sorted by their area, same as the indexes of suppression_slow
+            suppressed = candidates[np.logical_and(np.logical_and(candidates < i, alive[candidates]), overlap[b])]
+            deleted_i = np.concatenate(([i], suppressed))
+
+            # instead of picking up the base box of the suppressed boxes
+            # we might want instead to pick up their means
+            mean_box = np.mean(boxes[deleted_i], axis=0)
+
+            # for if we have many neighbours, then it's strong suppression
+            # else, it's week one
+            if deleted_i.shape[0] >= min_overlap:
+                strong_pick.append(mean_box)
+            else:
+                pick.append(mean_box)
+
+            alive[deleted_i] = False
+
+    # return only the bounding boxes that were picked using the integer data type
+    return np.asarray(pick, dtype=int), np.asarray(strong_pick, dtype=int)
+
+
+def __suppression_grid(boxes, overlap_thresh, min_overlap):
+    """
+    Same as suppression, but the boxes are bucketed in a uniform grid by their top-left corner.
+    The cell is as big as the biggest box, so a box can only overlap with the boxes of it's cell
+    and of the 8 cells around it. The cells are stored row by row (as in a CSR matrix), so the
+    neighbour cells in each row of the grid are one slice.
+    :return: weak and strong boxes
+    """
+
+    pick = []
+    strong_pick = []
+
+    # sort according to the area, so that the bigger box eat the smaller ones
+    area = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    idxs = np.argsort(area)
+    boxes = boxes[idxs]
+    area = area[idxs]
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    # the cell of each box, the grid starts at the top-left corner of all the boxes
+    cell_w = max(np.max(x2 - x1 + 1), 1)
+    cell_h = max(np.max(y2 - y1 + 1), 1)
+    x_min = np.min(x1)
+    y_min = np.min(y1)
+    cx1 = ((x1 - x_min) // cell_w).astype(np.int64) + 1
+    cy1 = ((y1 - y_min) // cell_h).astype(np.int64)
+    n_cols = int(np.max(cx1)) + 3
+    cells = cy1 * n_cols + cx1
+
+    # the boxes ordered by their cell, then by their rank (stable sort)
+    cell_boxes = np.argsort(cells, kind="stable")
+    cell_ids = cells[cell_boxes]
+
+    # the neighbours of a box are in the cells (cx1 - 1 -> cx1 + 1) of each row (cy1 - 1 -> cy1 + 1),
+    # the column is shifted by one so cx1 - 1 is never negative, and the row -1 is just empty
+    # the start/end of the neighbours in cell_boxes for each box and each row, of shape (n, 3)
+    rows = cy1[:, None] + np.arange(-1, 2)[None, :]
+    starts = np.searchsorted(cell_ids, rows * n_cols + cx1[:, None] - 1)
+    ends = np.searchsorted(cell_ids, rows * n_cols + cx1[:, None] + 2)
+
+    alive = np.ones(len(boxes), dtype=bool)
+    for i in range(len(boxes) - 1, -1, -1):
+        if not alive[i]:
+            continue
+
+        # the boxes of the neighbour cells, one slice per row of the grid
+        start = starts[i]
+        end = ends[i]
+        neighbours = np.concatenate((cell_boxes[start[0]:end[0]], cell_boxes[start[1]:end[1]], cell_boxes[start[2]:end[2]]))
+
+        # the smaller boxes that are not suppressed yet, sorted by their rank as in suppression
+        neighbours = np.sort(neighbours[np.logical_and(neighbours < i, alive[neighbours])])
+
+        w = np.maximum(0, 1 + np.minimum(x2[i], x2[neighbours]) - np.maximum(x1[i], x1[neighbours]))
+        h = np.maximum(0, 1 + np.minimum(y2[i], y2[neighbours]) - np.maximum(y1[i], y1[neighbours]))
+        overlap = (w * h) / area[neighbours]
+
+        deleted_i = np.concatenate(([i], neighbours[overlap > overlap_thresh]))
+
+        # pick up the mean of the suppressed boxes
+        # if we have many neighbours, then it's strong suppression, else, it's week one
+        mean_box = np.mean(boxes[deleted_i], axis=0)
+        if deleted_i.shape[0] >= min_overlap:
+            strong_pick.append(mean_box)
+        else:
+            pick.append(mean_box)
+
+        alive[deleted_i] = False
+
+    # return only the bounding boxes that were picked using the integer data type
+    return np.asarray(pick, dtype=int), np.asarray(strong_pick, dtype=int)
+
+
+def score_suppression(boxes, scores, overlap_thresh, min_overlap, weighted=True, max_detections=None):
+    """
+    Suppression driven by the confidence of the detector instead of the area of the boxes.
+    The boxes are processed in the order of their scores, the best box that is not suppressed
+    yet suppresses the boxes with lower scores it overlaps with, and their mean box is picked.
+    Each box is compared only with the boxes that overlap with it horizontally (sort and sweep).
+    :param boxes: array of shape (n, 4), each is x1, y1, x2, y2
+    :param scores: the score of each box, for example the sigmoid output of the detector
+    :param overlap_thresh: a box is suppressed if this ratio of it's area is overlapped
+    :param min_overlap: the mean box is strong if at least this number of boxes are suppressed (including it's base box)
+    :param weighted: the mean box is weighted by the scores of the suppressed boxes
+    :param max_detections: stop once this number of strong boxes are picked, None for no limit
+    :return: weak and strong boxes, sorted descending by their scores, and the scores of each
+    """
+
+    # if there are no boxes, return an empty list
+    if len(boxes) == 0:
+        return [], [], [], []
+
+    # cast as numpy if needed
+    boxes = np.asarray(boxes, dtype="float")
+    scores = np.asarray(scores, dtype="float").reshape((len(boxes),))
+
+    pick = []
+    strong_pick = []
+    pick_scores = []
+    strong_pick_scores = []
+
+    # sort according to the score, the best box comes first, in case of equal
+    # scores, the bigger box comes first as in suppression
+    area = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    idxs = np.lexsort((-area, -scores))
+    boxes = boxes[idxs]
+    scores = scores[idxs]
+    area = area[idxs]
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    # sort and sweep, a box can only overlap with the boxes that start in the range (x1 - max width -> x2)
+    # so the boxes are sorted by their x1, and the start/end of this range is found for each box
+    x_order = np.argsort(x1, kind="stable")
+    x1_sorted = x1[x_order]
+    max_w = np.max(x2 - x1)
+    x_starts = np.searchsorted(x1_sorted, x1 - max_w, side="left")
+    x_ends = np.searchsorted(x1_sorted, x2, side="right")
+
+    alive = np.ones(len(boxes), dtype=bool)
+    for i in range(len(boxes)):
+        if not alive[i]:
+            continue
+
+        # the boxes with lower scores that are not suppressed yet, in the order of their scores
+        others = x_order[x_starts[i]:x_ends[i]]
+        others = np.sort(others[np.logical_and(others > i, alive[others])])
+
+        w = np.maximum(0, 1 + np.minimum(x2[i], x2[others]) - np.maximum(x1[i], x1[others]))
+        h = np.maximum(0, 1 + np.minimum(y2[i], y2[others]) - np.maximum(y1[i], y1[others]))
+        overlap = (w * h) / area[others]
+
+        deleted_i = np.concatenate(([i], others[overlap > overlap_thresh]))
+        alive[deleted_i] = False
+
+        # the mean box is weighted by the scores, and it's score is the score of it's best box
+        weights = scores[deleted_i] if weighted else None
+        mean_box = np.average(boxes[deleted_i], axis=0, weights=weights)
+        if deleted_i.shape[0] >= min_overlap:
+            strong_pick.append(mean_box)
+            strong_pick_scores.append(scores[i])
+        else:
+            pick.append(mean_box)
+            pick_scores.append(scores[i])
+
+        # the rest of the boxes have lower scores, no need to process them
+        if max_detections is not None and len(strong_pick) >= max_detections:
+            break
+
+    # return only the bounding boxes that were picked using the integer data type
+    return np.asarray(pick, dtype=int), np.asarray(strong_pick, dtype=int), np.asarray(pick_scores), np.asarray(strong_pick_scores)
+
+
+def batched_suppression(boxes, group_ids, overlap_thresh, min_overlap, scores=None, cross_overlap_thresh=None, cross_min_overlap=0, max_detections=None, index=None):
+    """
+    Suppress the boxes of many groups (scales, detectors, images) in one call instead of one call per group.
+    The boxes of each group are shifted horizontally, each group after the other, so boxes of different
+    groups never overlap, then they are suppressed at once and shifted back. Optionally, the strong boxes
+    of all the groups are suppressed again together (cross-group), for example to merge the detectors.
+    :param boxes: array of shape (n, 4), each is x1, y1, x2, y2
+    :param group_ids: the group of each box
+    :param overlap_thresh: overlap_thresh of the suppression within each group
+    :param min_overlap: min_overlap of the suppression within each group
+    :param scores: the score of each box, if given, score_suppression is used instead of suppression
+    :param cross_overlap_thresh: overlap_thresh of the cross-group suppression, None for no cross-group suppression
+    :param cross_min_overlap: min_overlap of the cross-group suppression
+    :param max_detections: in case of scores, the max number of strong boxes, of the cross-group suppression
+    if any, else of all the groups together (the ones of highest score)
+    :param index: index of the suppression, in case of no scores
+    :return: weak and strong boxes, and their scores in case of scores
+    """
+
+    # if there are no boxes, return an empty list
+    if len(boxes) == 0:
+        return ([], [], [], []) if scores is not None else ([], [])
+
+    if max_detections is not None and scores is None:
+        raise Exception("Sorry, max_detections is only supported in case of scores")
+
+    boxes = np.asarray(boxes, dtype="float")
+    groups, group_ranks = np.unique(np.asarray(group_ids).reshape((len(boxes),)), return_inverse=True)
+
+    # shift the boxes of each group by the width spanned by all the boxes
+    # the shifts are integers, so shifting back the (int) picked boxes is exact for float boxes too
+    x_min = np.floor(np.min(boxes[:, 0]))
+    span = np.ceil(np.max(boxes[:, 2]) - x_min) + 2
+    shifts = np.zeros_like(boxes)
+    shifts[:, 0] = group_ranks * span - x_min
+    shifts[:, 2] = shifts[:, 0]
+
+    if scores is None:
+        weak, strong = suppression(boxes + shifts, overlap_thresh, min_overlap, index=index)
+    else:
+        # without cross-group suppression, the max detections are the ones of all the groups
+        group_max_detections = max_detections if cross_overlap_thresh is None else None
+        weak, strong, weak_scores, strong_scores = score_suppression(boxes + shifts, scores, overlap_thresh, min_overlap, max_detections=group_max_detections)
+
+    # shift back the picked boxes, the group of a box is known from it's left side
+    weak = __unshift_boxes(weak, span, x_min)
+    strong = __unshift_boxes(strong, span, x_min)
+
+    if cross_overlap_thresh is None or len(strong) == 0:
+        return (weak, strong, weak_scores, strong_scores) if scores is not None else (weak, strong)
+
+    # the weak boxes of the cross-group suppression are added to the weak boxes of the groups
+    if scores is None:
+        cross_weak, strong = suppression(strong, cross_overlap_thresh, cross_min_overlap, index=index)
+        weak = np.vstack((weak.reshape((-1, 4)), cross_weak.reshape((-1, 4)))).astype(int)
+        return weak, strong
+    else:
+        cross_weak, strong, cross_weak_scores, strong_scores = score_suppression(strong, strong_scores, cross_overlap_thresh, cross_min_overlap, max_detections=max_detections)
+        weak = np.vstack((weak.reshape((-1, 4)), cross_weak.reshape((-1, 4)))).astype(int)
+        weak_scores = np.hstack((weak_scores, cross_weak_scores))
+        return weak, strong, weak_scores, strong_scores
+
+
+def __unshift_boxes(boxes, span, x_min):
+    if len(boxes) == 0:
+        return boxes
+    shifts = ((boxes[:, 0] // span) * span - x_min).astype(int)
+    boxes = boxes.copy()
+    boxes[:, 0] -= shifts
+    boxes[:, 2] -= shifts
+    return boxes
+
+
+def check_suppression(n_boxes=(100, 1000, 5000), overlap_thresh=0.5, min_overlap=3, img_width=1360, img_height=800):
+    """
+    Run suppression and suppression_slow on the same random boxes (like the windows of sliding
+    window detection), print if they give the same weak/strong boxes and the time of each
+    """
+
+    rng = np.random.RandomState(1234)
+    results = []
+    for n in n_boxes:
+        dims = rng.randint(low=20, high=160, size=n)
+        xs = rng.randint(low=0, high=img_width - 160, size=n)
+        ys = rng.randint(low=0, high=img_height - 160, size=n)
+        boxes = np.transpose(np.asarray([xs, ys, xs + dims, ys + dims]))
+
+        t1 = time.clock()
+        weak_slow, strong_slow = suppression_slow(boxes, overlap_thresh, min_overlap)
+        t2 = time.clock()
+        weak, strong = suppression(boxes, overlap_thresh, min_overlap)
+        t3 = time.clock()
+
+        is_equal = np.array_equal(weak, weak_slow) and np.array_equal(strong, strong_slow)
+        print("... boxes: %d, equal: %s, time(sec.) slow: %f, suppression: %f" % (n, is_equal, t2 - t1, t3 - t2))
+        results.append(is_equal)
+
+    return all(results)
+
+
+def benchmark_suppression(n_boxes=(1000, 10000, 100000), overlap_thresh=0.5, min_overlap=3, box_density=0.002):
+    """
+    Time suppression without and with the grid index, from thousands to hundreds of thousands of boxes.
+    The boxes are random sliding windows (of dimensions 20 -> 80), the image grows with the number
+    of boxes so that they have the same density as the windows of the full-frame detection
+    :param box_density: number of boxes per pixel of the image
+    """
+
+    rng = np.random.RandomState(1234)
+    for n in n_boxes:
+        img_dim = int(np.sqrt(n / box_density))
+        dims = rng.randint(low=20, high=80, size=n)
+        xs = rng.randint(low=0, high=img_dim - 80, size=n)
+        ys = rng.randint(low=0, high=img_dim - 80, size=n)
+        boxes = np.transpose(np.asarray([xs, ys, xs + dims, ys + dims]))
+
+        t1 = time.clock()
+        weak, strong = suppression(boxes, overlap_thresh, min_overlap)
+        t2 = time.clock()
+        weak_grid, strong_grid = suppression(boxes, overlap_thresh, min_overlap, index="grid")
+        t3 = time.clock()
+
+        is_equal = np.array_equal(weak, weak_grid) and np.array_equal(strong, strong_grid)
+        print("... boxes: %d, equal: %s, time(sec.) suppression: %f, grid: %f" % (n, is_equal, t2 - t1, t3 - t2))
+
+
+def benchmark_score_suppression(n_boxes=(1000, 5000), max_detections=(None, 20, 5), overlap_thresh=0.25, min_overlap=3):
+    """
+    Time score_suppression with and without the early exit, on random boxes with
+    scores of weak positives (just above 0.5) as in frames with many false positives
+    """
+
+    rng = np.random.RandomState(1234)
+    for n in n_boxes:
+        dims = rng.randint(low=20, high=160, size=n)
+        xs = rng.randint(low=0, high=1200, size=n)
+        ys = rng.randint(low=0, high=640, size=n)
+        boxes = np.transpose(np.asarray([xs, ys, xs + dims, ys + dims]))
+        scores = rng.uniform(low=0.5, high=0.6, size=n)
+
+        for max_dets in max_detections:
+            t1 = time.clock()
+            weak, strong, weak_scores, strong_scores = score_suppression(boxes, scores, overlap_thresh, min_overlap, max_detections=max_dets)
+            t2 = time.clock()
+            print("... boxes: %d, max detections: %s, strong: %d, time(sec.): %f" % (n, max_dets, len(strong), t2 - t1))
+
+
+def check_batched_suppression(n_boxes=5000, n_groups=(2, 18, 100), overlap_thresh=0.25, min_overlap=3):
+    """
+    Run batched_suppression and score_suppression once per group on the same random boxes,
+    print if they give the same strong boxes and the time of each. The boxes are integers
+    (sliding windows) then floats (rescaled windows of the scales, not starting at 0)
+    """
+
+    rng = np.random.RandomState(1234)
+    dims = rng.randint(low=20, high=160, size=n_boxes)
+    xs = rng.randint(low=0, high=1200, size=n_boxes)
+    ys = rng.randint(low=0, high=640, size=n_boxes)
+    boxes_int = np.transpose(np.asarray([xs, ys, xs + dims, ys + dims]))
+    dims = rng.uniform(low=20, high=160, size=n_boxes)
+    xs = rng.uniform(low=10.3, high=1200, size=n_boxes)
+    ys = rng.uniform(low=0, high=640, size=n_boxes)
+    boxes_float = np.transpose(np.asarray([xs, ys, xs + dims, ys + dims]))
+    scores = rng.uniform(low=0.5, high=1.0, size=n_boxes)
+
+    results = []
+    for boxes, n in [(boxes, n) for boxes in (boxes_int, boxes_float) for n in n_groups]:
+        group_ids = rng.randint(low=0, high=n, size=n_boxes)
+
+        t1 = time.clock()
+        strong_loop = []
+        for group_id in np.unique(group_ids):
+            idx = np.where(group_ids == group_id)[0]
+            strong_loop.append(score_suppression(boxes[idx], scores[idx], overlap_thresh, min_overlap)[1].reshape((-1, 4)))
+        strong_loop = np.vstack(strong_loop)
+        t2 = time.clock()
+        strong = batched_suppression(boxes, group_ids, overlap_thresh, min_overlap, scores=scores)[1]
+        t3 = time.clock()
+
+        # the order of the strong boxes is not the same, so compare them sorted
+        strong_loop = strong_loop[np.lexsort(strong_loop.T[::-1])]
+        strong = strong[np.lexsort(strong.T[::-1])]
+        is_equal = np.array_equal(strong, strong_loop)
+        print("... boxes: %s, groups: %d, equal: %s, time(sec.) loop: %f, batched: %f" % (boxes.dtype, n, is_equal, t2 - t1, t3 - t2))
+        results.append(is_equal)
+
+    return all(results)
@@ -0,0 +1,244 @@
+"""
+Inference of the trained models using only numpy, i.e. without compiling theano graphs.
+It runs the same weights of the conv+pool layers (saved by CNN.recog.train_shallow and
+CNN.recog.train_deep) and of the nolearn MLPs, which makes the first image as fast as the rest.
+"""
+
+import time
+import numpy
+import numpy.lib.stride_tricks
+
+import CNN
+import CNN.enums
+
+
+def convpool_layer(input, W, b, pool_size):
+    """
+    Same as CNN.conv.convpool_layer: valid convolution, max-pooling (ignoring the border)
+    then tanh. The convolution is done as one matrix multiplication between the filters
+    and the image patches (im2col).
+    :param input: images of shape (batch size, n feature maps, height, width)
+    :param W: filters of shape (n filters, n feature maps, filter height, filter width)
+    :param b: bias, one per filter
+    :param pool_size:
+    :return:
+    """
+
+    n, c, h, w = input.shape
+    n_filters, _, k_h, k_w = W.shape
+    out_h = h - k_h + 1
+    out_w = w - k_w + 1
+
+    # patches of shape (batch, out_h, out_w, c, k_h, k_w), it's only a view, no copying
+    s_n, s_c, s_h, s_w = input.strides
+    patches = numpy.lib.stride_tricks.as_strided(input, shape=(n, out_h, out_w, c, k_h, k_w),
+                                                 strides=(s_n, s_h, s_w, s_c, s_h, s_w), writeable=False)
+    patches = patches.reshape((n * out_h * out_w, c * k_h * k_w))
+
+    # theano conv2d is a real convolution, not correlation, so the filters are flipped
+    filters = W[:, :, ::-1, ::-1].reshape((n_filters, c * k_h * k_w))
+    conv_out = numpy.dot(patches, filters.T)
+    conv_out = conv_out.reshape((n, out_h, out_w, n_filters)).transpose((0, 3, 1, 2))
+
+    # max-pooling, ignore the border
+    p_h, p_w = pool_size
+    pool_h = int(out_h / p_h)
+    pool_w = int(out_w / p_w)
+    conv_out = conv_out[:, :, 0:pool_h * p_h, 0:pool_w * p_w]
+    pooled_out = conv_out.reshape((n, n_filters, pool_h, p_h, pool_w, p_w)).max(axis=(3, 5))
+
+    output = numpy.tanh(pooled_out + b.reshape((1, n_filters, 1, 1)))
+    return output
+
+
+def hidden_layer(input, W, b):
+    return numpy.tanh(numpy.dot(input, W) + b)
+
+
+def logit_layer(input, W, b):
+    p_y_given_x = softmax(numpy.dot(input, W) + b)
+    y_pred = numpy.argmax(p_y_given_x, axis=1)
+    return y_pred, p_y_given_x
+
+
+def softmax(x):
+    e_x = numpy.exp(x - x.max(axis=1, keepdims=True))
+    return e_x / e_x.sum(axis=1, keepdims=True)
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + numpy.exp(-x))
+
+
+def rectify(x):
+    return numpy.maximum(x, 0)
+
+
+class ConvTrunk(object):
+    """
+    The conv+pool layers of the model, callable on a batch of images
+    as the compiled theano function of these layers
+    """
+
+    def __init__(self, loaded_objects, n_layers, dtype="float32"):
+        self.img_dim = loaded_objects[1]
+        self.pool_size = loaded_objects[5]
+        self.dtype = dtype
+        self.Ws = []
+        self.bs = []
+        for i in range(n_layers):
+            self.Ws.append(numpy.asarray(loaded_objects[6 + 2 * i], dtype=dtype))
+            self.bs.append(numpy.asarray(loaded_objects[7 + 2 * i], dtype=dtype))
+
+    def __call__(self, batch):
+        output = numpy.ascontiguousarray(batch, dtype=self.dtype)
+        for W, b in zip(self.Ws, self.bs):
+            output = convpool_layer(output, W, b, self.pool_size)
+        return output
+
+
+class MLP(object):
+    """
+    The dense layers of a nolearn network, with the same predict() as the network.
+    Dropout layers are ignored as it's inference.
+    """
+
+    def __init__(self, layers, regression=True, classes=None):
+        """
+        :param layers: the dense layers, each is W, b and the nonlinearity
+        :param regression:
+        :param classes: labels of the classes (of the label encoder of the network), None for their indexes
+        """
+        self.layers = layers
+        self.regression = regression
+        self.classes = classes
+
+    @classmethod
+    def from_nolearn(cls, nn, dtype="float32"):
+        import lasagne
+        import lasagne.layers
+        import lasagne.nonlinearities
+
+        nonlinearities = {
+            lasagne.nonlinearities.rectify: rectify,
+            lasagne.nonlinearities.sigmoid: sigmoid,
+            lasagne.nonlinearities.softmax: softmax,
+            lasagne.nonlinearities.tanh: numpy.tanh,
+            lasagne.nonlinearities.linear: None,
+            lasagne.nonlinearities.identity: None,
+            None: None,
+        }
+
+        nn.initialize()
+        layers = []
+        for layer in nn.layers_.values():
+            if not isinstance(layer, lasagne.layers.DenseLayer):
+                continue
+            if layer.nonlinearity not in nonlinearities:
+                raise Exception("Sorry, non-supported nonlinearity: %s" % (layer.nonlinearity))
+            W = numpy.asarray(layer.W.get_value(), dtype=dtype)
+            b = numpy.asarray(layer.b.get_value(), dtype=dtype)
+            layers.append((W, b, nonlinearities[layer.nonlinearity]))
+
+        classes = nn.enc_.classes_ if not nn.regression and nn.use_label_encoder else None
+        return cls(layers, nn.regression, classes)
+
+    def predict_proba(self, x):
+        output = x.reshape((x.shape[0], -1))
+        for W, b, nonlinearity in self.layers:
+            output = numpy.dot(output, W) + b
+            if nonlinearity is not None:
+                output = nonlinearity(output)
+        return output
+
+    def predict(self, x):
+        output = self.predict_proba(x)
+        if self.regression:
+            return output
+        y_pred = numpy.argmax(output, axis=1)
+        return y_pred if self.classes is None else self.classes[y_pred]
+
+
+def classify_batch(batch, loaded_objects, model_type=CNN.enums.ModelType._01_conv2_mlp2):
+    """
+    Same as CNN.recog.classify_batch but using numpy
+    Note that the logit and svm layers both use softmax at inference
+    :return:
+    """
+
+    if model_type == CNN.enums.ModelType._01_conv2_mlp2:
+        n_conv_layers = 2
+    elif model_type == CNN.enums.ModelType._02_conv3_mlp2:
+        n_conv_layers = 3
+    else:
+        raise Exception("Unknown model type")
+
+    img_dim = loaded_objects[1]
+    batch = batch.reshape((batch.shape[0], 1, img_dim, img_dim))
+
+    idx = 6 + 2 * n_conv_layers
+    trunk = ConvTrunk(loaded_objects, n_conv_layers)
+    filters = trunk(batch)
+    filters = filters.reshape((filters.shape[0], -1))
+    hidden_output = hidden_layer(filters, loaded_objects[idx], loaded_objects[idx + 1])
+    c_result, c_prob = logit_layer(hidden_output, loaded_objects[idx + 2], loaded_objects[idx + 3])
+    return c_result, c_prob
+
+
+def check_parity(recognition_model_path, detection_model_path, batch_size=50):
+    """
+    Run the detector using the theano and numpy backends on the same
+    random regions and print the max difference between the two outputs
+    (the number of different labels for the predictions in case of classification)
+    """
+    import CNN.cache
+
+    theano_detector = CNN.cache.get_detector(recognition_model_path, detection_model_path, batch_size, CNN.enums.BackendType.theano)
+    numpy_detector = CNN.cache.get_detector(recognition_model_path, detection_model_path, batch_size, CNN.enums.BackendType.numpy)
+    img_dim = theano_detector.img_dim
+
+    rng = numpy.random.RandomState(1234)
+    batch = rng.uniform(low=0, high=1, size=(batch_size, 1, img_dim, img_dim)).astype("float32")
+
+    theano_filters = theano_detector.conv_fn(batch)
+    numpy_filters = numpy_detector.conv_fn(batch)
+    theano_pred = theano_detector.predict(batch)
+    numpy_pred = numpy_detector.predict(batch)
+
+    filters_diff = numpy.max(numpy.abs(theano_filters - numpy_filters))
+    if numpy_detector.nn_mlp.regression:
+        pred_diff = numpy.max(numpy.abs(theano_pred - numpy_pred))
+    else:
+        pred_diff = numpy.sum(theano_pred != numpy_pred)
+    print("... max difference, filters: %f, prediction: %f" % (filters_diff, pred_diff))
+    return filters_diff, pred_diff
+
+
+def benchmark_backends(recognition_model_path, detection_model_path, batch_size=50, n_batches=20):
+    """
+    Compare cold-start (build the detector + first batch) and steady-state (per batch)
+    latency of the theano and numpy backends
+    """
+    import CNN.cache
+
+    rng = numpy.random.RandomState(1234)
+    for backend in [CNN.enums.BackendType.theano, CNN.enums.BackendType.numpy]:
+        CNN.cache.clear()
+
+        t1 = time.clock()
+        detector = CNN.cache.get_detector(recognition_model_path, detection_model_path, batch_size, backend)
+        img_dim = detector.img_dim
+        batch = rng.uniform(low=0, high=1, size=(batch_size, 1, img_dim, img_dim)).astype("float32")
+        detector.predict(batch)
+        t2 = time.clock()
+        cold_start = t2 - t1
+
+        t1 = time.clock()
+        for i in range(n_batches):
+            detector.predict(batch)
+        t2 = time.clock()
+        steady_state = (t2 - t1) / n_batches
+
+        print("... backend: %s, cold-start(sec.): %f, steady-state(sec./batch): %f" % (backend.name, cold_start, steady_state))
+
+    CNN.cache.clear()
@@ -0,0 +1,283 @@
+"""
+Staged producer/consumer pipeline, used to process the frames of a street view route: each stage
+(fetch, decode, extract regions, detect, classify, save) runs in it's own threads and passes the
+frames to the next one through a bounded queue, so the stages overlap. If a stage is slower than the
+ones before it, it's queue fills up and they wait (backpressure) instead of piling up frames in memory.
+The stages mostly wait (on the network and the queues), so they are timed by the wall-clock (perf_counter).
+"""
+
+import time
+import heapq
+import queue
+import threading
+import urllib.parse
+import http.server
+
+import numpy
+
+import cv2
+
+
+class Stage(object):
+    """
+    One stage of the pipeline, the given function is called on each item by n_workers threads.
+    If the function fails on an item, or the item is None (dropped by a previous stage), None is passed
+    to the next stage, so the results keep one entry per item.
+    """
+
+    def __init__(self, name, fn, n_workers=1, queue_size=4, ordered=False):
+        """
+        :param name:
+        :param fn: function of one argument, the output of the previous stage (or the item for the first stage)
+        :param n_workers: number of threads of the stage
+        :param queue_size: max number of items waiting for the stage
+        :param ordered: process the items in their order, for stateful stages (tracking), must have one worker
+        """
+
+        if ordered and n_workers != 1:
+            raise Exception("Sorry, an ordered stage must have only one worker")
+
+        self.name = name
+        self.fn = fn
+        self.n_workers = n_workers
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.reset()
+
+    def reset(self):
+        self.n_in = 0
+        self.n_out = 0
+        self.n_failed = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.max_queued = 0
+
+    def __str__(self):
+        return "%s: workers: %d, in: %d, out: %d, failed: %d, busy(sec.): %f, blocked by next stage(sec.): %f, max queued: %d" % \
+               (self.name, self.n_workers, self.n_in, self.n_out, self.n_failed, self.busy_time, self.wait_time, self.max_queued)
+
+
+class Pipeline(object):
+    """
+    Stages connected by bounded queues, the items are fed to the first stage and the results
+    of the last stage are returned in the order of the items
+    """
+
+    # marks the end of the items in the queues
+    __END = object()
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.duration = 0.0
+        self.__lock = threading.Lock()
+
+    def run(self, items):
+        """
+        :param items: the inputs of the first stage
+        :return: the outputs of the last stage, one for each item
+        """
+
+        for stage in self.stages:
+            stage.reset()
+
+        items = list(items)
+        n_stages = len(self.stages)
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        queues.append(queue.Queue())
+        n_finished = [0] * n_stages
+
+        t1 = time.perf_counter()
+
+        threads = [threading.Thread(target=self.__feed, args=(items, queues[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            for j in range(stage.n_workers):
+                threads.append(threading.Thread(target=self.__work, args=(i, queues, n_finished), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        # collect the results of the last stage until it's end
+        results = [None] * len(items)
+        while True:
+            item = queues[-1].get()
+            if item is Pipeline.__END:
+                break
+            idx, output = item
+            results[idx] = output
+
+        for thread in threads:
+            thread.join()
+
+        t2 = time.perf_counter()
+        self.duration = t2 - t1
+        return results
+
+    def print_stats(self):
+        print("... pipeline, time(sec.): %f" % (self.duration))
+        for stage in self.stages:
+            throughput = stage.n_out / self.duration if self.duration > 0 else 0
+            print("... stage %s, throughput(items/sec.): %f" % (stage, throughput))
+
+    def __feed(self, items, first_queue):
+        for idx, item in enumerate(items):
+            first_queue.put((idx, item))
+        for j in range(self.stages[0].n_workers):
+            first_queue.put(Pipeline.__END)
+
+    def __work(self, i, queues, n_finished):
+        stage = self.stages[i]
+        in_queue = queues[i]
+        out_queue = queues[i + 1]
+        is_last = i == len(self.stages) - 1
+
+        # in case of ordered stage, the items that came before their turn
+        pending = []
+        next_idx = 0
+
+        while True:
+            item = in_queue.get()
+            if item is Pipeline.__END:
+                break
+
+            with self.__lock:
+                stage.n_in += 1
+                stage.max_queued = max(stage.max_queued, in_queue.qsize() + 1)
+
+            if not stage.ordered:
+                self.__process(stage, item, out_queue)
+                continue
+
+            heapq.heappush(pending, item)
+            while len(pending) > 0 and pending[0][0] == next_idx:
+                self.__process(stage, heapq.heappop(pending), out_queue)
+                next_idx += 1
+
+        # the last worker of the stage ends the next one
+        with self.__lock:
+            n_finished[i] += 1
+            is_finished = n_finished[i] == stage.n_workers
+        if is_finished:
+            n_ends = 1 if is_last else self.stages[i + 1].n_workers
+            for j in range(n_ends):
+                out_queue.put(Pipeline.__END)
+
+    def __process(self, stage, item, out_queue):
+        idx, payload = item
+        output = None
+        t1 = time.perf_counter()
+        if payload is not None:
+            try:
+                output = stage.fn(payload)
+            except Exception as e:
+                print("... stage %s failed on item %d: %s" % (stage.name, idx, e))
+                with self.__lock:
+                    stage.n_failed += 1
+        t2 = time.perf_counter()
+
+        # blocks if the next stage is busy (backpressure)
+        out_queue.put((idx, output))
+        t3 = time.perf_counter()
+
+        with self.__lock:
+            stage.n_out += 1
+            stage.busy_time += t2 - t1
+            stage.wait_time += t3 - t2
+
+
+class FrameServer(object):
+    """
+    Local stand-in of the google street view api, serves the given images (GTSDB frames for example)
+    one for each location, so the route pipeline can be tested without the api. The image of a request
+    is the one of it's location parameter, formatted as the requests of CNN.stview.
+    """
+
+    def __init__(self, img_pathes, port=0, delay=0.0):
+        """
+        :param img_pathes: the images, one for each location
+        :param port: port of the server, 0 for any free port
+        :param delay: seconds to wait before each response, to simulate the latency of the network
+        """
+
+        # fake locations along a straight road, heading north
+        self.locations = []
+        self.__frames = {}
+        for i, img_path in enumerate(img_pathes):
+            location = {"lat": 50.9 + i * 0.0001, "lng": -1.4, "heading": 0.0}
+            self.locations.append(location)
+            self.__frames["%f,%f" % (location["lat"], location["lng"])] = img_path
+
+        frames = self.__frames
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                img_path = frames.get(query.get("location", [""])[0])
+                if img_path is None:
+                    self.send_error(404)
+                    return
+                time.sleep(delay)
+                with open(img_path, "rb") as f:
+                    img_bytes = f.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(img_bytes)))
+                self.end_headers()
+                self.wfile.write(img_bytes)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+        self.base_url = "http://127.0.0.1:%d/streetview" % (self.__server.server_address[1])
+
+    def shutdown(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+def check_pipeline(n_frames=20, delay=0.05, work_time=0.05, img_width=640, img_height=400):
+    """
+    Fetch random frames from a local FrameServer then decode and process them (sleep as the detection),
+    sequentially and using the pipeline, print the time of each and the counters of the stages
+    :param delay: latency of the server (sec.)
+    :param work_time: time of processing each frame (sec.)
+    """
+    import os
+    import tempfile
+    import urllib.request
+
+    rng = numpy.random.RandomState(1234)
+    root = tempfile.mkdtemp()
+    img_pathes = []
+    for i in range(n_frames):
+        img_path = os.path.join(root, "%05d.png" % (i))
+        cv2.imwrite(img_path, rng.randint(low=0, high=256, size=(img_height, img_width, 3)).astype(numpy.uint8))
+        img_pathes.append(img_path)
+
+    server = FrameServer(img_pathes, delay=delay)
+
+    def fetch(location):
+        url = "%s?location=%f,%f" % (server.base_url, location["lat"], location["lng"])
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.read()
+
+    def decode(img_bytes):
+        return cv2.imdecode(numpy.frombuffer(img_bytes, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+
+    def process(img):
+        time.sleep(work_time)
+        return img.shape
+
+    t1 = time.perf_counter()
+    results_seq = [process(decode(fetch(location))) for location in server.locations]
+    t2 = time.perf_counter()
+
+    pipeline = Pipeline([Stage("fetch", fetch, n_workers=4), Stage("decode", decode), Stage("process", process, ordered=True)])
+    results = pipeline.run(server.locations)
+    server.shutdown()
+
+    print("... frames: %d, equal: %s, time(sec.) sequential: %f, pipeline: %f" % (n_frames, results == results_seq, t2 - t1, pipeline.duration))
+    pipeline.print_stats()
+    return results == results_seq
@@ -1,3 +1,7 @@
+import csv
+import time
+import concurrent.futures
+
 import numpy
 import numpy as np
 import matplotlib.pyplot as plt
@@ -8,6 +12,8 @@ import CNN
 import CNN.utils
 import CNN.nms
 import CNN.enums
+import CNN.consts
+import CNN.sink
 
 import skimage
 import skimage.io
@@ -19,29 +25,360 @@ from skimage.draw import circle_perimeter
 from skimage.util import img_as_ubyte
 
 
-def detection_proposal(img_color, min_dim, max_dim, superclass_type=CNN.enums.SuperclassType._01_Prohibitory):
-    if superclass_type == CNN.enums.SuperclassType._01_Prohibitory or superclass_type == CNN.enums.SuperclassType._03_Mandatory:
-        return __detection_proposal_circles(img_color, min_dim, max_dim)
+class ProposalContext(object):
+    """
+    The pre-processed versions of an image needed to find the detection proposals.
+    They are computed once, when first needed, and then reused by the calls of
+    detection_proposal on the same image (i.e. at different scales or for different detectors)
+    """
+
+    def __init__(self, img_color):
+        self.img_color = img_color
+        self.__img_filtered = None
+        self.__img_blurred = None
+        self.__img_sharpened = None
+        self.__img_sharpened_half = None
+        self.__img_hsv = None
+        self.__parent = None
+        self.__region = None
+
+    def crop(self, x1, y1, x2, y2):
+        """
+        ProposalContext of the given region of the image, it's pre-processed images are cut
+        from the ones of the whole image, so the region is not pre-processed again
+        """
+        context = ProposalContext(self.img_color[y1:y2, x1:x2])
+        context.__parent = self
+        context.__region = (x1, y1, x2, y2)
+        return context
+
+    def __parent_img(self, name):
+        # the image of the region cut from the one of the whole image, None if it's not a region
+        if self.__parent is None:
+            return None
+        x1, y1, x2, y2 = self.__region
+        return getattr(self.__parent, name)[y1:y2, x1:x2]
+
+    @property
+    def img_filtered(self):
+        if self.__img_filtered is None:
+            img_filtered = self.__parent_img("img_filtered")
+            if img_filtered is None:
+                img_filtered = cv2.pyrMeanShiftFiltering(self.img_color, 10, 10)
+                img_filtered = cv2.cvtColor(img_filtered, cv2.COLOR_BGRA2GRAY).astype(float)
+            self.__img_filtered = img_filtered
+        return self.__img_filtered
+
+    @property
+    def img_blurred(self):
+        if self.__img_blurred is None:
+            img_blurred = self.__parent_img("img_blurred")
+            if img_blurred is None:
+                img_blurred = cv2.GaussianBlur(self.img_filtered, (7, 7), sigmaX=0)
+            self.__img_blurred = img_blurred
+        return self.__img_blurred
+
+    @property
+    def img_sharpened(self):
+        if self.__img_sharpened is None:
+            img_sharpened = self.__parent_img("img_sharpened")
+            if img_sharpened is None:
+                img_sharpened = sharpen_image(self.img_filtered, self.img_blurred)
+            self.__img_sharpened = img_sharpened
+        return self.__img_sharpened
+
+    @property
+    def img_sharpened_half(self):
+        if self.__img_sharpened_half is None:
+            self.__img_sharpened_half = cv2.pyrDown(self.img_sharpened)
+        return self.__img_sharpened_half
+
+    @property
+    def img_hsv(self):
+        if self.__img_hsv is None:
+            img_hsv = self.__parent_img("img_hsv")
+            if img_hsv is None:
+                img_hsv = cv2.cvtColor(self.img_color, cv2.COLOR_BGR2HSV)
+            self.__img_hsv = img_hsv
+        return self.__img_hsv
+
+
+def detection_proposal(img, min_dim, max_dim, superclass_type=CNN.enums.SuperclassType._01_Prohibitory, n_workers=4, half_max_dim=0,
+                       proposal_type=CNN.enums.ProposalType.hough, integral=False):
+    """
+    Find the detection proposals of the given image
+    :param img: either the color image or it's ProposalContext, pass the context
+    when calling many times on the same image so it's pre-processed only once
+    :param min_dim:
+    :param max_dim:
+    :param superclass_type:
+    :param n_workers: number of threads to search for circles of the different dims in parallel
+    :param half_max_dim: circles with dim up to this are searched for in the half-sized image (0 to disable)
+    :param proposal_type: hough (mean-shift + shapes) or color (blobs of the colors of the superclass, much faster)
+    :param integral: also return the integral (summed-area table) of the map, see window_origins
+    :return: weak regions, strong regions, map of the strong regions, shapes and the integral of the map (if asked for)
+    """
+
+    context = img if isinstance(img, ProposalContext) else ProposalContext(img)
+
+    if proposal_type == CNN.enums.ProposalType.color:
+        proposals = __detection_proposal_colors(context, min_dim, max_dim, superclass_type)
+    elif proposal_type != CNN.enums.ProposalType.hough:
+        raise Exception("Sorry, non-supported proposal type")
+    elif superclass_type == CNN.enums.SuperclassType._01_Prohibitory or superclass_type == CNN.enums.SuperclassType._03_Mandatory:
+        proposals = __detection_proposal_circles(context, min_dim, max_dim, n_workers, half_max_dim)
     elif superclass_type == CNN.enums.SuperclassType._02_Warning:
-        return __detection_proposal_triangles(img_color, min_dim, max_dim)
+        proposals = __detection_proposal_triangles(context, min_dim, max_dim)
     else:
         raise Exception("Sorry, non-supported superclass type to find detecttion proposal to.")
 
+    if integral:
+        img_map = proposals[2]
+        map_integral = integral_map(img_map) if len(img_map) > 0 else None
+        proposals = proposals + (map_integral,)
+
+    return proposals
+
+
+class ProposalTracker(object):
+    """
+    Detection proposals of a sequence of frames taken along a route (street view), where
+    consecutive frames overlap heavily. The strong proposals (and the detections, if given)
+    of the previous frame are carried forward to the current one after predicting their shift:
+    expansion from the center of the frame as the camera moves forward, and horizontal shift
+    as the heading changes. The new candidates of the current frame can only be the signs that
+    were too small to be found in the previous frame, or the ones that entered the frame by
+    turning. So, the proposals are extracted from the whole frame only in the narrow band of the
+    smallest dims, and with the full range of dims only in the strip that entered the frame.
+    Every full_every frames, the proposals are extracted from the whole frame as usual.
+    Note that the whole frame is still pre-processed, which is most of the time of the proposals,
+    so only the search of the bigger dims is saved. Also, it's lossy: a sign of a bigger dim that
+    appears inside the frame (i.e. after an occluding vehicle) is missed until the next full frame.
+    """
+
+    def __init__(self, min_dim, max_dim, superclass_type=CNN.enums.SuperclassType._01_Prohibitory,
+                 proposal_type=CNN.enums.ProposalType.hough, full_every=10, expansion=1.1, fov=90):
+        """
+        :param min_dim:
+        :param max_dim:
+        :param superclass_type:
+        :param proposal_type:
+        :param full_every: extract the proposals from the whole frame every this number of frames
+        :param expansion: scale of the carried candidates from one frame to the next
+        :param fov: horizontal field of view (degrees) of the camera, to convert the change of heading to pixels
+        """
+
+        self.min_dim = min_dim
+        self.max_dim = max_dim
+        self.superclass_type = superclass_type
+        self.proposal_type = proposal_type
+        self.full_every = full_every
+        self.expansion = expansion
+        self.fov = fov
+
+        # the dims that can grow to more than min_dim from one frame to the next, at least
+        # one band of the hough circles (10 pixels)
+        self.new_max_dim = min(max(int(min_dim * expansion) + 1, min_dim + 10), max_dim)
+
+        self.n_frames = 0
+        self.n_full_frames = 0
+        self.duration = 0.0
+        self.full_duration = 0.0
+        self.__boxes = numpy.zeros(shape=(0, 4), dtype=int)
+        self.__detections = numpy.zeros(shape=(0, 4), dtype=int)
+        self.__heading = None
+
+    @property
+    def work_saved(self):
+        """
+        fraction of the proposal time (pre-processing included) saved so far, compared
+        to the time of extracting the proposals from the whole frame (the full frames)
+        """
+        if self.n_full_frames == 0:
+            return 0.0
+        return 1 - self.duration / (self.n_frames * self.full_duration / self.n_full_frames)
+
+    def add_detections(self, boxes):
+        """
+        the detections of the current frame, carried forward with the proposals to the next one
+        """
+        self.__detections = numpy.asarray(boxes, dtype=int).reshape((-1, 4))
+
+    def reset(self):
+        """
+        start a new route, the next frame is a full one
+        """
+        self.__boxes = numpy.zeros(shape=(0, 4), dtype=int)
+        self.__detections = numpy.zeros(shape=(0, 4), dtype=int)
+        self.__heading = None
+        self.n_frames = 0
+        self.n_full_frames = 0
+        self.duration = 0.0
+        self.full_duration = 0.0
+
+    def update(self, img, heading=None):
+        """
+        Find the detection proposals of the next frame of the route
+        :param img: the color image or it's ProposalContext
+        :param heading: heading of the camera (degrees)
+        :return: the same as detection_proposal
+        """
+
+        t1 = time.clock()
+
+        context = img if isinstance(img, ProposalContext) else ProposalContext(img)
+        img_height, img_width = context.img_color.shape[0:2]
+
+        heading_change = 0
+        if heading is not None and self.__heading is not None:
+            heading_change = (heading - self.__heading + 180) % 360 - 180
+        shift = int(round(heading_change * img_width / self.fov))
+
+        # the strip that entered the frame by turning, with a margin so the
+        # signs on it's border are found, if too wide, then it's a new view
+        strip = None
+        strip_dim = min(abs(shift) + self.max_dim, img_width)
+        if shift > 0:
+            strip = (img_width - strip_dim, img_width)
+        elif shift < 0:
+            strip = (0, strip_dim)
+
+        carried = self.__predict(img_width, img_height, shift)
+        is_full = self.n_frames % self.full_every == 0 or len(carried) == 0 or strip_dim == img_width
+        if is_full:
+            regions_weak, regions_strong, img_map, shapes = detection_proposal(context, self.min_dim, self.max_dim, self.superclass_type,
+                                                                               proposal_type=self.proposal_type)
+        else:
+            boxes = [carried]
+            proposals = detection_proposal(context, self.min_dim, self.new_max_dim, self.superclass_type, proposal_type=self.proposal_type)
+            if len(proposals[1]) > 0:
+                boxes.append(numpy.asarray(proposals[1]))
+
+            # the strip is cut from the pre-processed frame, so it's not pre-processed again
+            if strip is not None:
+                x1, x2 = strip
+                proposals = detection_proposal(context.crop(x1, 0, x2, img_height), self.min_dim, self.max_dim, self.superclass_type,
+                                               proposal_type=self.proposal_type)
+                if len(proposals[1]) > 0:
+                    boxes.append(numpy.asarray(proposals[1]) + [x1, 0, x1, 0])
+
+            boxes = numpy.vstack(boxes)
+            regions_weak, regions_strong = CNN.nms.suppression(boxes=boxes, overlap_thresh=0.75, min_overlap=0)
+            shapes = []
+            img_map = numpy.zeros(shape=(img_height, img_width), dtype=bool)
+            for r in regions_strong:
+                img_map[max(r[1], 0):r[3], max(r[0], 0):r[2]] = True
+
+        self.__boxes = numpy.asarray(regions_strong, dtype=int).reshape((-1, 4))
+        self.__detections = numpy.zeros(shape=(0, 4), dtype=int)
+        self.__heading = heading
+
+        t2 = time.clock()
+        self.n_frames += 1
+        self.duration += t2 - t1
+        if is_full:
+            self.n_full_frames += 1
+            self.full_duration += t2 - t1
+
+        return regions_weak, regions_strong, img_map, shapes
+
+    def __predict(self, img_width, img_height, shift):
+        """
+        the carried candidates of the previous frame, moved to where they are expected to be in the current one
+        """
+
+        boxes = numpy.vstack([self.__boxes, self.__detections]).astype(float)
+        if len(boxes) == 0:
+            return boxes.astype(int)
+
+        # objects get bigger and move away from the center of the frame as we move forward
+        center_x = (boxes[:, 0] + boxes[:, 2]) / 2
+        center_y = (boxes[:, 1] + boxes[:, 3]) / 2
+        dim_half = numpy.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]) * self.expansion / 2
+        center_x = img_width / 2 + (center_x - img_width / 2) * self.expansion
+        center_y = img_height / 2 + (center_y - img_height / 2) * self.expansion
+
+        # turning to the right moves the objects to the left
+        center_x -= shift
+
+        boxes = numpy.transpose(numpy.asarray([center_x - dim_half, center_y - dim_half, center_x + dim_half, center_y + dim_half]))
+        boxes = numpy.around(boxes).astype(int)
+
+        # drop the candidates that left the frame or got too big
+        inside = numpy.logical_and(numpy.logical_and(boxes[:, 0] >= 0, boxes[:, 1] >= 0),
+                                   numpy.logical_and(boxes[:, 2] <= img_width, boxes[:, 3] <= img_height))
+        valid_dim = 2 * dim_half <= self.max_dim
+        return boxes[numpy.logical_and(inside, valid_dim)]
+
+
+def integral_map(img_map):
+    """
+    Summed-area table of the given binary map, it's one row and one column bigger than the map
+    so the sum of any window is 4 lookups, see window_origins
+    """
+    return cv2.integral(img_map.astype("uint8"))
+
+
+def window_origins(img_height, img_width, window_dim, stride, map_integral=None):
+    """
+    The top-left corners of the sliding windows of the given dim, row by row. The windows cover
+    the image, so the last window of each row/column is the first one that exceeds the image.
+    If the integral of the proposals map is given, only the windows that intersect with it are returned.
+    :return: array of shape (n, 2), each row is (x, y)
+    """
+
+    xs = numpy.arange(0, img_width + 1, stride)
+    ys = numpy.arange(0, img_height + 1, stride)
+    xs = xs[0:min(numpy.sum(xs + window_dim <= img_width) + 1, len(xs))]
+    ys = ys[0:min(numpy.sum(ys + window_dim <= img_height) + 1, len(ys))]
+    y, x = numpy.meshgrid(ys, xs, indexing="ij")
+    x = x.ravel()
+    y = y.ravel()
+
+    if map_integral is not None:
+        x2 = numpy.minimum(x + window_dim, img_width)
+        y2 = numpy.minimum(y + window_dim, img_height)
+        window_sum = map_integral[y2, x2] - map_integral[y, x2] - map_integral[y2, x] + map_integral[y, x]
+        intersect = window_sum > 0
+        x = x[intersect]
+        y = y[intersect]
+
+    return numpy.stack([x, y], axis=1)
+
+
+def sharpen_image(img_filtered, img_blurred):
+    img_laplacian = cv2.Laplacian(img_blurred, ddepth=cv2.CV_64F)
+
+    weight = 0.01 * 40
+    scale = 0.01 * 20
+    img_sharpened = (1.5 * img_filtered) - (0.5 * img_blurred) - (weight * cv2.multiply(img_filtered, scale * img_laplacian))
+    img_sharpened = img_sharpened.astype("uint8")
+    return img_sharpened
+
 
 def detection_proposal_and_save(img_path, min_dim=40, max_dim=160, superclass_type=CNN.enums.SuperclassType._01_Prohibitory):
     # extract detection proposals for circle-based traffic signs
     # suppress the extracted circles to weak and strong regions
-    # draw the regions on the image and save it
+    # draw the regions on the image and save it using the artifact sink (if enabled, see CNN.sink.configure)
 
     # load picture and detect edges
     img_color = cv2.imread(img_path)
     regions_weak, regions_strong, img_map, circles = detection_proposal(img_color, min_dim, max_dim, superclass_type)
 
-    for c in circles:
-        # draw the outer circle
-        cv2.circle(img_color, (c[0], c[1]), c[2], (0, 255, 0), 2)
-        # draw the center of the circle
-        cv2.circle(img_color, (c[0], c[1]), 2, (0, 0, 255), 3)
+    # no need to draw if the result won't be saved
+    if not CNN.sink.enabled():
+        return
+
+    if superclass_type == CNN.enums.SuperclassType._02_Warning:
+        # draw the triangles
+        for t in circles:
+            cv2.polylines(img_color, [t.reshape((-1, 1, 2))], True, (0, 255, 0), 2)
+    else:
+        for c in circles:
+            # draw the outer circle
+            cv2.circle(img_color, (c[0], c[1]), c[2], (0, 255, 0), 2)
+            # draw the center of the circle
+            cv2.circle(img_color, (c[0], c[1]), 2, (0, 0, 255), 3)
 
     # draw and save the result, for testing purposes
     red_color = (0, 0, 255)
@@ -52,29 +389,50 @@ def detection_proposal_and_save(img_path, min_dim=40, max_dim=160, superclass_ty
         cv2.rectangle(img_color, (loc[0], loc[1]), (loc[2], loc[3]), red_color, 2)
 
     # save the result
-    cv2.imwrite("D://_Dataset//GTSDB//Test_Regions//_img2.png", img_color)
+    CNN.sink.save("_img2.png", img_color)
 
 
-def __detection_proposal_circles(img_color, min_dim, max_dim):
+def __detection_proposal_circles(context, min_dim, max_dim, n_workers=4, half_max_dim=0):
     """
     This algorithm depends on opencv, which is much much better than this of skiimage
-    :param img_color:
+    :param context: ProposalContext of the image
     :param min_dim:
     :param max_dim:
+    :param n_workers:
+    :param half_max_dim:
     :return:
     """
 
-    img_filtered = cv2.pyrMeanShiftFiltering(img_color, 10, 10)
-    img_filtered = cv2.cvtColor(img_filtered, cv2.COLOR_BGRA2GRAY)
-    img_filtered = img_filtered.astype(float)
-    img_blurred = cv2.GaussianBlur(img_filtered, (7, 7), sigmaX=0)
-    img_laplacian = cv2.Laplacian(img_blurred, ddepth=cv2.CV_64F)
+    # the image is pre-processed only once, then the circles of the current range of dims are found
+    circles = __hough_circles(context, min_dim, max_dim, n_workers, half_max_dim)
+
+    # if no circles, then return
+    if len(circles) == 0:
+        return [], [], [], circles
+
+    # convert circles to regions
+    circles = numpy.vstack(circles)
+    circles = (np.around(circles)).astype(int)
+    center_x = circles[:, 0]
+    center_y = circles[:, 1]
+    radius = circles[:, 2]
+    regions = numpy.asarray([center_x - radius, center_y - radius, center_x + radius, center_y + radius])
+    regions = numpy.transpose(regions)
+
+    # suppress the regions to extract the strongest ones
+    min_overlap = 0
+    overlap_thresh = 0.75
+    regions_weak, regions_strong = CNN.nms.suppression(boxes=regions, overlap_thresh=overlap_thresh, min_overlap=min_overlap)
+
+    # create binary map using only the strong regions
+    img_shape = context.img_color.shape
+    img_map = np.zeros(shape=(img_shape[0], img_shape[1]), dtype=bool)
+    for r in regions_strong:
+        img_map[r[1]:r[3], r[0]:r[2]] = True
+    return regions_weak, regions_strong, img_map, circles
 
-    weight = 0.01 * 40
-    scale = 0.01 * 20
-    img_sharpened = (1.5 * img_filtered) - (0.5 * img_blurred) - (weight * cv2.multiply(img_filtered, scale * img_laplacian))
-    img_sharpened = img_sharpened.astype("uint8")
 
+def __hough_circles(context, min_dim, max_dim, n_workers=4, half_max_dim=0):
     dims = []
     if (max_dim - min_dim) > 10:
         dims = numpy.arange(max_dim, min_dim, -10, dtype=int)
@@ -86,27 +444,154 @@ def __detection_proposal_circles(img_color, min_dim, max_dim):
     # min and max increase more than 10 pixels specially in the bigger windows size (>80)
     # so, if the range is detected to be bigger than 10 pixels, then do detection on several steps
 
-    # loop on the dimensions, max radius is the current dim/2, while min radius = next dim/2
-    circles = []
+    # max radius is the current dim/2, while min radius = next dim/2
+    bands = []
     for i in range(0, len(dims) - 1):
         max_r = int(dims[i] / 2)
         min_r = int(dims[i + 1] / 2)
-        current_circles = cv2.HoughCircles(img_sharpened, cv2.HOUGH_GRADIENT, 1, min_r, param1=50, param2=30, minRadius=min_r, maxRadius=max_r)
-        if current_circles is not None:
-            circles.append(current_circles[0])
+        bands.append((min_r, max_r))
+
+    # the small bands can be searched for in the half-sized image, it's pre-processed
+    # before starting the threads, so the context is only read inside them
+    img_sharpened = context.img_sharpened
+    img_sharpened_half = context.img_sharpened_half if any([band[1] * 2 <= half_max_dim for band in bands]) else None
+
+    def find_circles(band):
+        min_r, max_r = band
+        if max_r * 2 <= half_max_dim:
+            # min radius of the half-sized image shouldn't be zero
+            min_r_half = max(int(min_r / 2), 1)
+            max_r_half = max(int(max_r / 2), min_r_half + 1)
+            band_circles = cv2.HoughCircles(img_sharpened_half, cv2.HOUGH_GRADIENT, 1, min_r_half, param1=50, param2=30, minRadius=min_r_half, maxRadius=max_r_half)
+            if band_circles is not None:
+                band_circles = band_circles * 2
+        else:
+            band_circles = cv2.HoughCircles(img_sharpened, cv2.HOUGH_GRADIENT, 1, min_r, param1=50, param2=30, minRadius=min_r, maxRadius=max_r)
+        return band_circles
+
+    # opencv releases the GIL, so the bands are searched for in parallel
+    # the circles are merged in the order of the bands, regardless of which thread finishes first
+    if n_workers > 1 and len(bands) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(n_workers, len(bands))) as pool:
+            bands_circles = list(pool.map(find_circles, bands))
+    else:
+        bands_circles = [find_circles(band) for band in bands]
 
-    # if no circles, then return
-    if len(circles) == 0:
-        return [], [], [], circles
+    circles = []
+    for band_circles in bands_circles:
+        if band_circles is not None:
+            circles.append(band_circles[0])
 
-    # convert circles to regions
-    circles = numpy.vstack(circles)
-    circles = (np.around(circles)).astype(int)
-    center_x = circles[:, 0]
-    center_y = circles[:, 1]
-    radius = circles[:, 2]
-    regions = numpy.asarray([center_x - radius, center_y - radius, center_x + radius, center_y + radius])
-    regions = numpy.transpose(regions)
+    return circles
+
+
+def benchmark_proposal_circles(img_pathes, min_dim=20, max_dim=160, n_workers=(1, 2, 4, 8), half_max_dims=(0, 60)):
+    """
+    Time (milli-sec. per image) of searching for the circles in the given images (GTSDB, 1360x800)
+    using different number of workers, with and without searching for the small circles
+    in the half-sized image. The pre-processing is done once per image and not timed.
+    """
+
+    contexts = []
+    for img_path in img_pathes:
+        context = ProposalContext(cv2.imread(img_path))
+        context.img_sharpened
+        context.img_sharpened_half
+        contexts.append(context)
+
+    n_imgs = len(contexts)
+    for half_max_dim in half_max_dims:
+        for workers in n_workers:
+            n_circles = 0
+            t1 = time.clock()
+            for context in contexts:
+                circles = __hough_circles(context, min_dim, max_dim, workers, half_max_dim)
+                n_circles += sum([len(c) for c in circles])
+            t2 = time.clock()
+            duration = 1000 * (t2 - t1) / n_imgs
+            print("... workers: %d, half-sized up to dim: %d, circles: %d, time(ms/image): %f" % (workers, half_max_dim, n_circles, duration))
+
+
+def __detection_proposal_triangles(context, min_dim, max_dim):
+    """
+    Find the triangles (warning signs) of the image: the line segments of the edges are
+    classified by their angle to left and right sides of an upright triangle, then each pair
+    of left and right sides that meet at their top end (the apex) and have close lengths
+    makes a candidate triangle.
+    :param context: ProposalContext of the image
+    :param min_dim:
+    :param max_dim:
+    :return: the same as the circles, but the shapes are triangles, each is 3 vertices (apex, bottom-left, bottom-right)
+    """
+
+    img_blurred = context.img_blurred
+    img_edge = cv2.Canny(img_blurred.astype("uint8"), 10, 200, apertureSize=3)
+
+    # the side of the triangle is about the dim of the window around it
+    min_length = max(int(min_dim * 0.4), 5)
+    max_gap = max(int(min_dim * 0.1), 3)
+    lines = cv2.HoughLinesP(img_edge, 1, np.pi / 180, min_length, minLineLength=min_length, maxLineGap=max_gap)
+    if lines is None:
+        return [], [], [], []
+    lines = lines.reshape((lines.shape[0], 4)).astype(float)
+
+    # make the first point of each segment it's top point (the apex end of the side)
+    swap = lines[:, 1] > lines[:, 3]
+    lines[swap] = lines[swap][:, [2, 3, 0, 1]]
+    top_x, top_y, bottom_x, bottom_y = lines[:, 0], lines[:, 1], lines[:, 2], lines[:, 3]
+
+    # angle of the segment from it's top to it's bottom, 60 degrees for the right side
+    # and 120 for the left one (y-axis of the image is downwards)
+    angles = numpy.degrees(numpy.arctan2(bottom_y - top_y, bottom_x - top_x))
+    lengths = numpy.hypot(bottom_x - top_x, bottom_y - top_y)
+    angle_tolerance = 12
+    valid_length = numpy.logical_and(lengths >= min_length, lengths <= max_dim * 1.2)
+    right_idx = numpy.where(numpy.logical_and(numpy.abs(angles - 60) <= angle_tolerance, valid_length))[0]
+    left_idx = numpy.where(numpy.logical_and(numpy.abs(angles - 120) <= angle_tolerance, valid_length))[0]
+    if len(right_idx) == 0 or len(left_idx) == 0:
+        return [], [], [], []
+
+    # a side might be broken to many segments, extend each segment to the top/bottom
+    # ends of the segments that are on the same line
+    lines[left_idx] = __extend_collinear_segments(lines[left_idx], max_gap)
+    lines[right_idx] = __extend_collinear_segments(lines[right_idx], max_gap)
+    top_x, top_y, bottom_x, bottom_y = lines[:, 0], lines[:, 1], lines[:, 2], lines[:, 3]
+    lengths = numpy.hypot(bottom_x - top_x, bottom_y - top_y)
+
+    # pair all the left sides with all the right sides, a pair is a triangle if the sides
+    # meet at the apex (their top ends are close) and their lengths are close
+    l_top_x, l_top_y, l_length = top_x[left_idx][:, None], top_y[left_idx][:, None], lengths[left_idx][:, None]
+    r_top_x, r_top_y, r_length = top_x[right_idx][None, :], top_y[right_idx][None, :], lengths[right_idx][None, :]
+    apex_dist = numpy.hypot(l_top_x - r_top_x, l_top_y - r_top_y)
+    apex_tolerance = 0.2 * numpy.minimum(l_length, r_length) + max_gap
+    length_ratio = numpy.minimum(l_length, r_length) / numpy.maximum(l_length, r_length)
+    l_pairs, r_pairs = numpy.where(numpy.logical_and(apex_dist <= apex_tolerance, length_ratio >= 0.5))
+    if len(l_pairs) == 0:
+        return [], [], [], []
+    l_pairs = left_idx[l_pairs]
+    r_pairs = right_idx[r_pairs]
+
+    # the triangle is the apex (mean of the top ends) and the bottom ends of the sides
+    # complete the shorter side so the base is horizontal
+    apex_x = (top_x[l_pairs] + top_x[r_pairs]) / 2
+    apex_y = (top_y[l_pairs] + top_y[r_pairs]) / 2
+    base_y = numpy.maximum(bottom_y[l_pairs], bottom_y[r_pairs])
+    height = base_y - apex_y
+    half_base = height * numpy.tan(numpy.radians(30))
+    triangles = numpy.stack([apex_x, apex_y, apex_x - half_base, base_y, apex_x + half_base, base_y], axis=1)
+
+    # the region of the triangle is the square around it, it's dim is the base of the triangle
+    dims = 2 * half_base
+    valid_dim = numpy.logical_and(dims >= min_dim, dims <= max_dim)
+    triangles = triangles[valid_dim]
+    if len(triangles) == 0:
+        return [], [], [], []
+    center_x = triangles[:, 0]
+    center_y = (triangles[:, 1] + triangles[:, 3]) / 2
+    dim_half = (triangles[:, 4] - triangles[:, 2]) / 2
+    regions = numpy.transpose(numpy.asarray([center_x - dim_half, center_y - dim_half, center_x + dim_half, center_y + dim_half]))
+    regions = numpy.around(regions).astype(int)
+    triangles = numpy.around(triangles).astype(int).reshape((-1, 3, 2))
 
     # suppress the regions to extract the strongest ones
     min_overlap = 0
@@ -114,78 +599,178 @@ def __detection_proposal_circles(img_color, min_dim, max_dim):
     regions_weak, regions_strong = CNN.nms.suppression(boxes=regions, overlap_thresh=overlap_thresh, min_overlap=min_overlap)
 
     # create binary map using only the strong regions
-    img_shape = img_color.shape
+    img_shape = context.img_color.shape
     img_map = np.zeros(shape=(img_shape[0], img_shape[1]), dtype=bool)
     for r in regions_strong:
-        img_map[r[1]:r[3], r[0]:r[2]] = True
-    return regions_weak, regions_strong, img_map, circles
+        img_map[max(r[1], 0):r[3], max(r[0], 0):r[2]] = True
+    return regions_weak, regions_strong, img_map, triangles
 
 
-def __detection_proposal_triangles(img_color, min_dim, max_dim):
-    # pre-process the image for better detection
-    img_filtered = cv2.pyrMeanShiftFiltering(img_color, 10, 10)
-    img_filtered = cv2.cvtColor(img_filtered, cv2.COLOR_BGRA2GRAY)
-    img_filtered = img_filtered.astype(float)
-    img_blurred = cv2.GaussianBlur(img_filtered, (7, 7), sigmaX=0)
+def __detection_proposal_colors(context, min_dim, max_dim, superclass_type):
+    """
+    Find the blobs of the colors of the given superclass: red for prohibitory and warning signs
+    and blue for the mandatory ones (or both for all the superclasses). The colors are thresholded
+    in HSV then the connected components with the right dim and aspect ratio are the regions.
+    :param context: ProposalContext of the image
+    :param min_dim:
+    :param max_dim:
+    :param superclass_type:
+    :return: the same as the circles, but the shapes are the boxes of the blobs (x, y, width, height, area)
+    """
 
-    # img_laplacian = cv2.Laplacian(img_blurred, ddepth=cv2.CV_64F)
-    # img_laplacian_thresh = cv2.bitwise_not(img_laplacian.astype("uint8"))
-    # img_thresh = cv2.adaptiveThreshold(img_blurred.astype("uint8"), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-    # #image, contours, hierarchy = cv2.findContours(img_edge.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    img_hsv = context.img_hsv
+    hue = img_hsv[:, :, 0]
+    saturation = img_hsv[:, :, 1]
+    value = img_hsv[:, :, 2]
+
+    # hue of opencv is in the range [0, 180]
+    colorful = numpy.logical_and(saturation >= 70, value >= 40)
+    red = numpy.logical_and(colorful, numpy.logical_or(hue <= 10, hue >= 160))
+    blue = numpy.logical_and(colorful, numpy.logical_and(hue >= 100, hue <= 130))
+    if superclass_type == CNN.enums.SuperclassType._01_Prohibitory or superclass_type == CNN.enums.SuperclassType._02_Warning:
+        mask = red
+    elif superclass_type == CNN.enums.SuperclassType._03_Mandatory:
+        mask = blue
+    elif superclass_type == CNN.enums.SuperclassType._00_All:
+        mask = numpy.logical_or(red, blue)
+    else:
+        raise Exception("Sorry, non-supported superclass type to find detecttion proposal to.")
 
-    import math
+    # close the small gaps in the borders of the signs, then find the blobs
+    mask = mask.astype("uint8")
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, numpy.ones((3, 3), dtype="uint8"))
+    n_blobs, labels, blobs, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+    # first blob is the background, then keep only the blobs that can be traffic signs
+    blobs = blobs[1:]
+    x, y, w, h = blobs[:, cv2.CC_STAT_LEFT], blobs[:, cv2.CC_STAT_TOP], blobs[:, cv2.CC_STAT_WIDTH], blobs[:, cv2.CC_STAT_HEIGHT]
+    dims = numpy.maximum(w, h)
+    ratio = w / numpy.maximum(h, 1)
+    valid = numpy.logical_and(numpy.logical_and(dims >= min_dim, dims <= max_dim), numpy.logical_and(ratio >= 0.5, ratio <= 2))
+    blobs = blobs[valid]
+    if len(blobs) == 0:
+        return [], [], [], []
+
+    # the region of the blob is the square around it
+    x, y, w, h = blobs[:, cv2.CC_STAT_LEFT], blobs[:, cv2.CC_STAT_TOP], blobs[:, cv2.CC_STAT_WIDTH], blobs[:, cv2.CC_STAT_HEIGHT]
+    center_x = x + w / 2
+    center_y = y + h / 2
+    dim_half = numpy.maximum(w, h) / 2
+    regions = numpy.transpose(numpy.asarray([center_x - dim_half, center_y - dim_half, center_x + dim_half, center_y + dim_half]))
+    regions = numpy.around(regions).astype(int)
 
-    img_edge = cv2.Canny(img_blurred.astype("uint8"), 10, 200, apertureSize=3)
-    lines = []
-    for angle in [1]:
-        min_theta = math.radians(angle - 10)
-        max_theta = math.radians(angle + 10)
-        theta = math.radians(angle)
-        # new_lines = cv2.HoughLines(img_edge, 2, theta, 100)
-        # new_lines = cv2.HoughLines(img_edge, 1, theta, 10, min_theta=min_theta, max_theta=max_theta)
-        # new_lines = cv2.HoughLines(img_edge, 1, numpy.pi / 180, 10)
-        new_lines = cv2.HoughLinesP(img_edge, 1, np.pi / 180, 50, minLineLength=40, maxLineGap=10)
-        if new_lines is not None:
-            new_lines = new_lines.reshape(new_lines.shape[0], new_lines.shape[2])
-            lines.append(new_lines)
-
-    img_map = img_color.copy()
-    if len(lines) > 0:
-        lines = numpy.vstack(lines)
-    print("line counr %d " % (len(lines)))
-
-    # for probabilistic Hough
-    for x1, y1, x2, y2 in lines:
-        cv2.line(img_map, (x1, y1), (x2, y2), (0, 255, 0), 1)
-
-    # # # for typical Hough
-    # for rho, theta in lines[0:50]:
-    #     # print("rho %f, theta %f" % (rho, math.degrees(theta)))
-    #     a = np.cos(theta)
-    #     b = np.sin(theta)
-    #     x0 = a * rho
-    #     y0 = b * rho
-    #     x1 = int(x0 + 1000 * (-b))
-    #     y1 = int(y0 + 1000 * (a))
-    #     x2 = int(x0 - 1000 * (-b))
-    #     y2 = int(y0 - 1000 * (a))
-    #     cv2.line(img_map, (x1, y1), (x2, y2), (0, 0, 255), 2)
-
-    # color_red = (0, 255, 0)
-    # for contour in contours:
-    #     approx = cv2.approxPolyDP(contour, 0.01 * cv2.arcLength(contour, True), True)
-    #     cv2.drawContours(img_map, [contour], 0, color_red, 1)
-    # # if len(approx) == 3:
-
-    cv2.imwrite("D://_Dataset//GTSDB//Test_Regions//_img_01.png", img_map)
-    cv2.imwrite("D://_Dataset//GTSDB//Test_Regions//_img_02.png", img_edge)
-    return
-
-    regions_weak = []
-    regions_strong = []
-    triangles = []
+    # suppress the regions to extract the strongest ones
+    min_overlap = 0
+    overlap_thresh = 0.75
+    regions_weak, regions_strong = CNN.nms.suppression(boxes=regions, overlap_thresh=overlap_thresh, min_overlap=min_overlap)
 
-    return regions_weak, regions_strong, img_map, triangles
+    # create binary map using only the strong regions
+    img_shape = context.img_color.shape
+    img_map = np.zeros(shape=(img_shape[0], img_shape[1]), dtype=bool)
+    for r in regions_strong:
+        img_map[max(r[1], 0):r[3], max(r[0], 0):r[2]] = True
+    return regions_weak, regions_strong, img_map, blobs
+
+
+def benchmark_proposal_types(img_pathes, gt_path, min_dim=16, max_dim=160, superclass_type=CNN.enums.SuperclassType._01_Prohibitory,
+                             overlap_thresh=0.5):
+    """
+    Compare the recall and the time (milli-sec. per image, including the pre-processing)
+    of the hough and color proposals on GTSDB images
+    :param img_pathes: pathes of GTSDB images, named by their ids, i.e. 00001.ppm or 00001.png
+    :param gt_path: the ground truth file gt.txt of GTSDB
+    :param min_dim:
+    :param max_dim:
+    :param superclass_type:
+    :param overlap_thresh: a ground truth is found if the IoU of a strong region with it is bigger than this
+    :return:
+    """
+
+    if superclass_type == CNN.enums.SuperclassType._01_Prohibitory:
+        classes = CNN.consts.ClassesIDs.PROHIB_CLASSES
+    elif superclass_type == CNN.enums.SuperclassType._02_Warning:
+        classes = CNN.consts.ClassesIDs.WARNING_CLASSES
+    elif superclass_type == CNN.enums.SuperclassType._03_Mandatory:
+        classes = CNN.consts.ClassesIDs.MANDATORY_CLASSES
+    else:
+        raise Exception("Sorry, un-recognized super-class type")
+
+    # ground truth of the images, each row is: file name;x1;y1;x2;y2;class id
+    gt_boxes = {}
+    with open(gt_path, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter=';', quotechar='|')
+        for row in reader:
+            if int(row[5]) in classes:
+                img_id = int(row[0][:-4])
+                gt_boxes.setdefault(img_id, []).append([int(col) for col in row[1:5]])
+
+    imgs = []
+    for img_path in img_pathes:
+        img_id = int(img_path.replace("\\", "/").split("/")[-1][:-4])
+        imgs.append((cv2.imread(img_path), numpy.asarray(gt_boxes.get(img_id, []))))
+
+    n_imgs = len(imgs)
+    n_gt = sum([len(b) for i, b in imgs])
+    for proposal_type in [CNN.enums.ProposalType.hough, CNN.enums.ProposalType.color]:
+        n_found = 0
+        n_regions = 0
+        duration = 0
+        for img_color, boxes in imgs:
+            t1 = time.clock()
+            regions_weak, regions_strong, img_map, shapes = detection_proposal(img_color, min_dim, max_dim, superclass_type, proposal_type=proposal_type)
+            t2 = time.clock()
+            duration += t2 - t1
+            n_regions += len(regions_strong)
+            if len(boxes) == 0 or len(regions_strong) == 0:
+                continue
+
+            # IoU of each ground truth with each strong region
+            boxes = boxes[:, None, :]
+            regions = numpy.asarray(regions_strong)[None, :, :]
+            w = numpy.maximum(0, numpy.minimum(boxes[:, :, 2], regions[:, :, 2]) - numpy.maximum(boxes[:, :, 0], regions[:, :, 0]))
+            h = numpy.maximum(0, numpy.minimum(boxes[:, :, 3], regions[:, :, 3]) - numpy.maximum(boxes[:, :, 1], regions[:, :, 1]))
+            intersection = w * h
+            area_boxes = (boxes[:, :, 2] - boxes[:, :, 0]) * (boxes[:, :, 3] - boxes[:, :, 1])
+            area_regions = (regions[:, :, 2] - regions[:, :, 0]) * (regions[:, :, 3] - regions[:, :, 1])
+            iou = intersection / (area_boxes + area_regions - intersection)
+            n_found += numpy.sum(numpy.any(iou >= overlap_thresh, axis=1))
+
+        recall = 100 * n_found / max(n_gt, 1)
+        print("... %s proposals, recall: %f%% (%d/%d), regions/image: %f, time(ms/image): %f"
+              % (proposal_type.name, recall, n_found, n_gt, n_regions / n_imgs, 1000 * duration / n_imgs))
+
+
+def __extend_collinear_segments(lines, tolerance):
+    """
+    For each segment, find the segments on the same line (their ends are close to it's line and
+    not far from it along the line) and extend the segment to the top-most and the bottom-most ends
+    :param lines: segments of shape (n, 4), each is (top x, top y, bottom x, bottom y)
+    :param tolerance: max distance (pixels) of the ends of a segment from the line of the other one
+    :return: the extended segments
+    """
+
+    top_x, top_y, bottom_x, bottom_y = lines[:, 0], lines[:, 1], lines[:, 2], lines[:, 3]
+    lengths = numpy.maximum(numpy.hypot(bottom_x - top_x, bottom_y - top_y), 1)
+    dir_x = ((bottom_x - top_x) / lengths)[:, None]
+    dir_y = ((bottom_y - top_y) / lengths)[:, None]
+
+    # distance of the ends of segment j from the line of segment i (across and along the line)
+    d_top_x = top_x[None, :] - top_x[:, None]
+    d_top_y = top_y[None, :] - top_y[:, None]
+    d_bottom_x = bottom_x[None, :] - top_x[:, None]
+    d_bottom_y = bottom_y[None, :] - top_y[:, None]
+    across = numpy.maximum(numpy.abs(d_top_x * dir_y - d_top_y * dir_x), numpy.abs(d_bottom_x * dir_y - d_bottom_y * dir_x))
+    along_top = d_top_x * dir_x + d_top_y * dir_y
+    along_bottom = d_bottom_x * dir_x + d_bottom_y * dir_y
+    length = lengths[:, None]
+    near = numpy.logical_and(along_bottom >= -tolerance, along_top <= length + tolerance)
+    collinear = numpy.logical_and(across <= tolerance, near)
+
+    # the top-most and the bottom-most ends of the collinear segments (each segment is collinear with itself)
+    top_j = numpy.argmin(numpy.where(collinear, top_y[None, :], numpy.inf), axis=1)
+    bottom_j = numpy.argmax(numpy.where(collinear, bottom_y[None, :], -numpy.inf), axis=1)
+    extended = numpy.stack([top_x[top_j], top_y[top_j], bottom_x[bottom_j], bottom_y[bottom_j]], axis=1)
+    return extended
 
 
 def __proposal_old(img_preprocessed, min_dim, max_dim):
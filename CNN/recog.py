@@ -22,7 +22,9 @@ References:
 
 import os
 import sys
+import math
 import time
+import concurrent.futures
 import cv2
 import PIL
 import PIL.Image
@@ -48,6 +50,7 @@ import CNN.mlp
 import CNN.conv
 from CNN.mlp import HiddenLayer
 import CNN.enums
+import CNN.npnet
 
 # region Train Class Classifier
 
@@ -268,25 +271,14 @@ def train_shallow(dataset_path, model_path='', img_dim=28, learning_rate=0.1, n_
     if len(model_path) == 0:
         return
 
-    # serialize the params of the model
-    # the -1 is for HIGHEST_PROTOCOL
-    # this will overwrite current contents and it triggers much more efficient storage than numpy's default
-    save_file = open(model_path, 'wb')
-    pickle.dump(dataset_path, save_file, -1)
-    pickle.dump(img_dim, save_file, -1)
-    pickle.dump(kernel_dim, save_file, -1)
-    pickle.dump(nkerns, save_file, -1)
-    pickle.dump(mlp_layers, save_file, -1)
-    pickle.dump(pool_size, save_file, -1)
-    pickle.dump(layer0.W.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer0.b.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer1.W.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer1.b.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer2.W.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer2.b.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer3.W.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer3.b.get_value(borrow=True), save_file, -1)
-    save_file.close()
+    # serialize the params of the model, if the model path has .bin extension
+    # then it's saved in the binary format (memory-mapped when loaded), else it's pickled
+    CNN.utils.save_model(model_path, [
+        dataset_path, img_dim, kernel_dim, nkerns, mlp_layers, pool_size,
+        layer0.W.get_value(borrow=True), layer0.b.get_value(borrow=True),
+        layer1.W.get_value(borrow=True), layer1.b.get_value(borrow=True),
+        layer2.W.get_value(borrow=True), layer2.b.get_value(borrow=True),
+        layer3.W.get_value(borrow=True), layer3.b.get_value(borrow=True)])
 
 
 def train_deep(dataset_path, model_path='', img_dim=80, learning_rate=0.1, n_epochs=200, kernel_dim=(9, 7, 4), nkerns=(10, 58, 360),
@@ -520,27 +512,15 @@ def train_deep(dataset_path, model_path='', img_dim=80, learning_rate=0.1, n_epo
     if len(model_path) == 0:
         return
 
-    # serialize the params of the model
-    # the -1 is for HIGHEST_PROTOCOL
-    # this will overwrite current contents and it triggers much more efficient storage than numpy's default
-    save_file = open(model_path, 'wb')
-    pickle.dump(dataset_path, save_file, -1)
-    pickle.dump(img_dim, save_file, -1)
-    pickle.dump(kernel_dim, save_file, -1)
-    pickle.dump(nkerns, save_file, -1)
-    pickle.dump(mlp_layers, save_file, -1)
-    pickle.dump(pool_size, save_file, -1)
-    pickle.dump(layer0.W.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer0.b.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer1.W.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer1.b.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer2.W.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer2.b.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer3.W.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer3.b.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer4.W.get_value(borrow=True), save_file, -1)
-    pickle.dump(layer4.b.get_value(borrow=True), save_file, -1)
-    save_file.close()
+    # serialize the params of the model, if the model path has .bin extension
+    # then it's saved in the binary format (memory-mapped when loaded), else it's pickled
+    CNN.utils.save_model(model_path, [
+        dataset_path, img_dim, kernel_dim, nkerns, mlp_layers, pool_size,
+        layer0.W.get_value(borrow=True), layer0.b.get_value(borrow=True),
+        layer1.W.get_value(borrow=True), layer1.b.get_value(borrow=True),
+        layer2.W.get_value(borrow=True), layer2.b.get_value(borrow=True),
+        layer3.W.get_value(borrow=True), layer3.b.get_value(borrow=True),
+        layer4.W.get_value(borrow=True), layer4.b.get_value(borrow=True)])
 
 
 def train_deep_lasagne(dataset_path, model_path='', img_dim=80, learning_rates=(0.02, 0.005), momentums=(0.9, 0.95),
@@ -1187,20 +1167,131 @@ def resume_training_lasagne(dataset_path, model_path, learning_rates=(0.05, 0.00
 #  region Test Classification/Recognition
 
 def classify_imgs_from_files(imgs_pathes, model_path, classifier=CNN.enums.ClassifierType.logit, img_dim=28, is_rgb=False):
-    imgs = []
-    for path in imgs_pathes:
-        img = []
-        if is_rgb:
-            img = CNN.utils.rgb_to_gs(path)
-            img = img.astype(dtype='float64') / 255.0
-        else:
-            img = PIL.Image.open(path)
-            img = numpy.asarray(img, dtype='float64') / 255.0
-        imgs.append(img)
+    # the images are not pre-processed, only converted to gray-scale and resized to the
+    # dimension of the model, so img_dim and is_rgb are not needed anymore, they are kept for compatibility
+    results = list(classify_paths(imgs_pathes, model_path, classifier=classifier, preprocess=False))
+    c_result = numpy.asarray([r[1] for r in results])
+    c_prob = numpy.asarray([r[2] for r in results])
+    return c_result, c_prob
+
+
+def classify_paths(paths, model_path, batch_size=100, model_type=CNN.enums.ModelType._01_conv2_mlp2,
+                   classifier=CNN.enums.ClassifierType.logit, preprocess=True, n_workers=4):
+    """
+    Classify the images of the given pathes, batch by batch. The images are read and pre-processed
+    by a pool of workers while the previous batch is being classified by one compiled function.
+    The results are yielded in the same order of the pathes.
+    :param paths:
+    :param model_path:
+    :param batch_size: the last batch is zero-padded if needed
+    :param model_type:
+    :param classifier:
+    :param preprocess: pre-process the images using CNN.utils.preprocess_image, otherwise they are
+    only converted to gray-scale and normalized
+    :param n_workers: number of workers to read and pre-process the images
+    :return: generator of (path, class, class probabilities)
+    """
+
+    loaded_objects = CNN.utils.load_model(model_path, model_type)
+    img_dim = loaded_objects[1]
+    classify_fn = __build_classify_fn(loaded_objects, batch_size, model_type, classifier)
+
+    paths = list(paths)
+    n_paths = len(paths)
+    batch = numpy.zeros(shape=(batch_size, 1, img_dim, img_dim), dtype="float32")
+
+    def read_batch(idx_start):
+        batch_paths = paths[idx_start: idx_start + batch_size]
+        return [pool.submit(__read_img, path, img_dim, preprocess) for path in batch_paths]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+        # read the next batch while the current one is being classified
+        futures = read_batch(0)
+        for idx_start in range(0, n_paths, batch_size):
+            current_futures = futures
+            futures = read_batch(idx_start + batch_size)
+
+            n_imgs = len(current_futures)
+            for i, future in enumerate(current_futures):
+                batch[i, 0] = future.result()
+            batch[n_imgs:] = 0
+
+            t1 = time.clock()
+            c_result, c_prob = classify_fn(batch)
+            t2 = time.clock()
+            print("... batch: %d/%d, time(sec.): %f" % (int(idx_start / batch_size) + 1, int(math.ceil(n_paths / batch_size)), t2 - t1))
+
+            for i in range(n_imgs):
+                yield paths[idx_start + i], c_result[i], c_prob[i]
+
+
+def __read_img(path, img_dim, preprocess):
+    img = cv2.imread(path)
+    if preprocess:
+        img = CNN.utils.preprocess_image(img, img_dim)
+    else:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if img.shape != (img_dim, img_dim):
+            img = cv2.resize(img, dsize=(img_dim, img_dim), interpolation=cv2.INTER_AREA)
+        img = img.astype("float32") / 255.0
+    return img
+
+
+def __build_classify_fn(loaded_objects, batch_size, model_type=CNN.enums.ModelType._01_conv2_mlp2,
+                        classifier=CNN.enums.ClassifierType.logit):
+    """
+    Compile the conv+pool, hidden and logit/svm layers of the given model in one function
+    that takes a batch of images and returns the classes and the class probabilities
+    """
 
-    n = imgs.shape[1]
-    imgs = numpy.asarray(imgs.shape[0], n * n)
-    classify_batch(imgs, model_path, classifier)
+    if model_type == CNN.enums.ModelType._01_conv2_mlp2:
+        n_conv_layers = 2
+    elif model_type == CNN.enums.ModelType._02_conv3_mlp2:
+        n_conv_layers = 3
+    else:
+        raise Exception("Unknown model type")
+
+    img_dim = loaded_objects[1]
+    kernel_dim = loaded_objects[2]
+    nkerns = loaded_objects[3]
+    mlp_layers = loaded_objects[4]
+    pool_size = loaded_objects[5]
+
+    # conv+pool layers, each layer takes the output of the previous one
+    layer0_input = T.tensor4(name='input')
+    layer_input = layer0_input
+    layer_img_dim = img_dim
+    layer_n_maps = 1
+    for i in range(n_conv_layers):
+        W = theano.shared(loaded_objects[6 + 2 * i], borrow=True)
+        b = theano.shared(loaded_objects[7 + 2 * i], borrow=True)
+        layer_input = CNN.conv.convpool_layer(input=layer_input, W=W, b=b,
+                                              image_shape=(batch_size, layer_n_maps, layer_img_dim, layer_img_dim),
+                                              filter_shape=(nkerns[i], layer_n_maps, kernel_dim[i], kernel_dim[i]),
+                                              pool_size=pool_size)
+        layer_img_dim = int((layer_img_dim - kernel_dim[i] + 1) / 2)
+        layer_n_maps = nkerns[i]
+
+    # hidden layer
+    idx = 6 + 2 * n_conv_layers
+    hidden_W = theano.shared(loaded_objects[idx], borrow=True)
+    hidden_b = theano.shared(loaded_objects[idx + 1], borrow=True)
+    hidden_n_in = layer_n_maps * layer_img_dim * layer_img_dim
+    hidden_layer = CNN.mlp.HiddenLayer(input=layer_input.flatten(2), W=hidden_W, b=hidden_b, n_in=hidden_n_in,
+                                       n_out=mlp_layers[0], activation=T.tanh, rng=0)
+
+    # logit (logistic regression) or SVM
+    output_W = theano.shared(loaded_objects[idx + 2], borrow=True)
+    output_b = theano.shared(loaded_objects[idx + 3], borrow=True)
+    if classifier == CNN.enums.ClassifierType.logit:
+        output_y, output_y_prob = CNN.logit.logit_layer(input=hidden_layer.output, W=output_W, b=output_b)
+    elif classifier == CNN.enums.ClassifierType.svm:
+        output_y, output_y_prob = CNN.svm.svm_layer(input=hidden_layer.output, W=output_W, b=output_b)
+    else:
+        raise TypeError('Unknown classifier type, should be either logit or svm', ('classifier:', classifier))
+
+    classify_fn = theano.function([layer0_input], [output_y, output_y_prob])
+    return classify_fn
 
 
 def classify_img_from_file(img_path, img_dim, model_path, model_type=CNN.enums.ModelType._01_conv2_mlp2,
@@ -1233,9 +1324,17 @@ def classify_img_from_dataset(dataset_path, model_path, index, classifier=CNN.en
     # img4D = img.reshape(1, 1, img_dim, img_dim)
 
 
-def classify_batch(batch, model_path, classifier=CNN.enums.ClassifierType.logit):
+def classify_batch(batch, model_path, classifier=CNN.enums.ClassifierType.logit, backend=CNN.enums.BackendType.theano):
     loaded_objects = CNN.utils.load_model(model_path)
 
+    # numpy backend doesn't need to compile the model before classifying
+    if backend == CNN.enums.BackendType.numpy:
+        start_time = time.clock()
+        c_result, c_prob = CNN.npnet.classify_batch(batch, loaded_objects, CNN.enums.ModelType._01_conv2_mlp2)
+        end_time = time.clock()
+        duration = end_time - start_time
+        return c_result, c_prob, duration
+
     img_dim = loaded_objects[1]
     kernel_dim = loaded_objects[2]
     nkerns = loaded_objects[3]
@@ -0,0 +1,520 @@
+"""
+Extract the regions of the detection proposals from the gray-scale image, resize them to
+the input dim of the model and equalize their histogram, all the regions in one go. This is
+the batched counterpart of cropping each region then calling skimage.transform.resize and
+skimage.exposure.equalize_hist on it.
+"""
+
+import time
+import numpy
+import numpy.lib.stride_tricks
+
+import cv2
+
+import skimage
+import skimage.transform
+import skimage.exposure
+
+
+class RegionBatcher(object):
+    """
+    Crop the given boxes from the gray-scale image, resize them using opencv and equalize their
+    histogram using numpy, vectorized over the regions. The regions are written in a preallocated
+    buffer of shape (n, 1, img_dim, img_dim) that is ready to be passed to the detectors.
+    In case of shared_lut, the regions of a proposal at different scales (which are nested) are
+    equalized using the histogram of the biggest one, see extract_at_scales.
+    """
+
+    def __init__(self, img_dim=80, equalize=True, nbins=256, interpolation=cv2.INTER_LINEAR, shared_lut=False):
+        """
+        :param img_dim: dim of the regions after resizing
+        :param equalize: equalize the histogram of the regions
+        :param nbins: number of bins of the histogram, same as skimage.exposure.equalize_hist
+        :param interpolation: opencv interpolation used for resizing, linear is the same as skimage
+        :param shared_lut: equalize the regions of the same proposal using one lookup table
+        """
+        self.img_dim = img_dim
+        self.equalize = equalize
+        self.nbins = nbins
+        self.interpolation = interpolation
+        self.shared_lut = shared_lut
+
+    def extract(self, img, boxes, out=None):
+        """
+        :param img: gray-scale image, either uint8 or float in the range [0, 1]
+        :param boxes: array of shape (n, 4), each is x1, y1, x2, y2
+        :param out: buffer to write the regions to, of shape at least (n, 1, img_dim, img_dim) and of type float32
+        it's allocated if not given. Note that the rest of the buffer (the padding) is not touched.
+        :return: the buffer
+        """
+
+        img_dim = self.img_dim
+        boxes = numpy.asarray(boxes, dtype=int).reshape((-1, 4))
+        n_regions = boxes.shape[0]
+
+        if out is None:
+            out = numpy.zeros(shape=(n_regions, 1, img_dim, img_dim), dtype="float32")
+        elif out.shape[0] < n_regions or out.shape[-2:] != (img_dim, img_dim) or out.dtype != numpy.float32:
+            raise Exception("Sorry, the buffer doesn't fit the regions")
+
+        # the same as skimage, uint8 images are converted to float in the range [0, 1]
+        if img.dtype == numpy.uint8:
+            img = img.astype("float32") / 255.0
+        else:
+            img = img.astype("float32", copy=False)
+
+        # boxes partially out of the image are clipped to it
+        img_height, img_width = img.shape[0:2]
+        x1 = numpy.clip(boxes[:, 0], 0, img_width)
+        y1 = numpy.clip(boxes[:, 1], 0, img_height)
+        x2 = numpy.clip(boxes[:, 2], 0, img_width)
+        y2 = numpy.clip(boxes[:, 3], 0, img_height)
+
+        regions = out[0:n_regions].reshape((n_regions, img_dim, img_dim))
+        for i in range(n_regions):
+            if x2[i] <= x1[i] or y2[i] <= y1[i]:
+                regions[i] = 0
+                continue
+            cv2.resize(img[y1[i]:y2[i], x1[i]:x2[i]], dsize=(img_dim, img_dim), dst=regions[i], interpolation=self.interpolation)
+
+        if self.equalize:
+            regions[:] = equalize_hist_batch(regions, self.nbins)
+
+        return out
+
+    def extract_at_scales(self, img, proposals, scales, out=None):
+        """
+        Extract the regions of each of the given proposals at each of the given scales, see boxes_at_scales.
+        In case of shared_lut, the cdf is computed only once per proposal, on the biggest of it's regions,
+        then applied as a lookup table on it. The other regions are nested in it, so they are cropped from
+        it then resized. It's not the same as equalizing each region after resizing, but much faster.
+        :param img: gray-scale image, either uint8 or float in the range [0, 1]
+        :param proposals: array of shape (n, 4), each is x1, y1, x2, y2
+        :param scales:
+        :param out: buffer to write the regions to, see extract
+        :return: the buffer, the boxes of the regions and their dims
+        """
+
+        boxes, dims = boxes_at_scales(proposals, scales)
+        if not (self.equalize and self.shared_lut):
+            return self.extract(img, boxes, out), boxes, dims
+
+        img_dim = self.img_dim
+        n_regions = boxes.shape[0]
+        n_scales = len(scales)
+        if out is None:
+            out = numpy.zeros(shape=(n_regions, 1, img_dim, img_dim), dtype="float32")
+        elif out.shape[0] < n_regions or out.shape[-2:] != (img_dim, img_dim) or out.dtype != numpy.float32:
+            raise Exception("Sorry, the buffer doesn't fit the regions")
+
+        # the lookup table is of the 256 gray levels
+        if img.dtype != numpy.uint8:
+            img = numpy.around(img * 255).astype(numpy.uint8)
+
+        img_height, img_width = img.shape[0:2]
+        boxes_clipped = numpy.transpose(numpy.asarray([numpy.clip(boxes[:, 0], 0, img_width), numpy.clip(boxes[:, 1], 0, img_height),
+                                                       numpy.clip(boxes[:, 2], 0, img_width), numpy.clip(boxes[:, 3], 0, img_height)]))
+
+        regions = out[0:n_regions].reshape((n_regions, img_dim, img_dim))
+        for i in range(0, n_regions, n_scales):
+            # the biggest region of the proposal, it contains the others
+            idx = numpy.arange(i, i + n_scales)
+            idx_biggest = idx[numpy.argmax(dims[idx])]
+            bx1, by1, bx2, by2 = boxes_clipped[idx_biggest]
+            if bx2 <= bx1 or by2 <= by1:
+                regions[idx] = 0
+                continue
+
+            region_biggest = img[by1:by2, bx1:bx2]
+            lut = equalization_lut(region_biggest, self.nbins)
+            region_biggest = lut[region_biggest]
+
+            for j in idx:
+                x1, y1, x2, y2 = boxes_clipped[j]
+                if x2 <= x1 or y2 <= y1:
+                    regions[j] = 0
+                    continue
+                # the region relative to the biggest one
+                x1, x2 = max(x1, bx1) - bx1, min(x2, bx2) - bx1
+                y1, y2 = max(y1, by1) - by1, min(y2, by2) - by1
+                cv2.resize(region_biggest[y1:y2, x1:x2], dsize=(img_dim, img_dim), dst=regions[j], interpolation=self.interpolation)
+
+        return out, boxes, dims
+
+
+class ImagePyramid(object):
+    """
+    Sliding windows of different dims over the gray-scale image, without resizing each window.
+    Instead, the image is resized once per window dim so the window maps to exactly img_dim,
+    then the windows of this level are a strided view of it (no copying). The windows are only
+    copied (and equalized) chunk by chunk when they are passed to the detector.
+    """
+
+    def __init__(self, img, img_dim=80, stride_factor=0.1, equalize=True):
+        """
+        :param img: gray-scale image, either uint8 or float in the range [0, 1]
+        :param img_dim: dim of the input of the model
+        :param stride_factor: stride of the windows as a fraction of the window dim
+        :param equalize: equalize the histogram of the windows
+        """
+
+        if img.dtype == numpy.uint8:
+            img = img.astype("float32") / 255.0
+        self.img = img.astype("float32", copy=False)
+        self.img_dim = img_dim
+        self.stride = max(int(img_dim * stride_factor), 1)
+        self.equalize = equalize
+        self.__levels = {}
+
+    def level(self, window_dim):
+        """
+        The image resized so the window of the given dim becomes of img_dim, padded (by replicating
+        the border) so the last window of each row/column exceeds the image as in CNN.prop.window_origins.
+        The levels are built when first needed, then kept.
+        :return: the resized image and the scale factor
+        """
+
+        if window_dim in self.__levels:
+            return self.__levels[window_dim]
+
+        img_height, img_width = self.img.shape[0:2]
+        factor = self.img_dim / float(window_dim)
+        level_width = max(int(round(img_width * factor)), 1)
+        level_height = max(int(round(img_height * factor)), 1)
+        img_level = cv2.resize(self.img, dsize=(level_width, level_height), interpolation=cv2.INTER_AREA if factor < 1 else cv2.INTER_LINEAR)
+        img_level = cv2.copyMakeBorder(img_level, 0, self.img_dim, 0, self.img_dim, cv2.BORDER_REPLICATE)
+        self.__levels[window_dim] = (img_level, factor)
+        return img_level, factor
+
+    def windows(self, window_dim):
+        """
+        All the windows of the given dim, as a view of shape (n_rows, n_cols, img_dim, img_dim)
+        :return: the windows and the top-left corners of the windows in the image of shape (n_rows, n_cols, 2), each is (x, y)
+        """
+
+        img_level, factor = self.level(window_dim)
+        img_dim = self.img_dim
+        stride = self.stride
+
+        # the windows that start inside the image, same as CNN.prop.window_origins
+        level_height = img_level.shape[0] - img_dim
+        level_width = img_level.shape[1] - img_dim
+        n_rows = min(int(numpy.sum(numpy.arange(0, level_height + 1, stride) + img_dim <= level_height)) + 1, int(level_height / stride) + 1)
+        n_cols = min(int(numpy.sum(numpy.arange(0, level_width + 1, stride) + img_dim <= level_width)) + 1, int(level_width / stride) + 1)
+
+        windows = numpy.lib.stride_tricks.sliding_window_view(img_level, (img_dim, img_dim))[::stride, ::stride]
+        windows = windows[0:n_rows, 0:n_cols]
+
+        # locations of the windows in the image
+        ys = numpy.around(numpy.arange(n_rows) * stride / factor).astype(int)
+        xs = numpy.around(numpy.arange(n_cols) * stride / factor).astype(int)
+        y, x = numpy.meshgrid(ys, xs, indexing="ij")
+        locations = numpy.stack([x, y], axis=2)
+
+        return windows, locations
+
+    def chunks(self, window_dims, chunk_size=256):
+        """
+        Iterate on the windows of all the given dims, in chunks ready to be passed to the detector
+        :return: generator of (index of the window dim, windows of shape (n, 1, img_dim, img_dim), their locations of shape (n, 2))
+        the windows of a chunk belong to only one window dim, the last chunk of each window dim can be smaller than the chunk size
+        """
+
+        img_dim = self.img_dim
+        for i, window_dim in enumerate(window_dims):
+            windows, locations = self.windows(window_dim)
+            n_rows, n_cols = windows.shape[0:2]
+            n_windows = n_rows * n_cols
+            locations = locations.reshape((n_windows, 2))
+
+            for idx_start in range(0, n_windows, chunk_size):
+                idx_stop = min(idx_start + chunk_size, n_windows)
+                rows, cols = numpy.unravel_index(numpy.arange(idx_start, idx_stop), (n_rows, n_cols))
+
+                # only the windows of the chunk are copied
+                chunk = windows[rows, cols].reshape((idx_stop - idx_start, 1, img_dim, img_dim))
+                if self.equalize:
+                    chunk = equalize_hist_batch(chunk)
+                yield i, chunk, locations[idx_start:idx_stop]
+
+
+def boxes_at_scales(proposals, scales):
+    """
+    For each proposal, the square boxes with the same center of the proposal and with
+    dim of the max dim of the proposal multiplied by each of the given scales
+    :param proposals: array of shape (n, 4), each is x1, y1, x2, y2
+    :param scales:
+    :return: the boxes of shape (n * n_scales, 4) ordered by proposal then scale, and the dim of each box
+    """
+
+    proposals = numpy.asarray(proposals, dtype=int).reshape((-1, 4))
+    scales = numpy.asarray(scales, dtype=float)
+
+    w = proposals[:, 2] - proposals[:, 0]
+    h = proposals[:, 3] - proposals[:, 1]
+    window_dim = numpy.maximum(h, w)
+    center_x = (proposals[:, 0] + numpy.round(w / 2)).astype(int)
+    center_y = (proposals[:, 1] + numpy.round(h / 2)).astype(int)
+
+    dims = window_dim[:, None] * scales[None, :]
+    dims_half = numpy.round(dims / 2).astype(int).ravel()
+    dims = numpy.round(dims).astype(int).ravel()
+    center_x = numpy.repeat(center_x, len(scales))
+    center_y = numpy.repeat(center_y, len(scales))
+
+    boxes = numpy.transpose(numpy.asarray([center_x - dims_half, center_y - dims_half, center_x + dims_half, center_y + dims_half]))
+    return boxes, dims
+
+
+def equalize_hist_batch(regions, nbins=256):
+    """
+    Same as skimage.exposure.equalize_hist applied on each of the given regions, but vectorized
+    :param regions: array of shape (n, ...), each region is equalized on it's own
+    :param nbins:
+    :return: the equalized regions, of the same shape and type
+    """
+
+    shape = regions.shape
+    dtype = regions.dtype
+    n_regions = shape[0]
+    x = regions.reshape((n_regions, -1)).astype(float)
+    n_pixels = x.shape[1]
+
+    # the histogram of each region spans the range of it's values, as skimage.exposure.histogram
+    x_min = x.min(axis=1, keepdims=True)
+    x_max = x.max(axis=1, keepdims=True)
+    x_range = x_max - x_min
+    flat = x_range[:, 0] == 0
+    x_range[flat] = 1
+
+    # bin of each pixel, the max value goes to the last bin same as numpy.histogram
+    t = (x - x_min) / x_range * nbins
+    bins = numpy.minimum(t.astype(int), nbins - 1)
+    bins += numpy.arange(n_regions)[:, None] * nbins
+    hist = numpy.bincount(bins.ravel(), minlength=n_regions * nbins).reshape((n_regions, nbins))
+    cdf = numpy.cumsum(hist, axis=1) / float(n_pixels)
+
+    # interpolate the cdf at the bin centers, the centers are evenly spaced so the position
+    # of the pixel between them is computed directly, clipped to the first/last center as numpy.interp
+    t = numpy.clip(t - 0.5, 0, nbins - 1)
+    idx = numpy.minimum(t.astype(int), nbins - 2)
+    frac = t - idx
+    rows = numpy.arange(n_regions)[:, None]
+    y = cdf[rows, idx] * (1 - frac) + cdf[rows, idx + 1] * frac
+
+    # same as skimage, a region of constant value is in the middle of it's histogram
+    y[flat] = 0.5
+
+    return y.reshape(shape).astype(dtype, copy=False)
+
+
+def equalization_lut(region, nbins=256):
+    """
+    The lookup table of the 256 gray levels that equalizes the histogram of the given region,
+    applying it on the region is the same as skimage.exposure.equalize_hist on the region (as float)
+    :param region: uint8 region
+    :param nbins:
+    :return: float32 array of 256 values
+    """
+
+    counts = numpy.bincount(region.ravel(), minlength=256)
+    levels = numpy.arange(256, dtype=float)
+    v_min = float(region.min())
+    v_max = float(region.max())
+    if v_max == v_min:
+        return numpy.full(256, 0.5, dtype="float32")
+
+    # the histogram spans the range of the region, each level goes to one bin
+    t = (levels - v_min) / (v_max - v_min) * nbins
+    bins = numpy.clip(t.astype(int), 0, nbins - 1)
+    hist = numpy.bincount(bins, weights=counts, minlength=nbins)
+    cdf = numpy.cumsum(hist) / float(region.size)
+
+    # interpolate the cdf at the bin centers, as equalize_hist_batch
+    t = numpy.clip(t - 0.5, 0, nbins - 1)
+    idx = numpy.minimum(t.astype(int), nbins - 2)
+    frac = t - idx
+    lut = cdf[idx] * (1 - frac) + cdf[idx + 1] * frac
+    return lut.astype("float32")
+
+
+def check_region_batcher(img_path, img_dim=80, n_boxes=500, min_dim=20, max_dim=160):
+    """
+    Extract random boxes from the given image using skimage (one region at a time)
+    and using the RegionBatcher, print the max/mean difference and the time of each
+    """
+
+    img = cv2.imread(img_path)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    img = img.astype(float) / 255.0
+    img_height, img_width = img.shape
+
+    rng = numpy.random.RandomState(1234)
+    dims = rng.randint(low=min_dim, high=max_dim, size=n_boxes)
+    x1 = rng.randint(low=0, high=img_width - max_dim, size=n_boxes)
+    y1 = rng.randint(low=0, high=img_height - max_dim, size=n_boxes)
+    boxes = numpy.transpose(numpy.asarray([x1, y1, x1 + dims, y1 + dims]))
+
+    t1 = time.clock()
+    regions_skimage = []
+    for box in boxes:
+        region = img[box[1]:box[3], box[0]:box[2]]
+        region = skimage.transform.resize(region, output_shape=(img_dim, img_dim))
+        region = skimage.exposure.equalize_hist(region)
+        regions_skimage.append(region)
+    regions_skimage = numpy.asarray(regions_skimage)
+    t2 = time.clock()
+    duration_skimage = t2 - t1
+
+    t1 = time.clock()
+    regions_batched = RegionBatcher(img_dim).extract(img, boxes)
+    t2 = time.clock()
+    duration_batched = t2 - t1
+
+    diff = numpy.abs(regions_skimage - regions_batched.reshape(regions_skimage.shape))
+    print("... max difference: %f, mean difference: %f" % (diff.max(), diff.mean()))
+    print("... time(sec.) skimage: %f, batched: %f" % (duration_skimage, duration_batched))
+    return diff.max(), diff.mean(), duration_skimage, duration_batched
+
+
+def benchmark_image_pyramid(img_path, img_dim=80, min_dim=20, max_dim=160, down_scale_factor=0.9, stride_factor=0.1):
+    """
+    Extract all the sliding windows of the dims from max_dim down to min_dim (as CNN.detec.detect_from_file
+    without proposals) by resizing each window, and using the ImagePyramid, print the time of each.
+    The windows are not equalized, so only the time of extracting/resizing them is compared.
+    """
+    import CNN.prop
+
+    img = cv2.imread(img_path)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    img = img.astype("float32") / 255.0
+    img_height, img_width = img.shape
+
+    window_dims = []
+    window_dim = max_dim
+    while window_dim >= min_dim:
+        window_dims.append(window_dim)
+        window_dim = int(window_dim * down_scale_factor)
+
+    t1 = time.clock()
+    n_windows = 0
+    for window_dim in window_dims:
+        stride = int(window_dim * stride_factor)
+        for x, y in CNN.prop.window_origins(img_height, img_width, window_dim, stride):
+            skimage.transform.resize(img[y:y + window_dim, x:x + window_dim], output_shape=(img_dim, img_dim))
+            n_windows += 1
+    t2 = time.clock()
+    duration_windows = t2 - t1
+    print("... resizing each window, windows: %d, time(sec.): %f" % (n_windows, duration_windows))
+
+    t1 = time.clock()
+    n_windows = 0
+    image_pyramid = ImagePyramid(img, img_dim, stride_factor, equalize=False)
+    for i, windows, locations in image_pyramid.chunks(window_dims):
+        n_windows += len(windows)
+    t2 = time.clock()
+    duration_pyramid = t2 - t1
+    print("... image pyramid, windows: %d, time(sec.): %f" % (n_windows, duration_pyramid))
+
+    return duration_windows, duration_pyramid
+
+
+def benchmark_shared_lut(img_pathes, gt_path, recognition_model_path, detection_model_path, img_dim=80, min_dim=20, max_dim=160,
+                         superclass_type=None, batch_size=128, overlap_thresh=0.5):
+    """
+    Accuracy/latency report of equalizing the regions of the proposals each on it's own and using the shared lookup table
+    (see RegionBatcher.extract_at_scales) on GTSDB images. The regions at all the scales of the strong proposals are
+    extracted in both modes then passed to the binary detector. A region is a true sign if it's IoU with a ground truth
+    of the superclass is bigger than overlap_thresh.
+    :param img_pathes: pathes of GTSDB images, named by their ids, i.e. 00001.ppm or 00001.png
+    :param gt_path: the ground truth file gt.txt of GTSDB
+    :param recognition_model_path:
+    :param detection_model_path: binary detection model of the superclass
+    :return:
+    """
+    import csv
+    import CNN.prop
+    import CNN.cache
+    import CNN.enums
+    import CNN.consts
+
+    if superclass_type is None:
+        superclass_type = CNN.enums.SuperclassType._01_Prohibitory
+    if superclass_type == CNN.enums.SuperclassType._01_Prohibitory:
+        classes = CNN.consts.ClassesIDs.PROHIB_CLASSES
+    elif superclass_type == CNN.enums.SuperclassType._02_Warning:
+        classes = CNN.consts.ClassesIDs.WARNING_CLASSES
+    elif superclass_type == CNN.enums.SuperclassType._03_Mandatory:
+        classes = CNN.consts.ClassesIDs.MANDATORY_CLASSES
+    else:
+        raise Exception("Sorry, un-recognized super-class type")
+
+    # ground truth of the images, each row is: file name;x1;y1;x2;y2;class id
+    gt_boxes = {}
+    with open(gt_path, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter=';', quotechar='|')
+        for row in reader:
+            if int(row[5]) in classes:
+                img_id = int(row[0][:-4])
+                gt_boxes.setdefault(img_id, []).append([int(col) for col in row[1:5]])
+
+    detector = CNN.cache.get_detector(recognition_model_path, detection_model_path, batch_size)
+    scales = numpy.arange(0.7, 1.58, 0.05)
+    batchers = [RegionBatcher(img_dim), RegionBatcher(img_dim, shared_lut=True)]
+    durations = [0.0, 0.0]
+    n_correct = [0, 0]
+    n_true_positives = [0, 0]
+    n_positives = 0
+    n_regions = 0
+
+    for img_path in img_pathes:
+        img_id = int(img_path.replace("\\", "/").split("/")[-1][:-4])
+        img_color = cv2.imread(img_path)
+        img = cv2.cvtColor(img_color, cv2.COLOR_BGR2GRAY)
+        prop_strong = CNN.prop.detection_proposal(img_color, min_dim, max_dim, superclass_type)[1]
+        if len(prop_strong) == 0:
+            continue
+
+        # label of each region, using the IoU with the ground truth
+        boxes, dims = boxes_at_scales(prop_strong, scales)
+        labels = numpy.zeros(shape=(len(boxes),), dtype=bool)
+        gt = numpy.asarray(gt_boxes.get(img_id, [])).reshape((-1, 4))
+        if len(gt) > 0:
+            w = numpy.maximum(0, numpy.minimum(boxes[:, None, 2], gt[None, :, 2]) - numpy.maximum(boxes[:, None, 0], gt[None, :, 0]))
+            h = numpy.maximum(0, numpy.minimum(boxes[:, None, 3], gt[None, :, 3]) - numpy.maximum(boxes[:, None, 1], gt[None, :, 1]))
+            intersection = w * h
+            area_boxes = (boxes[:, None, 2] - boxes[:, None, 0]) * (boxes[:, None, 3] - boxes[:, None, 1])
+            area_gt = (gt[None, :, 2] - gt[None, :, 0]) * (gt[None, :, 3] - gt[None, :, 1])
+            labels = numpy.any(intersection / (area_boxes + area_gt - intersection) >= overlap_thresh, axis=1)
+        n_positives += numpy.sum(labels)
+        n_regions += len(boxes)
+
+        for i, batcher in enumerate(batchers):
+            t1 = time.clock()
+            regions = batcher.extract_at_scales(img, prop_strong, scales)[0]
+            t2 = time.clock()
+            durations[i] += t2 - t1
+
+            # detect the regions in batches, the last one is zero-padded
+            predictions = []
+            batch = numpy.zeros(shape=(batch_size, 1, img_dim, img_dim), dtype="float32")
+            for idx_start in range(0, len(regions), batch_size):
+                idx_stop = min(idx_start + batch_size, len(regions))
+                batch[:] = 0
+                batch[0:idx_stop - idx_start] = regions[idx_start:idx_stop]
+                predictions.append(detector.predict(batch)[0:idx_stop - idx_start])
+            predictions = numpy.concatenate(predictions, axis=0)
+            if predictions.ndim == 2:
+                predictions = predictions[:, 0] >= 0.5
+            else:
+                predictions = predictions == 1
+
+            n_correct[i] += numpy.sum(predictions == labels)
+            n_true_positives[i] += numpy.sum(numpy.logical_and(predictions, labels))
+
+    n_imgs = len(img_pathes)
+    for i, name in enumerate(["equalize each region", "shared lookup table"]):
+        accuracy = 100 * n_correct[i] / max(n_regions, 1)
+        recall = 100 * n_true_positives[i] / max(n_positives, 1)
+        print("... %s, accuracy: %f%%, recall: %f%%, time of extracting the regions(ms/image): %f"
+              % (name, accuracy, recall, 1000 * durations[i] / n_imgs))
@@ -0,0 +1,168 @@
+"""
+Sink of the debug artifacts of the detection (probability maps, detection proposals, results drawn on the
+images). It's disabled by default, so the detection doesn't pay for drawing nor writing the images.
+Once enabled, the images are written in the background by a small pool of threads, so the detection
+doesn't wait for the encoding nor the disk.
+"""
+
+import os
+import time
+import threading
+import concurrent.futures
+
+import cv2
+
+
+class ArtifactSink(object):
+    """
+    Writes the given images under the output root using a bounded pool of threads. If the number
+    of images waiting to be written reaches max_pending, the new ones are dropped (and counted)
+    instead of blocking the detection.
+    """
+
+    def __init__(self, root="D://_Dataset//GTSDB//Test_Regions", enabled=False, max_workers=2, max_pending=32, png_compression=None, jpeg_quality=None):
+        self.root = root
+        self.enabled = enabled
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.png_compression = png_compression
+        self.jpeg_quality = jpeg_quality
+        self.n_saved = 0
+        self.n_dropped = 0
+        self.n_failed = 0
+        self.__pool = None
+        self.__pending = threading.BoundedSemaphore(max_pending)
+        self.__lock = threading.Lock()
+
+    def save(self, name, img):
+        """
+        Write the given image (in the background) under the output root, the image must not be
+        modified after it's given to the sink, as it's not copied
+        :param name: file name of the image, relative to the output root, the extension decides the encoding
+        :param img:
+        :return: True if the image will be written, False if the sink is disabled or busy
+        """
+
+        if not self.enabled:
+            return False
+
+        if not self.__pending.acquire(blocking=False):
+            with self.__lock:
+                self.n_dropped += 1
+            return False
+
+        with self.__lock:
+            if self.__pool is None:
+                self.__pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            future = self.__pool.submit(self.__write, os.path.join(self.root, name), img)
+        future.add_done_callback(lambda f: self.__pending.release())
+        return True
+
+    def flush(self):
+        """
+        Wait until all the given images are written
+        """
+        with self.__lock:
+            pool = self.__pool
+            self.__pool = None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def close(self):
+        self.flush()
+        self.enabled = False
+
+    def __write(self, path, img):
+        # the encoding level, if not given, the default of opencv is used
+        # note that giving the png compression makes opencv use a slower strategy of zlib
+        ext = os.path.splitext(path)[1].lower()
+        params = []
+        if ext == ".png" and self.png_compression is not None:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        elif (ext == ".jpg" or ext == ".jpeg") and self.jpeg_quality is not None:
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+
+        # the exceptions of the background threads are not raised anywhere, so they are reported here
+        try:
+            is_written = cv2.imwrite(path, img, params)
+        except Exception as e:
+            print("... failed to write artifact: %s, %s" % (path, e))
+            is_written = False
+        else:
+            if not is_written:
+                print("... failed to write artifact: %s" % (path))
+
+        with self.__lock:
+            if is_written:
+                self.n_saved += 1
+            else:
+                self.n_failed += 1
+
+
+# the default sink, shared by all the detection entry points of the process
+__sink = ArtifactSink()
+
+
+def configure(enabled=True, root=None, max_workers=None, max_pending=None, png_compression=None, jpeg_quality=None):
+    """
+    Enable/disable the default sink and change it's settings, the settings that are None are not changed
+    """
+    global __sink
+    __sink.flush()
+
+    root = __sink.root if root is None else root
+    max_workers = __sink.max_workers if max_workers is None else max_workers
+    max_pending = __sink.max_pending if max_pending is None else max_pending
+    png_compression = __sink.png_compression if png_compression is None else png_compression
+    jpeg_quality = __sink.jpeg_quality if jpeg_quality is None else jpeg_quality
+    __sink = ArtifactSink(root, enabled, max_workers, max_pending, png_compression, jpeg_quality)
+
+
+def enabled():
+    """
+    If the default sink is disabled, there is no need to draw the artifacts at all
+    """
+    return __sink.enabled
+
+
+def save(name, img):
+    return __sink.save(name, img)
+
+
+def flush():
+    __sink.flush()
+
+
+def get_sink():
+    return __sink
+
+
+def benchmark_sink(img_width=1360, img_height=800, n_images=20, root=None):
+    """
+    Time saving the same images synchronously (cv2.imwrite on the calling thread) and using the sink
+    (the time of the calling thread, then the time until all of them are written), by the wall-clock
+    as the cpu time would include the encoding of the threads of the sink
+    :param root: output root, a temporary directory if None
+    """
+    import tempfile
+    import numpy
+
+    rng = numpy.random.RandomState(1234)
+    img = rng.randint(low=0, high=256, size=(img_height, img_width, 3)).astype(numpy.uint8)
+    root = tempfile.mkdtemp() if root is None else root
+
+    t1 = time.perf_counter()
+    for i in range(n_images):
+        cv2.imwrite(os.path.join(root, "sync_%05d.png" % (i)), img)
+    t2 = time.perf_counter()
+
+    sink = ArtifactSink(root, enabled=True, max_pending=n_images)
+    t3 = time.perf_counter()
+    for i in range(n_images):
+        sink.save("sink_%05d.png" % (i), img)
+    t4 = time.perf_counter()
+    sink.flush()
+    t5 = time.perf_counter()
+
+    print("... images: %d, time(sec.) synchronous: %f, sink (calling thread): %f, sink (until written): %f, saved: %d, dropped: %d, failed: %d"
+          % (n_images, t2 - t1, t4 - t3, t5 - t3, sink.n_saved, sink.n_dropped, sink.n_failed))
@@ -4,6 +4,8 @@ import numpy
 import requests
 import io
 import time
+import collections
+import concurrent.futures
 
 import PIL
 import PIL.Image
@@ -45,12 +47,21 @@ import CNN.conv
 import CNN.utils
 import CNN.enums
 import CNN.nms
+import CNN.cache
+import CNN.region
+import CNN.frame
+import CNN.sink
+import CNN.pipe
 
 
 class StreetViewSpan:
-    def __init__(self, load_models=True):
+    def __init__(self, load_models=True, backend=CNN.enums.BackendType.theano, shared_lut=False, max_detections=None,
+                 street_view_url="https://maps.googleapis.com/maps/api/streetview"):
 
         self.api_key = self.__read_api_key()
+
+        # the url of the street view images, can be changed to a local stand-in (see CNN.pipe.FrameServer)
+        self.street_view_url = street_view_url
         self.__load_models = load_models
         if not load_models:
             return
@@ -58,10 +69,24 @@ class StreetViewSpan:
         print("... start building the models")
         t1 = time.clock()
 
-        self.__batch_size = 50
+        # the detector is compiled for these batch sizes, so regions of the image
+        # are split in chunks of the tightest batch size instead of zero-padding them
+        self.__batch_sizes = (8, 16, 32, 64, 128)
+        self.__backend = backend
         self.__img_dim_80 = 80
         self.__img_dim_28 = 28
 
+        # in case of shared_lut, the regions of each proposal at the different scales are equalized
+        # using one lookup table, faster but slightly different, see CNN.region.benchmark_shared_lut
+        self.__region_batcher = CNN.region.RegionBatcher(self.__img_dim_80, shared_lut=shared_lut)
+
+        # when processing the frames of a route, the proposals are tracked from one frame to the next
+        self.__proposal_tracker = None
+
+        # the detections are suppressed in the order of the scores of the detectors, and only
+        # the best max_detections of them are passed to the superclass classifier (None for all)
+        self.__max_detections = max_detections
+
         # some images needed for visualization
         img_sc_prohib = cv2.imread("D:\\_Dataset\\UK\\sc_prohibitory.png", cv2.IMREAD_UNCHANGED)
         img_sc_mandat = cv2.imread("D:\\_Dataset\\UK\\sc_mandatory.png", cv2.IMREAD_UNCHANGED)
@@ -75,9 +100,14 @@ class StreetViewSpan:
         mandat_detec_model_path = "D:\\_Dataset\\GTSDB\\las_model_m_80_binary.pkl"
         superclass_recognition_model_path = "D:\\_Dataset\\SuperClass\\cnn_model_28_lasagne.pkl"
 
-        # build the model once and for all
-        self.__detect_net_p = self.__build_detector(prohib_recog_model_path, prohib_detec_model_path, self.__batch_size)
-        self.__detect_net_m = self.__build_detector(mandat_recog_model_path, mandat_detec_model_path, self.__batch_size)
+        # build the model once and for all, the detectors of the superclasses run on
+        # the same regions of the image, each in it's own thread
+        self.__detect_nets = collections.OrderedDict()
+        self.__detect_pool = None
+        self.register_detector(CNN.enums.SuperclassType._01_Prohibitory, prohib_recog_model_path, prohib_detec_model_path)
+        self.register_detector(CNN.enums.SuperclassType._03_Mandatory, mandat_recog_model_path, mandat_detec_model_path)
+        # the warning detector is not trained yet, once it is, register it the same way
+        # self.register_detector(CNN.enums.SuperclassType._02_Warning, warning_recog_model_path, warning_detec_model_path)
         self.__recog_superclass_cnn = self.__build_classifier(superclass_recognition_model_path)
 
         t2 = time.clock()
@@ -146,44 +176,221 @@ class StreetViewSpan:
 
         dummy_object = True
 
+    def register_detector(self, superclass_type, recognition_model_path, detection_model_path):
+        """
+        Add the detector of the given superclass (warning for example) to the detectors
+        that run on each image, or replace it if already added
+        """
+
+        self.__detect_nets[superclass_type] = self.__build_detector(recognition_model_path, detection_model_path, self.__batch_sizes)
+
+        # one thread for each detector
+        if self.__detect_pool is not None:
+            self.__detect_pool.shutdown()
+        self.__detect_pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.__detect_nets))
+
     def process_image_and_save(self, img_path, count):
         if not self.__load_models:
             print("Sorry, can't process image because models were not loaded!!!!")
             return
 
+        # the result is saved using the artifact sink (if enabled, see CNN.sink.configure)
+        # in the background, so the next image is processed while it's being written
         img_color = cv2.imread(img_path)
         img_result = self.__process_image(img_color)
         if img_result is not None:
-            img_path = "D://_Dataset//GTSDB//Test_Regions/result_%d.png" % (count)
-            cv2.imwrite(img_path, img_result)
+            CNN.sink.save("result_%d.png" % (count), img_result)
+
+    def process_street_view_images(self, locations, tracking=False):
+        """
+        Download the google street view image at each location of the route, then process it.
+        Consecutive frames overlap heavily, so in case of tracking, the proposals and detections of
+        each frame are carried forward to the next one instead of extracting the proposals from scratch
+        :param locations: the locations of the route, with their heading
+        :param tracking: off by default, as it's lossy and saves little time, see CNN.prop.ProposalTracker
+        :return: the result image of each frame (None if no traffic sign found)
+        """
+
+        if not self.__load_models:
+            print("Sorry, can't process images because models were not loaded!!!!")
+            return
 
-    def __process_image(self, img_color):
+        self.__proposal_tracker = None
+        if tracking:
+            img_dim = self.__img_dim_80
+            self.__proposal_tracker = CNN.prop.ProposalTracker(min_dim=int(img_dim / 4), max_dim=int(img_dim * 2))
 
         t1 = time.clock()
 
-        # detect the region, using superclass-specific recognition model
-        detec_result_p = self.__detect(img_color, self.__batch_size, self.__detect_net_p)
-        detec_result_m = self.__detect(img_color, self.__batch_size, self.__detect_net_m)
+        img_results = []
+        for loc in locations:
+            img_bytes = self.__download_street_view_image(loc)
+            img_color = self.__decode_street_view_image(img_bytes)
+            img_results.append(self.__process_image(img_color, loc["heading"]))
+
+        t2 = time.clock()
+        duration = t2 - t1
+        print("... finish processing %d frames, time(sec.): %f" % (len(locations), duration))
+
+        if self.__proposal_tracker is not None:
+            print("... proposal work saved by tracking: %f" % (self.__proposal_tracker.work_saved))
+            self.__proposal_tracker = None
+
+        return img_results
+
+    def process_street_view_route(self, locations, tracking=False, n_fetch_workers=4, n_decode_workers=2, queue_size=4, save_results=True):
+        """
+        Same as process_street_view_images, but the frames are processed by a staged pipeline (see CNN.pipe):
+        fetch, decode, extract the proposals and the regions, detect, classify the superclasses, then save
+        the result. Each stage runs in it's own threads, so the download of the next frames overlaps
+        with the detection of the current one, and the stages are connected with bounded queues.
+        In case of tracking, the proposals are extracted in the order of the frames, but the detections
+        are not carried forward, as they are only known after the next frames are extracted.
+        :param locations: the locations of the route, with their heading
+        :param tracking: off by default, see process_street_view_images
+        :param n_fetch_workers: number of threads downloading the frames
+        :param n_decode_workers: number of threads decoding the frames
+        :param queue_size: max number of frames waiting for each stage
+        :param save_results: save the result images using the artifact sink (if enabled)
+        :return: the result image of each frame (None if no traffic sign found)
+        """
+
+        if not self.__load_models:
+            print("Sorry, can't process images because models were not loaded!!!!")
+            return
+
+        self.__proposal_tracker = None
+        if tracking:
+            img_dim = self.__img_dim_80
+            self.__proposal_tracker = CNN.prop.ProposalTracker(min_dim=int(img_dim / 4), max_dim=int(img_dim * 2))
+
+        # each stage takes and gives the index of the frame along with it's data
+        def fetch(item):
+            idx, loc = item
+            return idx, loc, self.__download_street_view_image(loc)
+
+        def decode(item):
+            idx, loc, img_bytes = item
+            return idx, loc, self.__decode_street_view_image(img_bytes)
+
+        def extract(item):
+            idx, loc, img_color = item
+            frame = CNN.frame.FrameContext(img_color)
+            return idx, frame, self.__extract_regions(frame, self.__batch_sizes, loc["heading"])
+
+        def detect(item):
+            idx, frame, extracted_regions = item
+            return idx, frame, extracted_regions, self.__detect_all(extracted_regions)
+
+        def classify(item):
+            idx, frame, extracted_regions, detec_results = item
+            return idx, self.__classify_superclasses(frame, extracted_regions, detec_results, track=False)
+
+        def save(item):
+            idx, img_result = item
+            if save_results and img_result is not None:
+                CNN.sink.save("route_%05d.png" % (idx), img_result)
+            return img_result
+
+        pipeline = CNN.pipe.Pipeline([
+            CNN.pipe.Stage("fetch", fetch, n_workers=n_fetch_workers, queue_size=queue_size),
+            CNN.pipe.Stage("decode", decode, n_workers=n_decode_workers, queue_size=queue_size),
+            CNN.pipe.Stage("extract", extract, queue_size=queue_size, ordered=tracking),
+            CNN.pipe.Stage("detect", detect, queue_size=queue_size),
+            CNN.pipe.Stage("classify", classify, queue_size=queue_size),
+            CNN.pipe.Stage("save", save, queue_size=queue_size)])
+        img_results = pipeline.run(enumerate(locations))
+
+        print("... finish processing %d frames" % (len(locations)))
+        pipeline.print_stats()
+
+        if self.__proposal_tracker is not None:
+            print("... proposal work saved by tracking: %f" % (self.__proposal_tracker.work_saved))
+            self.__proposal_tracker = None
+
+        return img_results
+
+    def __download_street_view_image(self, location):
+        latlng = "%f,%f" % (location["lat"], location["lng"])
+        heading = location["heading"]
+        url = "%s?size=640x400&location=%s&heading=%f&pitch=0&key=%s" % (self.street_view_url, latlng, heading, self.api_key)
+        response = requests.get(url, timeout=30)
+        response.raise_for_status()
+        return response.content
+
+    def __decode_street_view_image(self, img_bytes):
+        # the image is decoded as RGB, then converted to BGR as the images read by opencv
+        img_color = numpy.asarray(PIL.Image.open(io.BytesIO(img_bytes)).convert("RGB"))
+        img_color = cv2.cvtColor(img_color, cv2.COLOR_RGB2BGR)
+        return img_color
+
+    def __process_image(self, img_color, heading=None):
+
+        t1 = time.clock()
+
+        # the versions of the frame (gray-scale, pre-processed for proposals, ..) are
+        # computed once and shared by all the stages of processing it
+        frame = CNN.frame.FrameContext(img_color)
+
+        # extract the regions once, then detect them using superclass-specific recognition models
+        extracted_regions = self.__extract_regions(frame, self.__batch_sizes, heading)
+        detec_results = self.__detect_all(extracted_regions)
+        img_result = self.__classify_superclasses(frame, extracted_regions, detec_results)
+
+        t2 = time.clock()
+        duration = t2 - t1
+        print("... finish processing the image, time(sec.): %d" % (duration))
+        return img_result
+
+    def __detect_all(self, extracted_regions):
+        """
+        run all the detectors on the extracted regions of the image
+        the detectors are independent so they run concurrently (theano/BLAS release the GIL)
+        """
+        futures = [self.__detect_pool.submit(self.__detect, net, extracted_regions) for net in self.__detect_nets.values()]
+        detec_results = [f.result() for f in futures]
+        return detec_results
+
+    def __classify_superclasses(self, frame, extracted_regions, detec_results, track=True):
+        """
+        suppress the regions found by the detectors, then classify the superclass of each
+        :param track: carry the detections forward to the next frame, in case of tracking
+        :return: the image of the result, None if no traffic sign found
+        """
 
         regions = []
-        if len(detec_result_p[0]) > 0:
-            for r in detec_result_p[0]:
-                regions.append(r)
-        if len(detec_result_m[0]) > 0:
-            for r in detec_result_m[0]:
-                regions.append(r)
+        scores = []
+        detector_ids = []
+        for i, detec_result in enumerate(detec_results):
+            if len(detec_result[0]) > 0:
+                regions.append(detec_result[0])
+                scores.append(detec_result[1])
+                detector_ids.append(numpy.full(len(detec_result[0]), i))
         if len(regions) == 0:
             print("... NO TRAFFIC SIGN FOUND BY THE DETECTORS")
             return None
 
-        # merge only the strong regions from the detector
-        # then create different superclass regions (at different scales)
-        # to be passed to the super_class classifier
+        # make the final verdict in one call: suppress the regions of each detector
+        # (found at different scales), the best of them first, then merge the strong
+        # regions of all the detectors, then create different superclass regions
+        # (at different scales) to be passed to the super_class classifier
         regions = numpy.vstack(regions)
-        weak_region, regions = CNN.nms.suppression(regions, 0.25, 0)
+        scores = numpy.hstack(scores)
+        detector_ids = numpy.hstack(detector_ids)
+        n_scales = len(extracted_regions[4])
+        weak_region, regions, weak_scores, scores = CNN.nms.batched_suppression(regions, detector_ids, 0.25, round(n_scales * 0.35), scores=scores,
+                                                                                cross_overlap_thresh=0.25, cross_min_overlap=0, max_detections=self.__max_detections)
+        if len(regions) == 0:
+            print("... NO TRAFFIC SIGN FOUND BY THE DETECTORS")
+            return None
+
+        # carry the detections forward to the next frame of the route
+        if track and self.__proposal_tracker is not None:
+            self.__proposal_tracker.add_detections(regions)
+
         scales = numpy.arange(0.9, 1.3, 0.1)
         n_scales = len(scales)
-        sc_regions = self.__regions_at_different_scales(img_color, self.__img_dim_28, regions, scales)
+        sc_regions = self.__regions_at_different_scales(frame, self.__img_dim_28, regions, scales)
         print("... start classify superclass")
         sc_prediction = self.__classify_images(self.__recog_superclass_cnn, sc_regions, self.__img_dim_28)
         print("... finish classify superclass")
@@ -207,17 +414,13 @@ class StreetViewSpan:
                 superclass_id = 2
             superclass_ids.append(superclass_id)
 
-        t2 = time.clock()
-        duration = t2 - t1
-        print("... finish processing the image, time(sec.): %d" % (duration))
-
         # now, we have the regions and the prediction (class id) of the superclasses in the image
-        img_result = self.__draw_superclass_result(img_color, regions, superclass_ids, self.__sc_imgs)
+        img_result = self.__draw_superclass_result(frame.img_color, regions, superclass_ids, self.__sc_imgs)
         return img_result
 
     # region Detector
 
-    def __build_detector(self, recognition_model_path, detection_model_path, batch_size):
+    def __build_detector(self, recognition_model_path, detection_model_path, batch_sizes):
         # stack the regions of all the scales in one array
         # please note that a scale can have no regions, so using vstack wouldn't work
         # remove the scales with empty regions then use vstack
@@ -226,242 +429,158 @@ class StreetViewSpan:
         # Build the detector         #
         ##############################
 
-        loaded_objects = CNN.utils.load_model(model_path=recognition_model_path, model_type=CNN.enums.ModelType._02_conv3_mlp2)
-        img_dim = loaded_objects[1]
-        kernel_dim = loaded_objects[2]
-        nkerns = loaded_objects[3]
-        pool_size = loaded_objects[5]
-
-        layer0_W = theano.shared(loaded_objects[6], borrow=True)
-        layer0_b = theano.shared(loaded_objects[7], borrow=True)
-        layer1_W = theano.shared(loaded_objects[8], borrow=True)
-        layer1_b = theano.shared(loaded_objects[9], borrow=True)
-        layer2_W = theano.shared(loaded_objects[10], borrow=True)
-        layer2_b = theano.shared(loaded_objects[11], borrow=True)
-
-        layer0_input = T.tensor4(name='input')
-        layer0_img_dim = img_dim
-        layer0_img_shape = (batch_size, 1, layer0_img_dim, layer0_img_dim)
-        layer0_kernel_dim = kernel_dim[0]
-        layer1_img_dim = int((layer0_img_dim - layer0_kernel_dim + 1) / 2)
-        layer1_kernel_dim = kernel_dim[1]
-        layer2_img_dim = int((layer1_img_dim - layer1_kernel_dim + 1) / 2)
-        layer2_kernel_dim = kernel_dim[2]
-        layer3_img_dim = int((layer2_img_dim - layer2_kernel_dim + 1) / 2)
-        layer3_input_shape = (batch_size, nkerns[2] * layer3_img_dim * layer3_img_dim)
-
-        # layer 0, 1, 2: Conv-Pool
-        layer0_output = CNN.conv.convpool_layer(
-            input=layer0_input, W=layer0_W, b=layer0_b,
-            image_shape=(batch_size, 1, layer0_img_dim, layer0_img_dim),
-            filter_shape=(nkerns[0], 1, layer0_kernel_dim, layer0_kernel_dim),
-            pool_size=pool_size
-        )
-        layer1_output = CNN.conv.convpool_layer(
-            input=layer0_output, W=layer1_W, b=layer1_b,
-            image_shape=(batch_size, nkerns[0], layer1_img_dim, layer1_img_dim),
-            filter_shape=(nkerns[1], nkerns[0], layer1_kernel_dim, layer1_kernel_dim),
-            pool_size=pool_size
-        )
-        layer2_output = CNN.conv.convpool_layer(
-            input=layer1_output, W=layer2_W, b=layer2_b,
-            image_shape=(batch_size, nkerns[1], layer2_img_dim, layer2_img_dim),
-            filter_shape=(nkerns[2], nkerns[1], layer2_kernel_dim, layer2_kernel_dim),
-            pool_size=pool_size
-        )
-        # do the filtering using 3 layers of Conv+Pool
-        conv_fn = theano.function([layer0_input], layer2_output)
-
-        # load the regression model
-        with open(detection_model_path, 'rb') as f:
-            nn_mlp = pickle.load(f)
-
-        return conv_fn, nn_mlp, layer3_input_shape
-
-    def __detect(self, img_color, batch_size, net):
+        # the detector is shared with the other entry points through the cache
+        # so it's compiled only once per process, one detector for each batch size
+        detectors = {}
+        for batch_size in batch_sizes:
+            detectors[batch_size] = CNN.cache.get_detector(recognition_model_path, detection_model_path, batch_size, self.__backend)
+        return detectors
+
+    def __extract_regions(self, frame, batch_sizes, heading=None):
         """
-        detect a traffic sign form the given natural image
-        detected signs depend on the given model, for example if it is a prohibitory detection model
-        we'll only detect prohibitory traffic signs
-        :param img_path:
-        :param model_path:
-        :param classifier:
-        :param img_dim:
-        :return:
+        extract the regions of the given natural image to be passed to the detectors
+        the regions don't depend on the detection model, so they are extracted once per image
+        and shared by all the detectors
+        :param frame: FrameContext of the natural image
+        :param batch_sizes: the batch sizes of the detectors
+        :param heading: heading of the frame, in case of tracking the proposals along a route
+        :return: regions, their locations and window dims, the chunks of the regions and the scales
         """
 
-        net_cnn, net_mlp, net_mlp_input_shape = net
-
         ##############################
         # Extract detection regions  #
         ##############################
 
-        # pre-process image by: equalize histogram and stretch intensity
-        # converting to gray-scale and normalizing are redundant steps
-        img = cv2.cvtColor(img_color, cv2.COLOR_BGR2GRAY)
-        img = img.astype(float) / 255.0
-        img_dim = 80
+        # the regions are cropped from the gray-scale image of the frame
+        img = frame.img_gray
+        img_dim = self.__img_dim_80
 
         # min, max defines what is the range the detection proposals
         max_window_dim = int(img_dim * 2)
         min_window_dim = int(img_dim / 4)
 
-        # regions, locations and window_dim at each scale
-        regions = []
-        locations = []
-        window_dims = []
-        r_count = 0
-
         # important, instead of naively add every sliding window, we'll only add
         # windows that covers the strong detection proposals
-        prop_weak, prop_strong, prop_map, prop_circles = CNN.prop.detection_proposal(img_color, min_dim=min_window_dim, max_dim=max_window_dim)
+        # in case of tracking, the proposals of the previous frame are carried forward
+        if self.__proposal_tracker is not None:
+            prop_weak, prop_strong, prop_map, prop_circles = self.__proposal_tracker.update(frame, heading)
+        else:
+            prop_weak, prop_strong, prop_map, prop_circles = CNN.prop.detection_proposal(frame, min_dim=min_window_dim, max_dim=max_window_dim)
         if len(prop_strong) == 0:
-            return [], [], [], []
+            return None
 
-        # loop on the detection proposals
+        # the regions are split in chunks of the available batch sizes,
+        # the regions array is allocated once for all the chunks, the padding
+        # of the last chunk (if any) is kept zeros
         scales = numpy.arange(0.7, 1.58, 0.05)
-        for prop in prop_strong:
-            x1 = prop[0]
-            y1 = prop[1]
-            x2 = prop[2]
-            y2 = prop[3]
-            w = x2 - x1
-            h = y2 - y1
-            window_dim = max(h, w)
-            center_x = int(x1 + round(w / 2))
-            center_y = int(y1 + round(h / 2))
-
-            for scale in scales:
-                r_count += 1
-                dim = window_dim * scale
-                dim_half = round(dim / 2)
-                dim = round(dim)
-                x1 = center_x - dim_half
-                y1 = center_y - dim_half
-                x2 = center_x + dim_half
-                y2 = center_y + dim_half
-
-                # pre-process the region and scale it to img_dim
-                region = img[y1:y2, x1:x2]
-                region = skimage.transform.resize(region, output_shape=(img_dim, img_dim))
-                region = skimage.exposure.equalize_hist(region)
-
-                # we only need to store the region, it's top-left corner and sliding window dim
-                regions.append(region)
-                locations.append([x1, y1])
-                window_dims.append(dim)
+        n_regions = len(prop_strong) * len(scales)
+        batches = self.__split_to_batches(n_regions, batch_sizes)
+        n_regions_padded = batches[-1][1]
+
+        # the regions at all the scales of all the proposals are cropped, resized and
+        # equalized in one go, into the regions array, the top-left corner of each and it's window dim
+        regions = numpy.zeros(shape=(n_regions_padded, 1, img_dim, img_dim), dtype="float32")
+        regions, boxes, window_dims = self.__region_batcher.extract_at_scales(img, prop_strong, scales, out=regions)
+        locations = boxes[:, 0:2].tolist()
+        window_dims = window_dims.tolist()
+
+        return regions, locations, window_dims, batches, scales
+
+    def __detect(self, net, extracted_regions):
+        """
+        detect a traffic sign form the given extracted regions of the natural image
+        detected signs depend on the given model, for example if it is a prohibitory detection model
+        we'll only detect prohibitory traffic signs
+        :param net: detectors of the model, one for each batch size
+        :param extracted_regions: the result of __extract_regions
+        :return: the regions detected as traffic signs (at all the scales) and their scores
+        """
+
+        if extracted_regions is None:
+            return [], []
+
+        regions, locations, window_dims, batches, scales = extracted_regions
+        n_regions = len(locations)
+        r_count = n_regions
 
         ##############################
         # Start detection            #
         ##############################
 
-        # split it to batches first, zero-pad them if needed
-        n_regions = len(regions)
-        if n_regions % batch_size != 0:
-            n_remaining = batch_size - (n_regions % batch_size)
-            regions_padding = numpy.zeros(shape=(n_remaining, img_dim, img_dim), dtype=float)
-            regions = numpy.vstack((regions, regions_padding)).tolist()
-
         # run the detector on the regions
         start_time = time.clock()
 
         # loop on the batches of the regions
-        n_regions_padded = len(regions)
-        n_batches = int(n_regions_padded / batch_size)
-        layer0_img_shape = (batch_size, 1, img_dim, img_dim)
+        n_batches = len(batches)
         predictions = []
-        for i in range(n_batches):
+        for i, (idx_start, idx_stop, batch_size) in enumerate(batches):
             # prediction: CNN filtering then MLP regression
             t1 = time.clock()
-            batch = numpy.asarray(regions[i * batch_size: (i + 1) * batch_size])
-            batch = batch.reshape(layer0_img_shape)
-            filters = net_cnn(batch)
-            filters = filters.reshape(net_mlp_input_shape).astype("float32")
-            batch_pred = net_mlp.predict(filters)
+            batch_pred = net[batch_size].predict(regions[idx_start:idx_stop])
             predictions.append(batch_pred)
             t2 = time.clock()
-            print("... batch: %i/%i, time(sec.): %f" % ((i + 1), n_batches, t2 - t1))
+            print("... batch: %i/%i, size: %d, time(sec.): %f" % ((i + 1), n_batches, batch_size, t2 - t1))
 
         # after getting all the predictions, remove the padding
-        predictions = numpy.hstack(predictions)
+        # concatenate along the regions, as the predictions can be 1D or 2D
+        predictions = numpy.concatenate(predictions, axis=0)
         predictions = predictions[0:n_regions]
 
         # now, here is the thing, since this function serves detection model
         # of prohibitory and mandatory, and both models were built slightly differently
-        # so all we want to do is to convert the predictions into list of bool values
+        # so all we want to do is to convert the predictions into scores, the sigmoid output
+        # of the regression model or 0/1 of the classification model, and keep the scores
+        # for the suppression instead of thresholding them to bool values
         if predictions.ndim != 1 and predictions.ndim != 2:
             raise Exception("There must be something wrong here, why the predictions of the detector has wrong dimension?")
-        if predictions.ndim == 2:
-            predictions = predictions.reshape((predictions.shape[0],))
-            predictions[predictions >= 0.5] = 1
-            predictions[predictions < 0.5] = 0
-        predictions = predictions.astype(bool).tolist()
+        scores = predictions.reshape((predictions.shape[0],)).astype("float32")
+        predictions = scores >= 0.5
 
         end_time = time.clock()
         duration = (end_time - start_time)
         print("... detection regions: %d, duration(sec.): %f" % (r_count, duration))
 
-        # construct the probability map for each scale and show it/ save it
-        s_count = 0
-        overlap_thresh = 0.5
-        min_overlap = 0
-        strong_prob_regions = []
-        weak_prob_regions = []
-        for pred, loc, window_dim in zip(predictions, locations, window_dims):
-            s_count += 1
-            w_regions, s_regions = self.__probability_map([pred], [loc], window_dim, overlap_thresh, min_overlap)
-            if len(w_regions) > 0:
-                weak_prob_regions.append(w_regions)
-            if len(s_regions) > 0:
-                strong_prob_regions.append(s_regions)
-
-        if len(weak_prob_regions) > 0:
-            weak_prob_regions = numpy.vstack(weak_prob_regions)
-
-        if len(strong_prob_regions) > 0:
-            strong_prob_regions = numpy.vstack(strong_prob_regions)
-
-        # now, after we finished scanning at all the levels, we should make the final verdict
-        # by suppressing all the strong_regions that we extracted on different scales
-        if len(strong_prob_regions) > 0:
-            overlap_thresh = 0.25
-            min_overlap = round(len(scales) * 0.35)
-            weak_regions, strong_regions = CNN.nms.suppression(strong_prob_regions, overlap_thresh, min_overlap)
-            if weak_regions is not list:
-                weak_regions.tolist()
-            if strong_regions is not list:
-                strong_regions.tolist()
-            return strong_regions, weak_regions, strong_prob_regions, weak_prob_regions
-        else:
-            return [], [], [], []
-
-    def __probability_map(self, predictions, locations, window_dim, overlap_thresh, min_overlap):
-        locations = numpy.asarray(locations)
-        predictions = numpy.asarray(predictions)
-
-        regions = []
+        # the regions detected at all the scales, they are suppressed later with the regions of the other detectors
         idx = numpy.where(predictions)[0]
-        for i in idx:
-            region = [0, 0, window_dim, window_dim]
-            location = locations[i]
-            x1 = int(region[0] + location[0])
-            y1 = int(region[1] + location[1])
-            x2 = int(region[2] + location[0])
-            y2 = int(region[3] + location[1])
-            regions.append([x1, y1, x2, y2])
-
-        # check if no region found
-        if len(regions) == 0:
-            return [], []
+        locations = numpy.asarray(locations)[idx]
+        window_dims = numpy.asarray(window_dims)[idx]
+        strong_prob_regions = numpy.hstack((locations, locations + window_dims[:, None])).astype(int)
+        strong_prob_scores = scores[idx]
+        return strong_prob_regions, strong_prob_scores
+
+    def __split_to_batches(self, n_regions, batch_sizes):
+        """
+        Split the regions to chunks, each chunk takes the biggest batch size that it can fill,
+        unless the rest of the regions fit in one batch size with less padding than the smallest
+        batch size. So only the last chunk is zero-padded.
+        :param n_regions:
+        :param batch_sizes: sorted ascending
+        :return: list of (start, stop, batch size) of each chunk
+        """
 
-        # suppress the new regions and raw them with red color
-        weak_regions, strong_regions = CNN.nms.suppression(regions, overlap_thresh, min_overlap)
+        batches = []
+        idx_start = 0
+        n_remaining = n_regions
+        while n_remaining > 0:
+            fitting = [b for b in batch_sizes if b <= n_remaining]
+            holding = [b for b in batch_sizes if b >= n_remaining]
+            if len(holding) > 0 and holding[0] - n_remaining < batch_sizes[0]:
+                batch_size = holding[0]
+            elif len(fitting) > 0:
+                batch_size = fitting[-1]
+            else:
+                batch_size = batch_sizes[0]
+            batches.append((idx_start, idx_start + batch_size, batch_size))
+            idx_start += batch_size
+            n_remaining -= batch_size
 
-        # return the map to be exploited later by the detector, for the next scale
-        weak_regions = weak_regions.tolist()
-        return weak_regions, strong_regions
+        return batches
 
     def __save_detection_result(self, img_color, regions, img_id):
+        # no need to draw if the result won't be saved
+        if not CNN.sink.enabled():
+            return
+
         strong_regions = regions[0]
         weak_regions = regions[1]
         strong_probability_regions = regions[2]
@@ -481,8 +600,7 @@ class StreetViewSpan:
         for reg in strong_regions:
             cv2.rectangle(img_color, (reg[0], reg[1]), (reg[2], reg[3]), red_color, 2)
 
-        img_path = "D://_Dataset//GTSDB//Test_Regions/result_detect_%d.png" % (img_id)
-        cv2.imwrite(img_path, img_color)
+        CNN.sink.save("result_detect_%d.png" % (img_id), img_color)
 
     def __draw_superclass_result(self, img_color, regions, superclass_ids, imgs_sc):
         color_red = (0, 0, 255)
@@ -511,36 +629,12 @@ class StreetViewSpan:
 
         return img_result
 
-    def __regions_at_different_scales(self, img_color, img_dim, regions, scales):
-        img = cv2.cvtColor(img_color, cv2.COLOR_BGR2GRAY)
-
-        new_regions = []
-
-        for region in regions:
-            x1 = region[0]
-            y1 = region[1]
-            x2 = region[2]
-            y2 = region[3]
-            w = x2 - x1
-            h = y2 - y1
-            window_dim = max(h, w)
-            center_x = int(x1 + round(w / 2))
-            center_y = int(y1 + round(h / 2))
-            for scale in scales:
-                dim_half = round(window_dim * scale / 2)
-                x1 = center_x - dim_half
-                y1 = center_y - dim_half
-                x2 = center_x + dim_half
-                y2 = center_y + dim_half
-
-                # pre-process the region and scale it to img_dim
-                region = img[y1:y2, x1:x2]
-                region = skimage.transform.resize(region, output_shape=(img_dim, img_dim))
-                region = skimage.exposure.equalize_hist(region)
-
-                # we only need to store the region, it's top-left corner and sliding window dim
-                new_regions.append(region)
+    def __regions_at_different_scales(self, frame, img_dim, regions, scales):
+        img = frame.img_gray
 
+        # crop, resize and equalize the regions at all the scales in one go
+        boxes, window_dims = CNN.region.boxes_at_scales(regions, scales)
+        new_regions = CNN.region.RegionBatcher(img_dim).extract(img, boxes)
         return new_regions
 
     # endregion
@@ -582,10 +676,7 @@ class StreetViewSpan:
         # download the images of google street view at each location/step
         img_count = 0
         for dir in directions:
-            latlng = "%f,%f" % (dir["lat"], dir["lng"])
-            heading = dir["heading"]
-            url = "https://maps.googleapis.com/maps/api/streetview?size=640x400&location=%s&heading=%f&pitch=0&key=%s" % (latlng, heading, api_key)
-            img_bytes = requests.get(url).content
+            img_bytes = self.__download_street_view_image(dir)
             img = numpy.asarray(PIL.Image.open(io.BytesIO(img_bytes)))
             plt.imshow(img)
             plt.pause(0.1)
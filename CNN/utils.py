@@ -5,7 +5,10 @@ import time
 import csv
 import pickle
 import gzip
+import json
+import struct
 import numpy
+import numpy.lib.stride_tricks
 import theano
 import theano.tensor
 import PIL
@@ -20,6 +23,7 @@ import CNN.recog
 import CNN.enums
 import CNN.consts
 import CNN.conv
+import CNN.region
 
 import matplotlib
 import matplotlib.cm
@@ -171,6 +175,14 @@ def load_model(model_path, model_type=CNN.enums.ModelType._01_conv2_mlp2):
         n = 16
     else:
         raise Exception("Unknown model type")
+
+    # the model is either saved in the binary format or as stream of pickled objects
+    if is_binary_model(model_path):
+        loaded_objects = __load_model_binary(model_path)
+        if len(loaded_objects) < n:
+            raise Exception("Binary model has %d objects, while the model type needs %d" % (len(loaded_objects), n))
+        return loaded_objects[0:n]
+
     save_file = open(model_path, 'rb')
     loaded_objects = []
     for i in range(n):
@@ -179,6 +191,118 @@ def load_model(model_path, model_type=CNN.enums.ModelType._01_conv2_mlp2):
     return loaded_objects
 
 
+def save_model(model_path, objects):
+    """
+    Save the objects of the model in the same order they are loaded by load_model, i.e.
+    dataset path, img_dim, kernel_dim, nkerns, mlp_layers, pool_size then the W/b of the layers.
+    If the extension of the file is .bin, the model is saved in the binary format,
+    else it's saved as stream of pickled objects.
+    """
+    if os.path.splitext(model_path)[1] == CNN.consts.ModelBinaryFormat.EXTENSION:
+        __save_model_binary(model_path, objects)
+        return
+
+    # the -1 is for HIGHEST_PROTOCOL
+    # this will overwrite current contents and it triggers much more efficient storage than numpy's default
+    save_file = open(model_path, 'wb')
+    for obj in objects:
+        pickle.dump(obj, save_file, -1)
+    save_file.close()
+
+
+def convert_model(model_path, binary_model_path, model_type=CNN.enums.ModelType._02_conv3_mlp2):
+    """
+    Convert model saved as stream of pickled objects to the binary format
+    """
+    loaded_objects = load_model(model_path, model_type)
+    __save_model_binary(binary_model_path, loaded_objects)
+    print("... model converted: %s" % (binary_model_path))
+
+
+def is_binary_model(model_path):
+    with open(model_path, 'rb') as f:
+        magic = f.read(len(CNN.consts.ModelBinaryFormat.MAGIC))
+    return magic == CNN.consts.ModelBinaryFormat.MAGIC
+
+
+def __save_model_binary(model_path, objects, dtype="float32"):
+    """
+    The binary format consists of: magic bytes, format version and header length (uint32 each)
+    then json header of the hyper-parameters and then the weights, each one starts
+    at new page so it can be memory-mapped without copying
+    """
+
+    n_params = 6
+    params = objects[0:n_params]
+    weights = [numpy.asarray(w, dtype=dtype) for w in objects[n_params:]]
+
+    header = {
+        "dataset_path": params[0],
+        "img_dim": params[1],
+        "kernel_dim": list(params[2]),
+        "nkerns": list(params[3]),
+        "mlp_layers": list(params[4]),
+        "pool_size": list(params[5]),
+        "weights": [],
+    }
+
+    # calculate the offset of the weights, assuming header of the biggest possible size
+    # then re-write the header with the actual offsets
+    offset = 0
+    for w in weights:
+        header["weights"].append({"dtype": w.dtype.str, "shape": list(w.shape), "offset": offset})
+        offset = __align_to_page(offset + w.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    prefix_length = len(CNN.consts.ModelBinaryFormat.MAGIC) + struct.calcsize(CNN.consts.ModelBinaryFormat.STRUCT)
+    data_offset = __align_to_page(prefix_length + len(header_bytes) + 64 * len(weights))
+    for w_header in header["weights"]:
+        w_header["offset"] += data_offset
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    with open(model_path, 'wb') as f:
+        f.write(CNN.consts.ModelBinaryFormat.MAGIC)
+        f.write(struct.pack(CNN.consts.ModelBinaryFormat.STRUCT, CNN.consts.ModelBinaryFormat.VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for w, w_header in zip(weights, header["weights"]):
+            f.seek(w_header["offset"])
+            f.write(w.tobytes(order='C'))
+        # make sure the file size covers the last page
+        f.truncate(__align_to_page(f.tell()))
+
+
+def __load_model_binary(model_path):
+    with open(model_path, 'rb') as f:
+        f.read(len(CNN.consts.ModelBinaryFormat.MAGIC))
+        version, header_length = struct.unpack(CNN.consts.ModelBinaryFormat.STRUCT, f.read(struct.calcsize(CNN.consts.ModelBinaryFormat.STRUCT)))
+        if version > CNN.consts.ModelBinaryFormat.VERSION:
+            raise Exception("Sorry, binary model version %d is not supported" % (version))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+
+    loaded_objects = [header["dataset_path"],
+                      header["img_dim"],
+                      tuple(header["kernel_dim"]),
+                      tuple(header["nkerns"]),
+                      tuple(header["mlp_layers"]),
+                      tuple(header["pool_size"])]
+
+    # map the weights without copying, copy-on-write so the pages are
+    # shared between the processes as long as no one writes to them
+    for w_header in header["weights"]:
+        shape = tuple(w_header["shape"])
+        dtype = numpy.dtype(w_header["dtype"])
+        if numpy.prod(shape) == 0:
+            w = numpy.zeros(shape=shape, dtype=dtype)
+        else:
+            w = numpy.memmap(model_path, dtype=dtype, mode='c', offset=w_header["offset"], shape=shape)
+        loaded_objects.append(w)
+
+    return loaded_objects
+
+
+def __align_to_page(offset):
+    return int((offset + CNN.consts.ModelBinaryFormat.PAGE_SIZE - 1) / CNN.consts.ModelBinaryFormat.PAGE_SIZE) * CNN.consts.ModelBinaryFormat.PAGE_SIZE
+
+
 def shared_dataset(data_xy, borrow=True):
     """ Function that loads the dataset into shared variables
 
@@ -337,6 +461,7 @@ def probability_map(img_path, model_path, classifier=CNN.enums.ClassifierType.lo
 
     img = cv2.imread(img_path)
     img_gs = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    img_gs = img_gs.astype("float32") / 255.0
 
     scaling_factor = 0.75
     stride = int(window_size * 0.5)
@@ -357,24 +482,23 @@ def probability_map(img_path, model_path, classifier=CNN.enums.ClassifierType.lo
         # split the images to small images using overlapping sliding window
         # do classification of all of the small images as one batch
         # then output the classification result as probability map
-        batch_count = 0
+        # the windows are a strided view of the image at the current scale, they are
+        # only copied when they are added to the batch
         y_range = numpy.arange(0, img_gs.shape[0] - window_size, stride)
         x_range = numpy.arange(0, img_gs.shape[1] - window_size, stride)
-        for y in y_range:
-            for x in x_range:
-                roi = img_gs[y:y + window_size, x:x + window_size] / 255.0
-                batch.append(roi.ravel())
-                batch_count += 1
+        windows = numpy.lib.stride_tricks.sliding_window_view(img_gs, (window_size, window_size))[::stride, ::stride]
+        windows = windows[0:len(y_range), 0:len(x_range)]
+        batch_count = len(y_range) * len(x_range)
+        batch.append(windows.reshape((batch_count, window_size * window_size)))
 
         batch_counts.append(batch_count)
 
-        # re-scale the image to make it smaller
+        # re-scale the image to make it smaller, the windows are never resized
         shapes.append((len(y_range), len(x_range)))
-        img_gs = skimage.transform.resize(img_gs, output_shape=(
-            int(img_gs.shape[0] * scaling_factor), int(img_gs.shape[1] * scaling_factor)))
+        img_gs = cv2.resize(img_gs, dsize=(int(img_gs.shape[1] * scaling_factor), int(img_gs.shape[0] * scaling_factor)), interpolation=cv2.INTER_AREA)
 
     # after we obained all the batches for all the image scales, classify the batches
-    batch_np = numpy.asarray(batch, float)
+    batch_np = numpy.vstack(batch).astype(float)
     c_result, c_prob, c_duration = CNN.recog.classify_batch(batch_np, model_path, classifier)
     print('Classification of image batches in %f sec.' % (c_duration))
 
@@ -790,6 +914,20 @@ def restore_class_ids(mapped_ids, superclass_type):
     :return:
     """
 
+    classes_ids = superclass_classes_ids(superclass_type)
+
+    # recover the original ids, using the mapped ids as indexes of the original ones
+    original_ids = numpy.asarray(classes_ids)[mapped_ids]
+
+    return original_ids
+
+
+def superclass_classes_ids(superclass_type):
+    """
+    the original class ids of the given superclass, the mapped id of a class is it's index
+    :return:
+    """
+
     if superclass_type == CNN.enums.SuperclassType._01_Prohibitory:
         classes_ids = CNN.consts.ClassesIDs.PROHIB_CLASSES
     elif superclass_type == CNN.enums.SuperclassType._02_Warning:
@@ -801,14 +939,7 @@ def restore_class_ids(mapped_ids, superclass_type):
     else:
         raise Exception("Sorry, un-recognized super-class type")
 
-    # copy list
-    original_ids = mapped_ids.copy()
-
-    # recover the original ids
-    for i in range(0, len(classes_ids)):
-        original_ids[mapped_ids == i] = classes_ids[i]
-
-    return original_ids
+    return classes_ids
 
 
 def __reduce_gtsr(img_dim):
@@ -1392,6 +1523,7 @@ def serialize_gtsdb(img_dim, superclass_type, add_true_negative=True, pre_proces
     img_height = 800
     stride_factor = 10
     regions = numpy.zeros(shape=(0, img_dim * img_dim), dtype=float)
+    region_batcher = CNN.region.RegionBatcher(img_dim, equalize=pre_processing)
     relative_boundaries = numpy.zeros(shape=(0, 4), dtype=int)
 
     directory = "D:\\_Dataset\\GTSDB\\Training_PNG\\"
@@ -1458,6 +1590,7 @@ def serialize_gtsdb(img_dim, superclass_type, add_true_negative=True, pre_proces
                 # the factor used to rescale the region before saving it to the region array
                 # note that we want to rescale to 28*28 to be compatible with our CNN recognition network
                 r_factor = window_dim / img_dim
+                window_boxes = []
                 for y in y_range:
                     for x in x_range:
 
@@ -1478,22 +1611,12 @@ def serialize_gtsdb(img_dim, superclass_type, add_true_negative=True, pre_proces
 
                         relative_boundary = (numpy.asarray([x1 - x, y1 - y, x2 - x, y2 - y]) / r_factor).astype(int)
                         relative_boundaries = numpy.vstack([relative_boundaries, relative_boundary])
+                        window_boxes.append([x, y, x + window_dim, y + window_dim])
 
-                        region = numpy.copy(img[y:y + window_dim, x:x + window_dim])
-                        region = skimage.transform.resize(region, output_shape=(img_dim, img_dim))
-
-                        # pre-process the region if needed
-                        if pre_processing:
-                            region = skimage.exposure.equalize_hist(region)
-                            # region = skimage.exposure.rescale_intensity(region, in_range=(0.1, 0.8))
-
-                        # append the region
-                        region = region.reshape((img_dim * img_dim,))
-                        regions = numpy.vstack([regions, region])
-
-                        # # save region for experimenting/debugging
-                        # filePathWrite = "D:\\_Dataset\\GTSDB\\Training_Regions\\" + file[:-4] + "_" + "{0:05d}.png".format(len(regions))
-                        # cv2.imwrite(filePathWrite, region.reshape((img_dim, img_dim)) * 255)
+                # crop, resize and pre-process (if needed) the regions of the current scale in one go, then append them
+                if len(window_boxes) > 0:
+                    window_regions = region_batcher.extract(img, window_boxes)
+                    regions = numpy.vstack([regions, window_regions.reshape((len(window_boxes), img_dim * img_dim))])
 
                 if add_true_negative:
                     # add some true negatives to increase variance of the machine
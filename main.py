@@ -11,6 +11,13 @@ import CNN.prop
 import CNN.consts
 import CNN.stview
 import CNN.comp
+import CNN.npnet
+import CNN.cache
+import CNN.region
+import CNN.nms
+import CNN.heatmap
+import CNN.sink
+import CNN.pipe
 
 print('Traffic Sign Recognition')
 
@@ -328,8 +335,22 @@ print('Traffic Sign Recognition')
 # CNN.utils.convolve_gtsdb(gtsrb_model_80, CNN.enums.SuperclassType._01_Prohibitory)
 # CNN.utils.change_target_to_binary(img_dim_80, CNN.enums.SuperclassType._01_Prohibitory)
 
+# the debug images (probability maps, proposals, results) are only saved if the artifact sink is enabled
+# CNN.sink.configure(enabled=True, root="D://_Dataset//GTSDB//Test_Regions")
+# CNN.sink.benchmark_sink()
+
 # detection proposals
 # CNN.prop.detection_proposal_and_save(img_path="D://_Dataset//GTSDB//Test_PNG//00028.png", min_dim=16, max_dim=160)
+# CNN.prop.benchmark_proposal_circles(["D://_Dataset//GTSDB//Test_PNG//%05d.png" % (i) for i in range(0, 20)])
+# CNN.prop.benchmark_proposal_types(["D://_Dataset//GTSDB//Test_PNG//%05d.png" % (i) for i in range(0, 100)], "D://_Dataset//GTSDB//Ground_Truth//gt.txt")
+# CNN.region.check_region_batcher(img_path="D://_Dataset//GTSDB//Test_PNG//00028.png", img_dim=img_dim_80)
+# CNN.region.benchmark_image_pyramid(img_path="D://_Dataset//GTSDB//Test_PNG//00028.png", img_dim=img_dim_80)
+# CNN.region.benchmark_shared_lut(["D://_Dataset//GTSDB//Test_PNG//%05d.png" % (i) for i in range(0, 100)], "D://_Dataset//GTSDB//Ground_Truth//gt.txt", gtsrb_model_80, gtsdb_model_bin_80)
+# CNN.nms.check_suppression()
+# CNN.nms.benchmark_suppression()
+# CNN.nms.benchmark_score_suppression()
+# CNN.nms.check_batched_suppression()
+# CNN.heatmap.check_heatmap()
 
 # train the detector (detector will convolve the images each epoch)
 # CNN.detec.train_deep(dataset_path=gtsdb_dataset_80, recognition_model_path=gtsrb_model_80, detection_model_path=gtsdb_model_80,
@@ -342,6 +363,16 @@ print('Traffic Sign Recognition')
 # test the detector
 # CNN.detec.detect_from_dataset(dataset_path=gtsdb_dataset_80, recognition_model_path=gtsrb_model_80, detection_model_path=gtsdb_model_80)
 
+# convert the recognition model to the binary format, so it's memory-mapped when loaded
+# CNN.utils.convert_model(gtsrb_model_80, 'D:\\_Dataset\\GTSRB\\cnn_model_80.bin', CNN.enums.ModelType._02_conv3_mlp2)
+
+# compare the numpy backend with the theano one (parity of the outputs and latency)
+# CNN.npnet.check_parity(recognition_model_path=gtsrb_model_80, detection_model_path=gtsdb_model_bin_80)
+# CNN.npnet.benchmark_backends(recognition_model_path=gtsrb_model_80, detection_model_path=gtsdb_model_bin_80)
+
+# compare the fused detector (conv+pool and MLP in one function) with the not fused one
+# CNN.cache.check_fused_detector(recognition_model_path=gtsrb_model_80, detection_model_path=gtsdb_model_bin_80)
+
 # test the detector
 # CNN.detec.binary_detect_from_file_fast(img_path="D://_Dataset//GTSDB//Test_PNG//_img16.png", model_type=CNN.enums.ModelType._02_conv3_mlp2,
 #                                  recognition_model_path=gtsrb_model_80, detection_model_path=gtsdb_model_bin_80, img_dim=img_dim_80)
@@ -426,6 +457,14 @@ print('Traffic Sign Recognition')
 #     print("image: %s" % (img_id))
 #     img_path = "D:\\_Dataset\\GTSDB\\Test_PNG\\%s.png" % (img_id)
 #     street_view.process_image_and_save(img_path, i)
+# CNN.sink.flush()
+
+# process the frames of a route using the staged pipeline, against a local stand-in of street view serving GTSDB frames
+# server = CNN.pipe.FrameServer(["D://_Dataset//GTSDB//Test_PNG//%05d.png" % (i) for i in range(100, 200)])
+# street_view = CNN.stview.StreetViewSpan(True, street_view_url=server.base_url)
+# street_view.process_street_view_route(server.locations)
+# server.shutdown()
+# CNN.pipe.check_pipeline()
 
 # endregion
 